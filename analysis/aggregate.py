@@ -0,0 +1,223 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from indiv_data import (CACHE_VERSION, CATEGORICAL_COLUMNS, INDIV_COLUMNS, INDIV_DATA_PATH,
+                        cache_path, code_dtype, file_hash, file_stat, write_meta)
+
+################################################################################
+# SCHEMA
+################################################################################
+
+# Expected columns of every per-subject extraction file, and how each is parsed.
+# Columns not listed here are stored as dictionary-encoded strings.
+NUMERIC_COLUMNS = {
+    "ROI": np.int64,
+    "LocalizerSize": np.int64,
+    "EffectSize": np.float64,
+    "Speak_and_type": np.int64,
+}
+
+# Checks that `df` (read from `path`) has the expected columns and types, and
+# returns it with the columns in the standard order.
+def validate(df, path):
+    missing = [c for c in INDIV_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"{path}: missing columns {missing}")
+    df = df[INDIV_COLUMNS].copy()
+    for col, dtype in NUMERIC_COLUMNS.items():
+        values = pd.to_numeric(df[col], errors="coerce")
+        if values.isna().any() and col != "EffectSize":
+            raise ValueError(f"{path}: non-numeric or missing values in {col}")
+        df[col] = values.astype(dtype)
+    for col in INDIV_COLUMNS:
+        if col not in NUMERIC_COLUMNS and df[col].isna().any():
+            raise ValueError(f"{path}: missing values in {col}")
+    return df
+
+################################################################################
+# PER-FILE PARTS
+################################################################################
+
+# Worker: parses one per-subject file and saves it as a part (.npz) holding one
+# array per column, with string columns stored as local codes + dictionary.
+# Nothing is parsed if the file's hash equals `known_hash`.
+def parse_part(path, part_path, known_hash=None):
+    digest = file_hash(path)
+    if digest == known_hash:
+        return {"path": path, "sha256": digest, "changed": False}
+    df = validate(pd.read_csv(path), path)
+    arrays = {}
+    for col in INDIV_COLUMNS:
+        if col in NUMERIC_COLUMNS:
+            arrays[col] = df[col].to_numpy()
+        else:
+            codes, uniques = pd.factorize(df[col])
+            arrays[f"{col}.codes"] = codes.astype(np.int32)
+            arrays[f"{col}.dict"] = np.asarray(uniques, dtype=str)
+    np.savez(part_path, **arrays)
+    return {"path": path, "sha256": digest, "changed": True, "n_rows": len(df)}
+
+def _part_name(path, root):
+    rel = os.path.relpath(path, root)
+    return hashlib.sha256(rel.encode()).hexdigest()[:16] + ".npz"
+
+################################################################################
+# MERGING
+################################################################################
+
+# Builds the columnar store (same layout as indiv_data's cache) from the parts,
+# one part at a time, into preallocated memory-mapped columns. The merged CSV is
+# written alongside (also part by part), and its hash is recorded so that
+# indiv_data.load_indiv_data picks the store up without reparsing the CSV.
+def merge_parts(parts, store, csv_path):
+    n_rows = sum(p["n_rows"] for p in parts)
+    tmp = store + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    # Global dictionaries for the string columns and ROI (which is numeric in
+    # the files but categorical in the store), sorted like pd.Categorical.
+    string_columns = [c for c in INDIV_COLUMNS if c not in NUMERIC_COLUMNS]
+    dictionaries = {col: set() for col in string_columns + ["ROI"]}
+    for p in parts:
+        with np.load(p["part"]) as part:
+            for col in string_columns:
+                dictionaries[col].update(part[f"{col}.dict"].tolist())
+            dictionaries["ROI"].update(np.unique(part["ROI"]).tolist())
+    dictionaries = {col: sorted(d) for col, d in dictionaries.items()}
+    lookups = {col: {v: i for i, v in enumerate(d)} for col, d in dictionaries.items()}
+
+    columns = {}
+    for col in INDIV_COLUMNS:
+        if col in dictionaries:
+            dtype = code_dtype(len(dictionaries[col]))
+        else:
+            dtype = NUMERIC_COLUMNS[col]
+        columns[col] = np.lib.format.open_memmap(os.path.join(tmp, f"{col}.npy"), mode="w+", dtype=dtype, shape=(n_rows,))
+
+    csv_hash = hashlib.sha256()
+    with open(csv_path + ".tmp", "wb") as csv:
+        offset = 0
+        for i, p in enumerate(parts):
+            with np.load(p["part"]) as part:
+                n = p["n_rows"]
+                frame = {}
+                for col in INDIV_COLUMNS:
+                    if col in string_columns:
+                        local = part[f"{col}.dict"]
+                        remap = np.array([lookups[col][v] for v in local.tolist()], dtype=columns[col].dtype)
+                        columns[col][offset:offset+n] = remap[part[f"{col}.codes"]]
+                        frame[col] = local[part[f"{col}.codes"]]
+                    else:
+                        values = part[col]
+                        if col == "ROI":
+                            local, inverse = np.unique(values, return_inverse=True)
+                            remap = np.array([lookups[col][v] for v in local.tolist()], dtype=columns[col].dtype)
+                            columns[col][offset:offset+n] = remap[inverse]
+                        else:
+                            columns[col][offset:offset+n] = values
+                        frame[col] = values
+                chunk = pd.DataFrame(frame).to_csv(header=(i == 0), index=False).encode()
+                csv_hash.update(chunk)
+                csv.write(chunk)
+                offset += n
+    for col in columns.values():
+        col.flush()
+    del columns
+    os.replace(csv_path + ".tmp", csv_path)
+
+    specs = []
+    for col in INDIV_COLUMNS:
+        if col in dictionaries:
+            specs.append({
+                "name": col, "kind": "codes", "categories": dictionaries[col],
+                "categorical": col in CATEGORICAL_COLUMNS
+            })
+        else:
+            specs.append({"name": col, "kind": "values"})
+    write_meta(tmp, {
+        "version": CACHE_VERSION, "sha256": csv_hash.hexdigest(), "stat": file_stat(csv_path),
+        "n_rows": n_rows, "columns": specs
+    })
+    shutil.rmtree(store, ignore_errors=True)
+    os.replace(tmp, store)
+
+################################################################################
+# AGGREGATION
+################################################################################
+
+def discover(root, pattern="**/*.csv"):
+    return sorted(glob.glob(os.path.join(root, pattern), recursive=True))
+
+# Parses every new or changed per-subject file under `root` in a process pool
+# and rebuilds the consolidated CSV and columnar store. Files whose size/mtime
+# (or, failing that, content hash) match the last build are not reparsed.
+def aggregate(root, csv_path=INDIV_DATA_PATH, pattern="**/*.csv", workers=None, cache_dir=None):
+    store = cache_path(csv_path, cache_dir)
+    parts_dir = store + ".parts"
+    manifest_path = os.path.join(parts_dir, "manifest.json")
+    os.makedirs(parts_dir, exist_ok=True)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    paths = discover(root, pattern)
+    jobs = []
+    entries = {}
+    for path in paths:
+        key = os.path.relpath(path, root)
+        entry = manifest.get(key)
+        part_path = os.path.join(parts_dir, _part_name(path, root))
+        if entry is not None and entry["stat"] == file_stat(path) and os.path.exists(part_path):
+            entries[key] = entry
+        else:
+            known_hash = entry["sha256"] if entry is not None and os.path.exists(part_path) else None
+            jobs.append((key, path, part_path, known_hash))
+
+    changed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {key: pool.submit(parse_part, path, part_path, known_hash) for key, path, part_path, known_hash in jobs}
+        for key, path, part_path, _ in jobs:
+            result = futures[key].result()
+            entry = dict(manifest[key]) if not result["changed"] else {"n_rows": result["n_rows"]}
+            entry.update({"stat": file_stat(path), "sha256": result["sha256"], "part": part_path})
+            entries[key] = entry
+            changed += result["changed"]
+
+    # Drop parts of files that have disappeared since the last build.
+    for key in set(manifest) - set(entries):
+        if os.path.exists(manifest[key]["part"]):
+            os.remove(manifest[key]["part"])
+        changed += 1
+
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(entries, f, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    up_to_date = (changed == 0 and os.path.exists(csv_path) and os.path.exists(store))
+    if up_to_date:
+        print(f"{len(paths)} files unchanged; nothing to rebuild")
+    else:
+        print(f"Merging {len(paths)} files ({changed} new, changed or removed)")
+        merge_parts([entries[os.path.relpath(p, root)] for p in paths], store, csv_path)
+    return store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the individual-level dataset from per-subject extraction files.")
+    parser.add_argument("root", help="directory containing the per-subject files")
+    parser.add_argument("--pattern", default="**/*.csv", help="glob pattern (relative to root) for the per-subject files")
+    parser.add_argument("--out", default=INDIV_DATA_PATH, help="path of the consolidated CSV (the columnar store is written to its cache)")
+    parser.add_argument("--cache-dir", default=None, help="directory for the columnar store (default: data/cache)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    print(aggregate(args.root, args.out, args.pattern, args.workers, args.cache_dir))
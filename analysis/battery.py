@@ -0,0 +1,293 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from indiv_data import CACHE_DIR, load_indiv_data
+from lmm import convergence_messages, lmer
+from model_data import (BATTERY, FROI_STR, FROIS, INTERACTION_EFFECTS, INTERACTIONS, build_sources,
+                        contrast_data, expt_data, interaction_data)
+from permutation import p_adjust_fdr
+from screening import apply_exclusions
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+FIT_CACHE_DIR = os.path.join(CACHE_DIR, "fits")
+# Bump when the fitting code changes, so that cached fits are not reused.
+FIT_VERSION = 3
+# Convergence warnings, in the format of lmers_convergence_tracking.R.
+TRACKING_PATH = "convergence_tracking_outputs/convergence_tracking_python.csv"
+TRACKING_COLUMNS = ["network", "fROI", "cond1", "cond1_src", "cond2", "cond2_src", "warning_message"]
+
+# A model is refitted from the previous fit's estimates when its subjects are a
+# superset of the previous ones with at most this fraction added.
+WARM_MAX_ADDED = 0.2
+# Random-effect parameters on the boundary are restarted from here, since the
+# REML criterion is flat in theta at zero.
+WARM_THETA_FLOOR = 0.1
+
+# Models of fit_model and fit_model_v2 in lmers.R.
+FORMULAS = {
+    "network": "EffectSize ~ Effect + (1|ROI) + (1|Subject)",
+    "separate_fROIs": "EffectSize ~ Effect + (1|Subject)",
+}
+INTERACTION_FORMULAS = {
+    "network": "EffectSize ~ TaskType + StimType + TaskType*StimType + (1|ROI) + (1|Subject)",
+    "separate_fROIs": "EffectSize ~ TaskType + StimType + TaskType*StimType + (1|Subject)",
+}
+
+################################################################################
+# JOBS
+################################################################################
+
+# Hash of everything a fit depends on: the formula, the columns it uses (with
+# the level order of ordered factors) and the fitting code version.
+def job_key(data, formula):
+    h = hashlib.sha256(f"{FIT_VERSION}\n{formula}\n".encode())
+    for col in sorted(data.columns):
+        if col not in formula:
+            continue
+        values = data[col]
+        h.update(col.encode())
+        if values.dtype == "category" and values.cat.ordered:
+            h.update(repr(values.cat.categories.tolist()).encode())
+        if pd.api.types.is_float_dtype(values):
+            h.update(np.ascontiguousarray(values.to_numpy(dtype=np.float64)).tobytes())
+        else:
+            h.update("\x00".join(map(str, values)).encode())
+    return h.hexdigest()
+
+# One job per model fit: the network model and the separate fROI models of
+# every contrast (or task x stimulus spec) of the given tables. `fROIs` and
+# `formulas` default to those of lmers.R; fROIs (and contrasts) without any
+# data are skipped.
+def expand_jobs(tables, sources, fROIs=FROIS, formulas=FORMULAS, interaction_formulas=INTERACTION_FORMULAS):
+    froi_str = lambda network: FROI_STR[network] if fROIs is FROIS else f"{min(fROIs[network])}-{max(fROIs[network])}"
+    jobs = []
+    for table in tables:
+        for i, contrast in enumerate(BATTERY.get(table, [])):
+            model_types = ["separate_fROIs"] if table.startswith("validation") else ["network", "separate_fROIs"]
+            network_data = contrast_data(sources, contrast)
+            if network_data.Effect.nunique() < 2:
+                continue
+            for model_type in model_types:
+                ROIs = [None] if model_type == "network" else [r for r in fROIs[contrast["network"]] if r in set(network_data.ROI)]
+                for ROI in ROIs:
+                    data = network_data if ROI is None else network_data[network_data.ROI == ROI].reset_index(drop=True)
+                    desc = dict(network=contrast["network"], fROI=froi_str(contrast["network"]) if ROI is None else ROI,
+                                cond1=contrast["cond1"], cond1_src=contrast["cond1_src"],
+                                cond2=contrast["cond2"], cond2_src=contrast["cond2_src"])
+                    jobs.append(dict(table=table, kind="contrast", spec=i, model_type=model_type, ROI=ROI,
+                                     formula=formulas[model_type], data=data, desc=desc))
+        for i, spec in enumerate(INTERACTIONS.get(table, [])):
+            network_data = interaction_data(sources, spec)
+            if network_data.empty:
+                continue
+            for model_type in ["network", "separate_fROIs"]:
+                ROIs = [None] if model_type == "network" else [r for r in fROIs[spec["network"]] if r in set(network_data.ROI)]
+                for ROI in ROIs:
+                    data = network_data if ROI is None else network_data[network_data.ROI == ROI].reset_index(drop=True)
+                    desc = dict(network=spec["network"], fROI=froi_str(spec["network"]) if ROI is None else ROI,
+                                cond1="+".join(spec["conds"]), cond1_src=spec["src"], cond2="", cond2_src="")
+                    jobs.append(dict(table=table, kind="interaction", spec=i, model_type=model_type, ROI=ROI,
+                                     formula=interaction_formulas[model_type], data=data, desc=desc))
+    for job in jobs:
+        job["key"] = job_key(job["data"], job["formula"])
+        # The model's identity regardless of its data, for warm starts.
+        job["identity"] = hashlib.sha256((job["formula"] + json.dumps(job["desc"])).encode()).hexdigest()
+    return jobs
+
+# Worker: fits one model and returns the JSON-serializable result. Keyword
+# arguments (e.g. optimizer) are passed on to lmm.lmer.
+def fit_job(formula, data, **kwargs):
+    fit = lmer(formula, data, **kwargs)
+    return {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in fit.items()}
+
+################################################################################
+# RESULT CACHE
+################################################################################
+
+def read_fit(key, cache_dir=FIT_CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, f"{key}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_fit(key, fit, cache_dir=FIT_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(fit, f)
+    os.replace(path + ".tmp", path)
+
+# Parameter estimates of the last fit of every model (by identity), with the
+# subjects it was fitted on, used as starting values for the next refit.
+def read_starts(cache_dir=FIT_CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, "starts.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_starts(starts, cache_dir=FIT_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, "starts.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(starts, f)
+    os.replace(path + ".tmp", path)
+
+# Starting theta for a refit of a model previously fitted on `previous`
+# subjects, or None (cold start) if subjects were removed or too many added.
+def warm_start(start, subjects, max_added=WARM_MAX_ADDED):
+    if start is None:
+        return None
+    previous = set(start["subjects"])
+    added = set(subjects) - previous
+    if not previous <= set(subjects) or len(added) > max_added * len(previous):
+        return None
+    return np.maximum(start["theta"], WARM_THETA_FLOOR)
+
+def _subjects(job):
+    return sorted(map(str, job["data"]["Subject"].unique()))
+
+# Returns the fit of every job, from the cache where possible; the remaining
+# jobs are fitted in a process pool and cached as they finish. Jobs with
+# identical keys (e.g. a contrast shared by two tables) are fitted once.
+# Models refitted after a few subjects were added start from their previous
+# estimates (warm=False always starts from scratch).
+def run_jobs(jobs, workers=None, cache_dir=FIT_CACHE_DIR, warm=True):
+    fits = {}
+    todo = {}
+    for job in jobs:
+        if job["key"] in fits or job["key"] in todo:
+            continue
+        fit = read_fit(job["key"], cache_dir)
+        if fit is None:
+            todo[job["key"]] = job
+        else:
+            fits[job["key"]] = fit
+    starts = read_starts(cache_dir)
+    initial = {
+        key: warm_start(starts.get(job["identity"]), _subjects(job)) if warm else None
+        for key, job in todo.items()
+    }
+    n_warm = sum(start is not None for start in initial.values())
+    print(f"{len(jobs)} models: {len(fits)} cached, {len(todo)} to fit ({n_warm} warm-started)")
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                key: pool.submit(fit_job, job["formula"], job["data"], start=initial[key])
+                for key, job in todo.items()
+            }
+            for key, future in futures.items():
+                fits[key] = future.result()
+                fits[key]["warm_start"] = initial[key] is not None
+                write_fit(key, fits[key], cache_dir)
+        for job in jobs:
+            starts[job["identity"]] = {"theta": fits[job["key"]]["theta"], "subjects": _subjects(job)}
+        write_starts(starts, cache_dir)
+    return fits
+
+# Writes one line per fitted model with its convergence warnings (if any), in
+# the format of lmers_convergence_tracking.R, so that converge.py can read it.
+def write_convergence_tracking(jobs, fits, path=TRACKING_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(", ".join(TRACKING_COLUMNS) + "\n")
+        for job in jobs:
+            desc = job["desc"]
+            f.write("%s, %s, %s, %s, %s, %s , %s\n" % (
+                desc["network"], desc["fROI"], desc["cond1"], desc["cond1_src"],
+                desc["cond2"], desc["cond2_src"], convergence_messages(fits[job["key"]])
+            ))
+
+################################################################################
+# RESULTS TABLES
+################################################################################
+
+# Assembles the fits into the results tables written by lmers.R, keyed by
+# output name (e.g. "table1_network", "table1_sepfROIs", "validation_lang").
+def collect_results(tables, jobs, fits):
+    results = {}
+    for table in tables:
+        network_rows, sepfROI_rows = [], []
+        table_jobs = [job for job in jobs if job["table"] == table]
+        for i, contrast in enumerate(BATTERY.get(table, [])):
+            spec_jobs = [job for job in table_jobs if job["spec"] == i and job["kind"] == "contrast"]
+            desc = dict(cond1=contrast["cond1"], cond2=contrast["cond2"], expt_data=expt_data(contrast))
+            for job in spec_jobs:
+                if job["model_type"] == "network":
+                    fit = fits[job["key"]]
+                    network_rows.append(dict(desc, ROI=job["desc"]["fROI"], network=contrast["network"],
+                                             p_value=fit["p"][1], cohen_d=fit["d"][1]))
+            fROI_jobs = [job for job in spec_jobs if job["model_type"] == "separate_fROIs"]
+            p = [fits[job["key"]]["p"][1] for job in fROI_jobs]
+            for job, p_fdr in zip(fROI_jobs, p_adjust_fdr(p)):
+                fit = fits[job["key"]]
+                sepfROI_rows.append(dict(desc, ROI=job["ROI"], p_value_uncorrected=fit["p"][1],
+                                         p_value_fdr_corrected=p_fdr, cohen_d=fit["d"][1]))
+        for i, spec in enumerate(INTERACTIONS.get(table, [])):
+            spec_jobs = [job for job in table_jobs if job["spec"] == i and job["kind"] == "interaction"]
+            fROI_rows = []
+            for job in spec_jobs:
+                fit = fits[job["key"]]
+                for k, effect in enumerate(INTERACTION_EFFECTS, start=1):
+                    if job["model_type"] == "network":
+                        network_rows.append(dict(expt_data=spec["src"], ROI=job["desc"]["fROI"], network=spec["network"],
+                                                 effect=effect, p_value=fit["p"][k], cohen_d=fit["d"][k]))
+                    else:
+                        fROI_rows.append(dict(expt_data=spec["src"], ROI=job["ROI"], effect=effect,
+                                              p_value_uncorrected=fit["p"][k], cohen_d=fit["d"][k]))
+            # FDR correction across all effects and fROIs together, as in lmers.R.
+            for row, p_fdr in zip(fROI_rows, p_adjust_fdr([row["p_value_uncorrected"] for row in fROI_rows])):
+                row["p_value_fdr_corrected"] = p_fdr
+                sepfROI_rows.append(row)
+
+        sepfROIs = pd.DataFrame(sepfROI_rows)
+        if table.startswith("validation"):
+            results[table] = sepfROIs.drop(columns="expt_data")
+        else:
+            network = pd.DataFrame(network_rows)
+            if table in INTERACTIONS:
+                sepfROIs = sepfROIs[["expt_data", "ROI", "effect", "p_value_uncorrected", "p_value_fdr_corrected", "cohen_d"]]
+            results[f"{table}_network"] = network
+            results[f"{table}_sepfROIs"] = sepfROIs
+    return results
+
+# Runs the whole battery (or the given tables), refitting only the models
+# whose data or formula changed since they were last cached.
+def run_battery(tables=None, sources=None, workers=None, cache_dir=FIT_CACHE_DIR, warm=True, tracking_path=TRACKING_PATH):
+    tables = list(BATTERY) + list(INTERACTIONS) if tables is None else tables
+    sources = build_sources() if sources is None else sources
+    jobs = expand_jobs(tables, sources)
+    fits = run_jobs(jobs, workers, cache_dir, warm)
+    if tracking_path is not None:
+        write_convergence_tracking(jobs, fits, tracking_path)
+    return collect_results(tables, jobs, fits)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the linear mixed-effects models behind the results tables, in parallel and with caching.")
+    parser.add_argument("tables", nargs="*", default=None, help="tables to run (default: all)")
+    parser.add_argument("--out-dir", default="results/python", help="directory for the results CSVs")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--cache-dir", default=FIT_CACHE_DIR, help="directory of cached fits")
+    parser.add_argument("--cold", action="store_true", help="do not warm-start refits from previous estimates")
+    parser.add_argument("--tracking", default=TRACKING_PATH, help="where to write the convergence tracking CSV")
+    parser.add_argument("--exclusions", default=None, help="exclusion manifest written by screening.py")
+    args = parser.parse_args()
+    sources = None
+    if args.exclusions is not None:
+        sources = build_sources(apply_exclusions(load_indiv_data(), args.exclusions))
+    results = run_battery(args.tables or None, sources=sources, workers=args.workers, cache_dir=args.cache_dir,
+                          warm=not args.cold, tracking_path=args.tracking)
+    os.makedirs(args.out_dir, exist_ok=True)
+    for name, df in results.items():
+        out = os.path.join(args.out_dir, f"{name}.csv")
+        print(f"Writing {out}")
+        df.to_csv(out, index=False)
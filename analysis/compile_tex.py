@@ -0,0 +1,183 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from indiv_data import CACHE_DIR
+from format_table import TABLES_DIR
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+FIGURE1_TEX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "figures", "code", "figure1", "figure1.tex")
+# Digests of the documents (and their inputs) as of their last successful compile.
+BUILD_STATE_PATH = os.path.join(CACHE_DIR, "tex_builds.json")
+
+DEFAULT_ENGINE = "pdflatex"
+# Documents that load fontspec need a Unicode engine.
+FONTSPEC_ENGINE = "xelatex"
+
+# Files a document reads: \includegraphics[...]{...}, \input{...} and \include{...}.
+INPUT_PATTERN = re.compile(r"\\(?:includegraphics\s*(?:\[[^\]]*\])?|input|include)\s*\{([^}]+)\}")
+COMMENT_PATTERN = re.compile(r"(?<!\\)%.*")
+# Documents converted to images by the standalone class (figure 1 writes a TIFF)
+# run external programs, which needs -shell-escape.
+CONVERT_PATTERN = re.compile(r"\\documentclass\s*\[[^\]]*\bconvert\b")
+# Auxiliary files that are not copied next to the document.
+AUX_EXTENSIONS = [".tex", ".aux", ".log", ".out"]
+
+################################################################################
+# DOCUMENTS
+################################################################################
+
+# Every standalone document in the repository: the tables and figure 1.
+def all_documents():
+    return sorted(glob.glob(os.path.join(TABLES_DIR, "*.tex"))) + [os.path.normpath(FIGURE1_TEX)]
+
+def engine_for(tex):
+    with open(tex) as f:
+        source = COMMENT_PATTERN.sub("", f.read())
+    return FONTSPEC_ENGINE if "{fontspec}" in source else DEFAULT_ENGINE
+
+def needs_shell_escape(tex):
+    with open(tex) as f:
+        return CONVERT_PATTERN.search(COMMENT_PATTERN.sub("", f.read())) is not None
+
+# Paths of the files a document reads, relative to its directory. Commented
+# out lines are ignored.
+def document_inputs(tex):
+    with open(tex) as f:
+        source = COMMENT_PATTERN.sub("", f.read())
+    inputs = []
+    for match in INPUT_PATTERN.finditer(source):
+        name = match.group(1).strip()
+        if not match.group(0).startswith("\\includegraphics") and not os.path.splitext(name)[1]:
+            name += ".tex"
+        inputs.append(name)
+    return sorted(set(inputs))
+
+# SHA-256 over the engine, the document and every file it reads (missing
+# inputs are hashed by name, so creating them later triggers a recompile).
+def document_digest(tex, engine):
+    h = hashlib.sha256(engine.encode())
+    for name in [os.path.basename(tex)] + document_inputs(tex):
+        path = os.path.join(os.path.dirname(tex), name)
+        h.update(name.encode() + b"\0")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def read_build_state(path=BUILD_STATE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_build_state(state, path=BUILD_STATE_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+################################################################################
+# COMPILING
+################################################################################
+
+# Compiles one document in its own temporary directory, so that parallel jobs
+# never share auxiliary files. Inputs are found through TEXINPUTS in the
+# document's directory. The PDF (and converted images), and the compile log
+# are copied next to the document. Returns whether the compile succeeded.
+def compile_document(tex, engine, runs=1):
+    tex = os.path.abspath(tex)
+    source_dir, name = os.path.split(tex)
+    stem = os.path.splitext(name)[0]
+    with tempfile.TemporaryDirectory(prefix=f"{stem}-") as tmp:
+        shutil.copy(tex, tmp)
+        env = dict(os.environ, TEXINPUTS=source_dir + os.pathsep)
+        command = [engine, "-interaction=nonstopmode", "-halt-on-error"]
+        if needs_shell_escape(tex):
+            command.append("-shell-escape")
+        log = []
+        for _ in range(runs):
+            result = subprocess.run(
+                command + [name],
+                cwd=tmp, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            log.append(result.stdout.decode(errors="replace"))
+            if result.returncode != 0:
+                break
+        # The engine's own log is more complete than its output, if there is one.
+        engine_log = os.path.join(tmp, f"{stem}.log")
+        if os.path.exists(engine_log):
+            shutil.copy(engine_log, os.path.join(source_dir, f"{stem}.log"))
+        else:
+            with open(os.path.join(source_dir, f"{stem}.log"), "w") as f:
+                f.write("".join(log))
+        if result.returncode != 0 or not os.path.exists(os.path.join(tmp, f"{stem}.pdf")):
+            return False
+        # The PDF and any converted images.
+        for output in glob.glob(os.path.join(tmp, f"{stem}.*")):
+            if os.path.splitext(output)[1] not in AUX_EXTENSIONS:
+                shutil.copy(output, source_dir)
+    return True
+
+# Compiles the documents whose digest changed since their last successful
+# compile (or whose PDF is missing), in a pool of `workers` threads (the work
+# happens in the engine subprocesses; by default all documents at once). Returns {document: "compiled",
+# "up to date" or "failed"}.
+def compile_documents(documents, engine=None, workers=None, force=False, runs=1, state_path=BUILD_STATE_PATH):
+    state = read_build_state(state_path)
+    engines, digests, todo, status = {}, {}, [], {}
+    for tex in documents:
+        key = os.path.relpath(os.path.abspath(tex), os.path.dirname(os.path.abspath(__file__)))
+        engines[tex] = engine or engine_for(tex)
+        digests[tex] = document_digest(tex, engines[tex])
+        pdf = os.path.splitext(tex)[0] + ".pdf"
+        if not force and state.get(key) == digests[tex] and os.path.exists(pdf):
+            status[tex] = "up to date"
+        else:
+            todo.append((tex, key))
+    missing = sorted({engines[tex] for tex, _ in todo if shutil.which(engines[tex]) is None})
+    if missing:
+        raise FileNotFoundError(f"LaTeX engine not found: {', '.join(missing)} (install it or pass --engine)")
+    with ThreadPoolExecutor(max_workers=workers or max(len(todo), 1)) as pool:
+        futures = {tex: pool.submit(compile_document, tex, engines[tex], runs) for tex, _ in todo}
+        for tex, key in todo:
+            if futures[tex].result():
+                status[tex] = "compiled"
+                state[key] = digests[tex]
+            else:
+                status[tex] = "failed"
+                state.pop(key, None)
+    write_build_state(state, state_path)
+    return {tex: status[tex] for tex in documents}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the LaTeX tables and figure 1 in parallel, skipping unchanged documents.")
+    parser.add_argument("documents", nargs="*", default=None, help=".tex files (default: tables/*.tex and figure1.tex)")
+    parser.add_argument("--engine", default=None,
+                        help=f"LaTeX engine (default: {DEFAULT_ENGINE}, or {FONTSPEC_ENGINE} for documents using fontspec)")
+    parser.add_argument("--workers", type=int, default=None, help="documents compiled at once (default: all of them)")
+    parser.add_argument("--runs", type=int, default=1, help="engine runs per document")
+    parser.add_argument("--force", action="store_true", help="recompile even if nothing has changed")
+    args = parser.parse_args()
+    start = time.time()
+    try:
+        status = compile_documents(args.documents or all_documents(), args.engine, args.workers, args.force, args.runs)
+    except FileNotFoundError as e:
+        raise SystemExit(str(e))
+    for tex, result in status.items():
+        log = "" if result != "failed" else f" (see {os.path.splitext(tex)[0]}.log)"
+        print(f"{tex}: {result}{log}")
+    print(f"Done in {time.time() - start:.1f}s")
+    if "failed" in status.values():
+        raise SystemExit(1)
@@ -0,0 +1,161 @@
+import argparse
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from battery import FIT_CACHE_DIR, FORMULAS, expand_jobs, fit_job, read_fit
+from lmm import convergence_messages
+from model_data import BATTERY, INTERACTIONS, _contrast, build_sources, contrast_data
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+TRACKING_PATH = "convergence_tracking_outputs/convergence_tracking__.csv"
+VERDICTS_PATH = "convergence_tracking_outputs/convergence_verdicts.csv"
+
+# Alternatives to the default optimizer, in the order they are tried (the
+# scipy counterparts of the optimizers lme4's allFit runs).
+OPTIMIZERS = ["L-BFGS-B", "Nelder-Mead", "Powell", "TNC", "SLSQP", "COBYLA", "trust-constr"]
+# lme4's check.conv.grad tolerance.
+GRAD_TOL = 2e-3
+
+################################################################################
+# MODELS TO CHECK
+################################################################################
+
+# Reads the output of lmers_convergence_tracking.R and returns the models
+# whose fit raised a convergence warning (and, with singular=True, those that
+# were only flagged as boundary fits), as dicts with the model data attached.
+def tracked_models(sources, path=TRACKING_PATH, singular=False):
+    tracking = pd.read_csv(path, skipinitialspace=True, dtype=str, keep_default_na=False)
+    tracking.columns = tracking.columns.str.strip()
+    tracking = tracking.apply(lambda col: col.str.strip())
+    tracking = tracking[tracking.network != ""]
+    failed = tracking.warning_message.str.contains("converge")
+    if singular:
+        failed |= tracking.warning_message.str.contains("singular")
+    models = []
+    for _, row in tracking[failed].iterrows():
+        contrast = _contrast(row.cond1, row.cond2, row.cond1_src, row.cond2_src, network=row.network)
+        ROI = None if "-" in row.fROI else int(row.fROI)
+        model_type = "network" if ROI is None else "separate_fROIs"
+        models.append(dict(
+            row.to_dict(), formula=FORMULAS[model_type], data=contrast_data(sources, contrast, ROI)
+        ))
+    return models
+
+# Returns the models of the Python battery whose cached fit did not converge
+# (optimizer failure, or a gradient above lme4's tolerance).
+def battery_models(sources, tables=None, cache_dir=FIT_CACHE_DIR):
+    tables = list(BATTERY) + list(INTERACTIONS) if tables is None else tables
+    models = []
+    for job in expand_jobs(tables, sources):
+        fit = read_fit(job["key"], cache_dir)
+        if fit is None or (fit["converged"] and fit["max_grad"] < GRAD_TOL):
+            continue
+        models.append(dict(
+            job["desc"], table=job["table"], key=job["key"], warning_message=convergence_messages(fit, GRAD_TOL),
+            formula=job["formula"], data=job["data"]
+        ))
+    return models
+
+################################################################################
+# AGREEMENT
+################################################################################
+
+def fixed_effects_agree(a, b, rtol=1e-4, atol=1e-6):
+    return np.allclose(a["beta"], b["beta"], rtol=rtol, atol=atol)
+
+# Largest set of optimizers whose fixed effects agree with a common reference
+# fit (the first finished fit that most others agree with).
+def agreeing(fits, rtol=1e-4, atol=1e-6):
+    best = []
+    for ref in fits:
+        group = [name for name in fits if fixed_effects_agree(fits[ref], fits[name], rtol, atol)]
+        if len(group) > len(best):
+            best = group
+    return best
+
+################################################################################
+# CONVERGENCE SERVICE
+################################################################################
+
+# Refits every model with the alternative optimizers, each fit in its own
+# worker process. As soon as `min_agree` optimizers agree on a model's fixed
+# effects, its remaining fits are cancelled. Returns one verdict per model:
+# "consistent" if enough optimizers agree, "inconsistent" otherwise.
+def check_models(models, optimizers=OPTIMIZERS, min_agree=3, rtol=1e-4, atol=1e-6, workers=None):
+    min_agree = min(min_agree, len(optimizers))
+    fits = [dict() for _ in models]
+    errors = [dict() for _ in models]
+    done = [False] * len(models)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        # Submitted model by model, so that early agreement on one model
+        # frees the pool for the next one.
+        for i, model in enumerate(models):
+            for optimizer in optimizers:
+                future = pool.submit(fit_job, model["formula"], model["data"], optimizer=optimizer)
+                pending[future] = (i, optimizer)
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i, optimizer = pending.pop(future)
+                if done[i] or future.cancelled():
+                    continue
+                try:
+                    fits[i][optimizer] = future.result()
+                except Exception as e:
+                    errors[i][optimizer] = repr(e)
+                    continue
+                if len(agreeing(fits[i], rtol, atol)) >= min_agree:
+                    done[i] = True
+                    for other, (j, _) in list(pending.items()):
+                        if j == i and other.cancel():
+                            del pending[other]
+
+    verdicts = []
+    for model, model_fits, model_errors in zip(models, fits, errors):
+        group = agreeing(model_fits, rtol, atol)
+        row = {k: v for k, v in model.items() if k not in ["formula", "data", "key"]}
+        row.update(
+            n_optimizers_run=len(model_fits) + len(model_errors),
+            n_agree=len(group),
+            agreeing_optimizers=";".join(group),
+            failed_optimizers=";".join(model_errors),
+            verdict="consistent" if len(group) >= min_agree else "inconsistent",
+        )
+        if group:
+            beta = np.array([model_fits[name]["beta"] for name in model_fits])
+            ref = model_fits[group[0]]
+            row.update(
+                estimate=ref["beta"][1], p_value=ref["p"][1], cohen_d=ref["d"][1],
+                max_abs_beta_diff=float(np.max(np.ptp(beta, axis=0))),
+            )
+        verdicts.append(row)
+    return pd.DataFrame(verdicts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refit non-converged models with several optimizers in parallel.")
+    parser.add_argument("--tracking", default=TRACKING_PATH, help="output of lmers_convergence_tracking.R")
+    parser.add_argument("--from-battery", action="store_true", help="check the non-converged fits cached by battery.py instead")
+    parser.add_argument("--singular", action="store_true", help="also check boundary (singular) fits")
+    parser.add_argument("--min-agree", type=int, default=3, help="number of agreeing optimizers needed to stop early")
+    parser.add_argument("--rtol", type=float, default=1e-4, help="relative tolerance on the fixed effects")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--out", default=VERDICTS_PATH)
+    args = parser.parse_args()
+    sources = build_sources()
+    if args.from_battery:
+        models = battery_models(sources)
+    else:
+        models = tracked_models(sources, args.tracking, args.singular)
+    print(f"Checking {len(models)} models with {len(OPTIMIZERS)} optimizers")
+    if not models:
+        raise SystemExit("No non-converged models to check")
+    verdicts = check_models(models, min_agree=args.min_agree, rtol=args.rtol, workers=args.workers)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    verdicts.to_csv(args.out, index=False)
+    print(verdicts["verdict"].value_counts().to_string())
@@ -1,9 +1,24 @@
+import argparse
+import csv
+import hashlib
+import html
+import io
+import json
+import os
+
+import numpy as np
 import pandas as pd
 
+from indiv_data import CACHE_DIR
+from results_store import RESULTS_DB, ResultsStore
+
 ################################################################################
 # CONSTANTS AND MAPS
 ################################################################################
 SIG_LEVEL = 0.05
+TABLES_DIR = "tables"
+# Digests of the inputs of the last build of every table.
+BUILD_STATE_PATH = os.path.join(CACHE_DIR, "table_builds.json")
 ROI_names = {
     "lang": ['IFGorb', 'IFG', 'MFG', 'AntTemp', 'PostTemp', 'AngG'],
     "MD": ['LH PostParietal', 'LH midParietal', 'LH antParietal', 'LH supFrontal',
@@ -22,6 +37,12 @@ network_names = {
     "lang": "Language",
     "MD": "MD"
 }
+# Cell shading: predicted and significant in green, significant in the
+# opposite direction in red, significant but not predicted in blue, and
+# predicted not to be significant and shown to be equivalent to zero in
+# yellow.
+SHADES = {"g": (197, 217, 191), "r": (238, 196, 196), "b": (196, 227, 238), "e": (242, 233, 189)}
+SHADE_NAMES = {"g": "green", "r": "red", "b": "blue", "e": "yellow"}
 col_widths = {
     "table1": "14mm", 
     "table2": "15mm", 
@@ -42,8 +63,10 @@ def pretty_effect_name(e):
         "TaskType:StimType": "Interaction"
     }
     return d[e]
+def plain_p(p):
+    return "p<0.001" if p < 1e-3 else f"p={p:.3f}"
 def format_p(p, bold=False):
-    p = "p<0.001" if p < 1e-3 else f"p={p:.3f}"
+    p = plain_p(p)
     if bold:
         return "$\\mathbf{" + p + "}$"
     else:
@@ -108,28 +131,37 @@ PREDICTIONS = {
         },
     }
 }
-def format_cell(cell, p, d, table, contrast, expt):
+# Shading of a cell ("g", "r", "b", "e" or None).
+def cell_shade(p, d, table, contrast, expt, equivalent=False):
     pred = PREDICTIONS[table][expt]
     if p < SIG_LEVEL:
         if contrast in pred["sig"]:
             # Shade green if significant in the predicted direction.
             if pred["direction"](d):
-                return "\cellcolor{g}%s" % cell
+                return "g"
             else:
             # Shade red if significant in the opposite direction.
-                return "\cellcolor{r}%s" % cell
+                return "r"
         elif contrast in pred["nonsig"]:
             # Shade blue if significant and not predicted to be significant.
-            return "\cellcolor{b}%s" % cell
-    return cell
+            return "b"
+    elif equivalent and contrast in pred["nonsig"]:
+        # Shade yellow if predicted not to be significant and shown to be
+        # equivalent to zero by tost.py.
+        return "e"
+    return None
+def format_cell(cell, p, d, table, contrast, expt, equivalent=False):
+    shade = cell_shade(p, d, table, contrast, expt, equivalent)
+    return cell if shade is None else "\cellcolor{%s}%s" % (shade, cell)
 
 ################################################################################
 # DATA PROCESSING
 ################################################################################
 
-# Consistent data processing across questions.
-def process(path, by_expt=False):
-    df = pd.read_csv(path, float_precision="high")
+# Consistent data processing across questions. `name` names the results in
+# messages.
+def process(df, name, by_expt=False):
+    df = df.copy()
     try:
         # Replace underscores with LaTeX-friendly formatting.
         df['cond1'] = df['cond1'].apply(pretty_cond_name)
@@ -137,214 +169,389 @@ def process(path, by_expt=False):
         df['contrast'] = df["cond1"] + " vs.\\newline " + df["cond2"]
         df['contrast_ugly'] = df["cond1"] + "-" + df["cond2"]
     except:
-        print(f"Skipping formatting for {path}")
+        print(f"Skipping formatting for {name}")
     if by_expt:
-        df['expt'] = df['expt_data'].str.split('_', expand=True)[0]
+        df['expt'] = df['expt_data'].str.split('_').str[0]
         df['pretty_expt'] = df['expt'].map(expt_names)
     return df
 
-# Read in all data.
-dfs = {
-    table : {
-        "sepfROIs": process(f"results/{table}_sepfROIs.csv", by_expt=True),
-        "network": process(f"results/{table}_network.csv", by_expt=True)
-    } for table in PREDICTIONS.keys()
+# Result files that a table is built from, by name. The TOST files are
+# optional.
+def table_inputs(table):
+    return {
+        "sepfROIs": f"results/{table}_sepfROIs.csv",
+        "network": f"results/{table}_network.csv",
+        "sepfROIs_tost": f"results/{table}_sepfROIs_tost.csv",
+        "network_tost": f"results/{table}_network_tost.csv"
+    }
+
+# Kind of the store's rows that each input of a table is kept in.
+INPUT_KINDS = {
+    "sepfROIs": "contrasts", "network": "networks",
+    "sepfROIs_tost": "contrast_equivalence", "network_tost": "network_equivalence"
 }
 
+# The results of one table for one network, queried by key from the results
+# store: per-fROI rows from its `contrasts` table, network rows from
+# `networks` and the TOST results of tost.py from the equivalence tables, all
+# found through their (table_name, ..., network) index. The table's CSVs are
+# imported first; the store skips files that have not changed since their
+# last import. The TOST inputs are None if tost.py has not been run.
+def load_table(table, network="lang", db=RESULTS_DB):
+    paths = table_inputs(table)
+    store = ResultsStore(db)
+    dfs = {}
+    try:
+        for name, kind in INPUT_KINDS.items():
+            if name.endswith("_tost") and not os.path.exists(paths[name]):
+                dfs[name] = None
+                continue
+            store.import_csv(paths[name])
+            dfs[name] = store.query(kind, table, network=network)
+    finally:
+        store.close()
+    # The store keeps ROIs as text; fROIs are numbered.
+    dfs["sepfROIs"]["ROI"] = dfs["sepfROIs"]["ROI"].astype(int)
+    return {name: None if df is None else process(df, paths[name], by_expt=True) for name, df in dfs.items()}
+
 ################################################################################
-# GENERAL TABLE FUNCTIONS
+# CELL MATRIX
 ################################################################################
 
-def tabular_str(df, df_network, table, network="lang", tab="    ", col_width="14mm"):
-    # Filter df depending on network of interest.
+# Rows of a results frame that belong to the given network (the store's
+# network key, or MD sources having "MD" in their expt_data).
+def network_rows(df, network):
+    if "network" in df:
+        return df[df.network == network]
     if network == "lang":
-        df = df[~df.expt_data.str.contains("MD")]
-        df_network = df_network[~df_network.expt_data.str.contains("MD")]
-    else:
-        df = df[df.expt_data.str.contains("MD")]
-        df_network = df_network[df_network.expt_data.str.contains("MD")]
+        return df[~df.expt_data.str.contains("MD")]
+    return df[df.expt_data.str.contains("MD")]
+
+# Pivots one network's results into arrays indexed by (ROI, experiment, key),
+# where the key is the column the table has one column per experiment for
+# ("contrast_ugly", or "effect" for Table SI-4): the FDR-corrected p-values
+# and d of every fROI, and whether TOST showed the cell to be equivalent to
+# zero. Network rows are indexed by (experiment, key). `columns` and
+# `network_columns` list the keys of every experiment in order of appearance,
+# which is the order the table's columns are rendered in. When a cell has
+# several rows, the first one is used.
+def pivot_cells(df, df_network, table, network="lang", key="contrast_ugly", df_tost=None, df_network_tost=None):
+    df, df_network = network_rows(df, network), network_rows(df_network, network)
+    expts = sorted(PREDICTIONS[table].keys())
+    keys = list(pd.unique(pd.concat([df[key], df_network[key]])))
+    ROIs = sorted(df.ROI.unique())
+    expt_index, key_index, ROI_index = pd.Index(expts), pd.Index(keys), pd.Index(ROIs)
+    # Column labels (the pretty contrast names, if there are any).
+    label = "contrast" if "contrast" in df else key
+    labels = dict(zip(df[key], df[label]))
+
+    def columns_of(rows):
+        return [
+            (e, list(key_index.get_indexer(rows[rows.pretty_expt==expt][key].unique())))
+            for e, expt in enumerate(expts)
+        ]
+
+    # Array indices of the rows (ROI codes first, if given), and which rows
+    # have a position in the arrays.
+    def codes(rows, ROI_codes=None):
+        idx = [expt_index.get_indexer(rows.pretty_expt), key_index.get_indexer(rows[key])]
+        if ROI_codes is not None:
+            idx.insert(0, ROI_codes)
+        found = (np.stack(idx) >= 0).all(axis=0)
+        return tuple(i[found] for i in idx), found
+
+    shape = (len(ROIs), len(expts), len(keys))
+    p, d = np.full(shape, np.nan), np.full(shape, np.nan)
+    first = df.drop_duplicates(["pretty_expt", key, "ROI"])
+    idx, found = codes(first, ROI_index.get_indexer(first.ROI))
+    p[idx] = first.p_value_fdr_corrected.to_numpy(dtype=float)[found]
+    d[idx] = first.cohen_d.to_numpy(dtype=float)[found]
+
+    network_p, network_d = np.full(shape[1:], np.nan), np.full(shape[1:], np.nan)
+    network_ROI = np.full(shape[1:], None, dtype=object)
+    first = df_network.drop_duplicates(["pretty_expt", key])
+    idx, found = codes(first)
+    network_p[idx] = first.p_value.to_numpy(dtype=float)[found]
+    network_d[idx] = first.cohen_d.to_numpy(dtype=float)[found]
+    network_ROI[idx] = first.ROI.astype(str).to_numpy()[found]
+
+    # A cell is equivalent if any of its TOST rows is (ROIs compared as strings).
+    equivalent = np.zeros(shape, dtype=bool)
+    if df_tost is not None:
+        rows = df_tost[(df_tost.network==network) & df_tost.equivalent.astype(bool)]
+        idx, found = codes(rows, pd.Index([str(ROI) for ROI in ROIs]).get_indexer(rows.ROI.astype(str)))
+        equivalent[idx] = True
+    network_equivalent = np.zeros(shape[1:], dtype=bool)
+    if df_network_tost is not None:
+        rows = df_network_tost[(df_network_tost.network==network) & df_network_tost.equivalent.astype(bool)]
+        idx, found = codes(rows)
+        network_equivalent[idx] = network_ROI[idx] == rows.ROI.astype(str).to_numpy()[found]
+
+    return {
+        "expts": expts, "keys": keys, "labels": [labels.get(k, k) for k in keys], "ROIs": ROIs,
+        "columns": columns_of(df), "network_columns": columns_of(df_network),
+        "p": p, "d": d, "equivalent": equivalent,
+        "network_p": network_p, "network_d": network_d, "network_equivalent": network_equivalent,
+    }
+
+################################################################################
+# TABLE ROWS
+################################################################################
+
+# Name of an fROI in the first column of a table.
+def froi_name(network, ROI):
+    try:
+        return ROI_names[network][ROI-1]
+    except:
+        return str(ROI)
+
+# Header of a table: (experiment, column labels) for every experiment. Labels
+# are in LaTeX; `header` maps a column key's index to its label.
+def table_columns(cells, header=None):
+    header = (lambda k: cells["labels"][k]) if header is None else header
+    return [(cells["expts"][e], [header(k) for k in columns]) for e, columns in cells["columns"]]
+
+# Generates the rows of a table from its cell matrix, one at a time: the
+# network row first, then one row per fROI. Every row has a name and one cell
+# per column, with its p-value, d and shading.
+def table_rows(cells, table, network="lang"):
+    expts, keys = cells["expts"], cells["keys"]
+    def cell(p, d, e, k, equivalent):
+        return dict(p=p, d=d, shade=cell_shade(p, d, table, keys[k], expts[e], equivalent))
+
+    yield dict(name=f"{network_names[network]} network", network=True, cells=[
+        cell(cells["network_p"][e, k], cells["network_d"][e, k], e, k, cells["network_equivalent"][e, k])
+        for e, columns in cells["network_columns"] for k in columns
+    ])
+    for r, ROI in enumerate(cells["ROIs"]):
+        yield dict(name=froi_name(network, ROI), network=False, cells=[
+            cell(cells["p"][r, e, k], cells["d"][r, e, k], e, k, cells["equivalent"][r, e, k])
+            for e, columns in cells["columns"] for k in columns
+        ])
+
+# Column labels without LaTeX line breaks, for the other formats.
+def plain_label(label):
+    return label.replace("\\newline ", " ")
+
+def plain_d(d):
+    return f"d={d:.3f}" if not pd.isna(d) else "d=-"
+
+################################################################################
+# WRITERS
+################################################################################
+
+# Every writer streams the header and rows of one table to the file handle `f`
+# as they are generated, so that no table is held in memory as one string.
+
+LATEX_PREAMBLE = """\\documentclass[margin=0.1cm]{standalone}
+\\usepackage[utf8]{inputenc}
+\\usepackage{times}
+\\usepackage{newtxmath}
+\\usepackage[table]{xcolor}
+""" + "".join("\\definecolor{%s}{RGB}{%d, %d, %d}\n" % (shade, *rgb) for shade, rgb in SHADES.items()) + """\\usepackage{boldline} 
+\\usepackage{multirow}
+\\begin{document}
+\\scriptsize
+\\renewcommand{\\arraystretch}{1.5}
+"""
+LATEX_END = "\n\\end{document}"
+
+# The tabular environment alone.
+def write_latex_tabular(f, columns, rows, tab="    ", col_width="14mm", **options):
+    expt_names = [expt for expt, _ in columns]
     # Initialize header strings.
     tabular_header = tab + "\\begin{tabular}{V{3}c"
     row_super = tab
     row_header = tab + "fROI & "
     # Update header strings.
-    expt_names = sorted(PREDICTIONS[table].keys())
-    for expt in expt_names:
-        rows = df[df.pretty_expt==expt]
-        contrasts = rows.contrast.unique()
-        tabular_header += "|*{%d}{p{%s}}" % (len(contrasts), col_width)
+    for expt, labels in columns:
+        tabular_header += "|*{%d}{p{%s}}" % (len(labels), col_width)
         if expt != expt_names[-1]:
-            row_super += " & \multicolumn{%d}{c|}{\\textbf{%s}}" % (len(contrasts), expt)
+            row_super += " & \multicolumn{%d}{c|}{\\textbf{%s}}" % (len(labels), expt)
         else:
-            row_super += " & \multicolumn{%d}{cV{3}}{\\textbf{%s}}" % (len(contrasts), expt)
-        row_header += " & ".join(contrasts)
+            row_super += " & \multicolumn{%d}{cV{3}}{\\textbf{%s}}" % (len(labels), expt)
+        row_header += " & ".join(labels)
         if expt != expt_names[-1]:
             row_header += " & "
-    
-    # Initialize list of row strings.
-    row_strs = []
-
-    # Get row str corresponding to entire network.
-    row_str = tab + "\multirow{2}{*}{\\textbf{%s network}}" % network_names[network]
-    for expt in expt_names:
-        rows = df_network[df_network.pretty_expt==expt]
-        contrasts = rows.contrast_ugly.unique()
-        for contrast in contrasts:
-            contrast_rows = rows[(rows.contrast_ugly==contrast)]
-            p = contrast_rows.p_value.values[0]
-            d = contrast_rows.cohen_d.values[0]
-            p_str = format_p(p, bold=True)
-            d_str = "$\\mathbf{" + f"d={d:.3f}" + "}$" if not pd.isna(d) else "$\\mathbf{d=-}$"
-            cell_str = f"{d_str}\\newline{p_str}"
-            cell_str = format_cell(cell_str, p, d, table, contrast, expt)
-            row_str += f" & {cell_str}"
-    row_str += "\\\\\hline"
-    row_strs.append(row_str)
-
-    # Individual ROI results.
-    for ROI in sorted(df.ROI.unique()):
-        row_str = tab
-        try:
-            ROI_name = "\multirow{2}{*}{%s}" % ROI_names[network][ROI-1]
-            row_str += ROI_name
-        except:
-            row_str += "\multirow{2}{*}{%s}" % str(ROI)
-        for expt in expt_names:
-            rows = df[df.pretty_expt==expt]
-            contrasts = rows.contrast_ugly.unique()
-            for contrast in contrasts:
-                contrast_rows = rows[(rows.contrast_ugly==contrast)&(rows.ROI==ROI)]
-                p = contrast_rows.p_value_fdr_corrected.values[0]
-                d = contrast_rows.cohen_d.values[0]
-                p_str = format_p(p)
-                d_str = f"$d={d:.3f}$" if not pd.isna(d) else "$d=-$"
-                cell_str = f"{d_str}\\newline{p_str}"
-                cell_str = format_cell(cell_str, p, d, table, contrast, expt)
-                row_str += f" & {cell_str}"
-        row_str += "\\\\"
-        row_strs.append(row_str)
-
     # Finish up header strings.
     tabular_header += "V{3}} \\hlineB{3}"
     row_super += "\\\\"
     row_header += " \\\\\hline"
-    row_str = f"\n".join(row_strs) + "\\hlineB{3}"
-    tab_str = "\n".join([
-        tabular_header, row_super, row_header, row_str, tab + "\end{tabular}"
-    ])
-    return tab_str
+    f.write("\n".join([tabular_header, row_super, row_header]) + "\n")
 
-# Slightly modified code for Table SI-4
-def tabular_str_si4(df, df_network, table, network="lang", tab="    ", col_width="14mm"):
-    # Filter df depending on network of interest.
-    if network == "lang":
-        df = df[~df.expt_data.str.contains("MD")]
-        df_network = df_network[~df_network.expt_data.str.contains("MD")]
-    else:
-        df = df[df.expt_data.str.contains("MD")]
-        df_network = df_network[df_network.expt_data.str.contains("MD")]
-    # Initialize header strings.
-    tabular_header = tab + "\\begin{tabular}{V{3}c"
-    row_super = tab
-    row_header = tab + "fROI & "
-    # Update header strings.
-    expt_names = sorted(PREDICTIONS[table].keys())
-    for expt in expt_names:
-        rows = df[df.pretty_expt==expt]
-        effects = rows.effect.unique()
-        tabular_header += "|*{%d}{p{%s}}" % (len(effects), col_width)
-        if expt != expt_names[-1]:
-            row_super += " & \multicolumn{%d}{c|}{\\textbf{%s}}" % (len(effects), expt)
+    for i, row in enumerate(rows):
+        if row["network"]:
+            # Row corresponding to the entire network.
+            row_str = tab + "\multirow{2}{*}{\\textbf{%s}}" % row["name"]
         else:
-            row_super += " & \multicolumn{%d}{cV{3}}{\\textbf{%s}}" % (len(effects), expt)
-        row_header += " & ".join(pretty_effect_name(e) for e in effects)
-        if expt != expt_names[-1]:
-            row_header += " & "
-    
-    # Initialize list of row strings.
-    row_strs = []
-
-    # Get row str corresponding to entire network.
-    row_str = tab + "\multirow{2}{*}{\\textbf{%s network}}" % network_names[network]
-    for expt in expt_names:
-        rows = df_network[df_network.pretty_expt==expt]
-        effects = rows.effect.unique()
-        for effect in effects:
-            effect_rows = rows[rows.effect==effect]
-            p = effect_rows.p_value.values[0]
-            d = effect_rows.cohen_d.values[0]
-            p_str = format_p(p, bold=True)
-            d_str = "$\\mathbf{" + f"d={d:.3f}" + "}$" if not pd.isna(d) else "$\\mathbf{d=-}$"
-            cell_str = f"{d_str}\\newline{p_str}"
-            cell_str = format_cell(cell_str, p, d, table, effect, expt)
-            row_str += f" & {cell_str}"
-    row_str += "\\\\\hline"
-    row_strs.append(row_str)
-
-    # Individual ROI results.
-    for ROI in sorted(df.ROI.unique()):
-        row_str = tab
-        try:
-            ROI_name = "\multirow{2}{*}{%s}" % ROI_names[network][ROI-1]
-            row_str += ROI_name
-        except:
-            row_str += "\multirow{2}{*}{%s}" % str(ROI)
-        for expt in expt_names:
-            rows = df[df.pretty_expt==expt]
-            effects = rows.effect.unique()
-            for effect in effects:
-                effect_rows = rows[(rows.effect==effect)&(rows.ROI==ROI)]
-                p = effect_rows.p_value_fdr_corrected.values[0]
-                d = effect_rows.cohen_d.values[0]
+            row_str = tab + "\multirow{2}{*}{%s}" % row["name"]
+        for cell in row["cells"]:
+            p, d = cell["p"], cell["d"]
+            if row["network"]:
+                p_str = format_p(p, bold=True)
+                d_str = "$\\mathbf{" + f"d={d:.3f}" + "}$" if not pd.isna(d) else "$\\mathbf{d=-}$"
+            else:
                 p_str = format_p(p)
                 d_str = f"$d={d:.3f}$" if not pd.isna(d) else "$d=-$"
-                cell_str = f"{d_str}\\newline{p_str}"
-                cell_str = format_cell(cell_str, p, d, table, effect, expt)
-                row_str += f" & {cell_str}"
-        row_str += "\\\\"
-        row_strs.append(row_str)
+            cell_str = f"{d_str}\\newline{p_str}"
+            if cell["shade"] is not None:
+                cell_str = "\cellcolor{%s}%s" % (cell["shade"], cell_str)
+            row_str += f" & {cell_str}"
+        row_str += "\\\\\hline" if row["network"] else "\\\\"
+        f.write(("\n" if i else "") + row_str)
+    f.write("\\hlineB{3}\n" + tab + "\end{tabular}")
 
-    # Finish up header strings.
-    tabular_header += "V{3}} \\hlineB{3}"
-    row_super += "\\\\"
-    row_header += " \\\\\hline"
-    row_str = f"\n".join(row_strs) + "\\hlineB{3}"
-    tab_str = "\n".join([
-        tabular_header, row_super, row_header, row_str, tab + "\end{tabular}"
-    ])
-    return tab_str
+# A standalone LaTeX document that can be compiled on its own.
+def write_latex(f, columns, rows, **options):
+    f.write(LATEX_PREAMBLE)
+    write_latex_tabular(f, columns, rows, **options)
+    f.write(LATEX_END)
 
-def make_table(table, **kwargs):
+# A standalone HTML page, with the cells shaded as in the LaTeX tables.
+def write_html(f, columns, rows, title="", **options):
+    f.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n')
+    f.write(f"<title>{html.escape(title)}</title>\n</head>\n<body>\n<table>\n<thead>\n")
+    f.write('<tr><th rowspan="2">fROI</th>' + "".join(
+        f'<th colspan="{len(labels)}">{html.escape(expt)}</th>' for expt, labels in columns
+    ) + "</tr>\n")
+    f.write("<tr>" + "".join(
+        f"<th>{html.escape(plain_label(label))}</th>" for _, labels in columns for label in labels
+    ) + "</tr>\n</thead>\n<tbody>\n")
+    for row in rows:
+        tag = ("<b>", "</b>") if row["network"] else ("", "")
+        line = f"<tr><th>{tag[0]}{html.escape(row['name'])}{tag[1]}</th>"
+        for cell in row["cells"]:
+            style = ' style="background-color: rgb(%d, %d, %d)"' % SHADES[cell["shade"]] if cell["shade"] else ""
+            text = f"{plain_d(cell['d'])}<br>{html.escape(plain_p(cell['p']))}"
+            line += f"<td{style}>{tag[0]}{text}{tag[1]}</td>"
+        f.write(line + "</tr>\n")
+    f.write("</tbody>\n</table>\n</body>\n</html>\n")
+
+# A Markdown (pipe) table. Markdown has no cell colours, so shaded cells are
+# tagged with the name of their colour.
+def write_markdown(f, columns, rows, **options):
+    labels = [f"{expt}: {plain_label(label)}" for expt, expt_labels in columns for label in expt_labels]
+    f.write("| fROI | " + " | ".join(labels) + " |\n")
+    f.write("|---|" + "---|" * len(labels) + "\n")
+    for row in rows:
+        bold = "**" if row["network"] else ""
+        line = f"| {bold}{row['name']}{bold} |"
+        for cell in row["cells"]:
+            shade = f" ({SHADE_NAMES[cell['shade']]})" if cell["shade"] else ""
+            line += f" {bold}{plain_d(cell['d'])}, {plain_p(cell['p'])}{bold}{shade} |"
+        f.write(line + "\n")
+
+# Long format: one line per cell, with full-precision values.
+def write_csv(f, columns, rows, **options):
+    labels = [(expt, plain_label(label)) for expt, expt_labels in columns for label in expt_labels]
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow(["fROI", "network_row", "expt", "contrast", "cohen_d", "p_value", "shade"])
+    for row in rows:
+        for (expt, label), cell in zip(labels, row["cells"]):
+            writer.writerow([row["name"], row["network"], expt, label, cell["d"], cell["p"],
+                             SHADE_NAMES.get(cell["shade"], "")])
+
+WRITERS = {"latex": write_latex, "html": write_html, "markdown": write_markdown, "csv": write_csv}
+EXTENSIONS = {"latex": "tex", "html": "html", "markdown": "md", "csv": "csv"}
+
+################################################################################
+# GENERAL TABLE FUNCTIONS
+################################################################################
+
+def tabular_str(df, df_network, table, network="lang", tab="    ", col_width="14mm",
+                df_tost=None, df_network_tost=None):
+    cells = pivot_cells(df, df_network, table, network, "contrast_ugly", df_tost, df_network_tost)
+    f = io.StringIO()
+    write_latex_tabular(f, table_columns(cells), table_rows(cells, table, network), tab, col_width)
+    return f.getvalue()
+
+# Slightly modified code for Table SI-4
+def tabular_str_si4(df, df_network, table, network="lang", tab="    ", col_width="14mm"):
+    cells = pivot_cells(df, df_network, table, network, "effect")
+    f = io.StringIO()
+    columns = table_columns(cells, header=lambda k: pretty_effect_name(cells["keys"][k]))
+    write_latex_tabular(f, columns, table_rows(cells, table, network), tab, col_width)
+    return f.getvalue()
+
+# Streams one table to `f` in the given format.
+def write_table(f, table, fmt="latex", network="lang", tab="    "):
     # Get data corresponding to source for question of interest.
-    df, df_network = dfs[table]["sepfROIs"], dfs[table]["network"]
-    # Get tabular string, and embed it within a standalone document.
-    fn = tabular_str if table != "table_si4" else tabular_str_si4
-    tabular = fn(df, df_network, table, col_width=col_widths[table], **kwargs)
-    doc = """\\documentclass[margin=0.1cm]{standalone}
-\\usepackage[utf8]{inputenc}
-\\usepackage{times}
-\\usepackage{newtxmath}
-\\usepackage[table]{xcolor}
-\\definecolor{g}{RGB}{197, 217, 191}
-\\definecolor{r}{RGB}{238, 196, 196}
-\\definecolor{b}{RGB}{196, 227, 238}
-\\usepackage{boldline} 
-\\usepackage{multirow}
-\\begin{document}
-\\scriptsize
-\\renewcommand{\\arraystretch}{1.5}
-%s
-\\end{document}""" % tabular
-    return doc
+    dfs = load_table(table, network)
+    df, df_network = dfs["sepfROIs"], dfs["network"]
+    if table != "table_si4":
+        cells = pivot_cells(df, df_network, table, network, "contrast_ugly", dfs["sepfROIs_tost"], dfs["network_tost"])
+        columns = table_columns(cells)
+    else:
+        cells = pivot_cells(df, df_network, table, network, "effect")
+        columns = table_columns(cells, header=lambda k: pretty_effect_name(cells["keys"][k]))
+    WRITERS[fmt](f, columns, table_rows(cells, table, network), tab=tab, col_width=col_widths[table], title=table)
+
+# The standalone LaTeX document of a table, as a string.
+def make_table(table, **kwargs):
+    f = io.StringIO()
+    write_table(f, table, "latex", **kwargs)
+    return f.getvalue()
 
 ################################################################################
 # MAKE TABLES
 ################################################################################
 
+# SHA-256 over the contents of a table's input files and of this script, so
+# that a table is rebuilt when either its results or the formatting change.
+def table_digest(table):
+    h = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    for name, path in table_inputs(table).items():
+        h.update(name.encode())
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def read_build_state(path=BUILD_STATE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_build_state(state, path=BUILD_STATE_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+# Writes tables/{table}.tex (or the table in another format), unless its
+# inputs are unchanged since the last build and the file is still there. Only
+# this table's results are read, and the table is streamed to the file.
+# Returns whether the table was (re)built.
+def build_table(table, out_dir=TABLES_DIR, fmt="latex", force=False, state_path=BUILD_STATE_PATH, **kwargs):
+    out = os.path.join(out_dir, f"{table}.{EXTENSIONS[fmt]}")
+    state = read_build_state(state_path)
+    digest = table_digest(table)
+    if not force and state.get(os.path.basename(out)) == digest and os.path.exists(out):
+        return False
+    with open(out, "w", newline="") as f:
+        write_table(f, table, fmt, **kwargs)
+    state[os.path.basename(out)] = digest
+    write_build_state(state, state_path)
+    return True
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the LaTeX tables from the results CSVs.")
+    parser.add_argument("tables", nargs="*", default=list(PREDICTIONS), help="tables to build (default: all)")
+    parser.add_argument("--out-dir", default=TABLES_DIR)
+    parser.add_argument("--formats", nargs="+", choices=list(WRITERS), default=["latex"])
+    parser.add_argument("--force", action="store_true", help="rebuild even if the inputs have not changed")
+    args = parser.parse_args()
     # Generate tables for lang network analyses.
-    for table_name in PREDICTIONS.keys():
-        print(f"Making {table_name}")
-        table_tex = make_table(table_name, network="lang")
-        with open(f"tables/{table_name}.tex", "w") as f:
-            f.write(table_tex)
\ No newline at end of file
+    for table_name in args.tables:
+        if table_name not in PREDICTIONS:
+            parser.error(f"unknown table {table_name!r} (choose from {', '.join(PREDICTIONS)})")
+        for fmt in args.formats:
+            name = f"{table_name}.{EXTENSIONS[fmt]}"
+            if build_table(table_name, out_dir=args.out_dir, fmt=fmt, force=args.force, network="lang"):
+                print(f"Made {name}")
+            else:
+                print(f"{name} is up to date")
@@ -0,0 +1,96 @@
+import numpy as np
+
+from indiv_tensor import factorize
+
+################################################################################
+# MULTI-KEY INDEX OVER THE INDIVIDUAL DATA
+################################################################################
+
+# Columns that selections are made on. Rows are grouped by the combination of
+# all of them, so any selection is a union of whole groups.
+KEY_COLUMNS = ["Network", "Hemisphere", "ROI", "Effect", "Expt", "CriticalTask"]
+
+class IndexedData:
+    """
+    Groups the row offsets of `data` by (Network, Hemisphere, ROI, Effect, Expt,
+    CriticalTask) once. `postings[col][label]` lists the groups that have
+    `label` in column `col`, so a selection is an intersection of (unions of)
+    these group lists followed by a lookup of the groups' row offsets.
+    """
+    def __init__(self, data, keys=KEY_COLUMNS):
+        self.data = data
+        self.keys = keys
+        codes, labels = zip(*[factorize(data[col]) for col in keys])
+        shape = tuple(len(l) for l in labels)
+        group_key = np.ravel_multi_index(codes, shape)
+        # Rows sorted by group; group g owns order[starts[g]:starts[g+1]].
+        self.order = np.argsort(group_key, kind="stable")
+        unique_keys, starts = np.unique(group_key[self.order], return_index=True)
+        self.starts = np.append(starts, len(self.order))
+        group_codes = np.unravel_index(unique_keys, shape)
+        self.postings = {}
+        for col, col_labels, gc in zip(keys, labels, group_codes):
+            by_code = np.argsort(gc, kind="stable")
+            bounds = np.searchsorted(gc[by_code], np.arange(len(col_labels) + 1))
+            self.postings[col] = {
+                label: by_code[bounds[i]:bounds[i+1]] for i, label in enumerate(col_labels)
+            }
+
+    # Reuses the index of the last DataFrame it was asked for, so that callers
+    # which pass the same DataFrame around (e.g. prep_data) only build it once.
+    _last = None
+    @classmethod
+    def of(cls, data):
+        if cls._last is None or cls._last.data is not data:
+            cls._last = cls(data)
+        return cls._last
+
+    # Returns the ids of the groups matching every selection, where each
+    # selection maps a key column to a list of accepted values.
+    def groups(self, **selections):
+        result = None
+        for col, targets in selections.items():
+            if not isinstance(targets, list):
+                raise TypeError("targets must be a list")
+            postings = self.postings[col]
+            matched = [postings[t] for t in targets if t in postings]
+            matched = np.unique(np.concatenate(matched)) if matched else np.array([], dtype=np.intp)
+            result = matched if result is None else np.intersect1d(result, matched, assume_unique=True)
+        if result is None:
+            result = np.arange(len(self.starts) - 1)
+        return result
+
+    # Row offsets (in original row order) of the given groups.
+    def rows(self, groups):
+        if len(groups) == 0:
+            return np.array([], dtype=np.intp)
+        rows = np.concatenate([self.order[self.starts[g]:self.starts[g+1]] for g in groups])
+        return np.sort(rows)
+
+    def select(self, **selections):
+        return self.data.iloc[self.rows(self.groups(**selections))]
+
+    # For each experiment of select(**selections), takes the rows of its
+    # critical task (restricted to that Expt unless it is the consolidated
+    # experiment) and renames the Expt. experiment_names, new_exp_names and
+    # critical_tasks are parallel lists. All pieces are gathered as offsets
+    # first and copied out in one step.
+    def relabel_experiments(self, selections, consolidated_expt, experiment_names, new_exp_names, critical_tasks):
+        if not len(experiment_names) == len(new_exp_names) == len(critical_tasks):
+            raise ValueError(
+                f"experiment_names, new_exp_names and critical_tasks must have the same length "
+                f"(got {len(experiment_names)}, {len(new_exp_names)} and {len(critical_tasks)})"
+            )
+        selected = self.groups(**selections)
+        pieces = []
+        for exp, critical_task in zip(experiment_names, critical_tasks):
+            groups = np.intersect1d(selected, self.groups(CriticalTask=[critical_task]), assume_unique=True)
+            if consolidated_expt is not None and exp != consolidated_expt:
+                groups = np.intersect1d(groups, self.groups(Expt=[exp]), assume_unique=True)
+            pieces.append(self.rows(groups))
+        rows = np.concatenate(pieces) if pieces else np.array([], dtype=np.intp)
+        relabeled = self.data.iloc[rows].copy()
+        relabeled["Expt"] = np.repeat(
+            np.asarray(new_exp_names, dtype=object), [len(p) for p in pieces]
+        )
+        return relabeled
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+INDIV_DATA_PATH = os.path.join(DATA_DIR, "fMRI_all_indiv_production_data.csv")
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+
+# Columns of the individual-level data, in file order.
+INDIV_COLUMNS = [
+    "ROI", "Subject", "Effect", "LocalizerSize", "EffectSize", "Expt", "Network",
+    "Localizer_contrast", "CriticalTask", "ROI_name", "Speak_and_type", "Hemisphere"
+]
+
+# Columns that are returned as dictionary-encoded pandas categoricals. Every
+# other string column is also stored as codes on disk (so that it can be
+# memory-mapped), but is decoded back to plain strings on load.
+CATEGORICAL_COLUMNS = [
+    "ROI", "Effect", "Expt", "Network", "CriticalTask", "Hemisphere", "Subject"
+]
+CACHE_VERSION = 1
+
+################################################################################
+# HASHING
+################################################################################
+
+# Streams the file through sha256 so that large CSVs are never held in memory.
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_stat(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+################################################################################
+# COLUMNAR CACHE
+################################################################################
+
+def cache_path(path, cache_dir=None):
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, stem)
+
+def read_meta(cache):
+    try:
+        with open(os.path.join(cache, "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_meta(cache, meta):
+    tmp = os.path.join(cache, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(cache, "meta.json"))
+
+# Smallest integer type that can hold codes into a dictionary of size n.
+def code_dtype(n):
+    return np.int16 if n <= np.iinfo(np.int16).max else np.int32
+
+# Writes one .npy file per column into `cache`. String columns (and the
+# categorical columns) are stored as integer codes, with their dictionary kept
+# in the metadata.
+def write_columns(df, cache, source_hash, source_stat):
+    tmp = cache + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        if col in CATEGORICAL_COLUMNS or not pd.api.types.is_numeric_dtype(values):
+            cat = pd.Categorical(values)
+            codes = cat.codes.astype(code_dtype(len(cat.categories)))
+            np.save(os.path.join(tmp, f"{col}.npy"), codes)
+            categories = cat.categories.tolist()
+            columns.append({
+                "name": col, "kind": "codes", "categories": categories,
+                "categorical": col in CATEGORICAL_COLUMNS
+            })
+        else:
+            np.save(os.path.join(tmp, f"{col}.npy"), values.to_numpy())
+            columns.append({"name": col, "kind": "values"})
+    write_meta(tmp, {
+        "version": CACHE_VERSION, "sha256": source_hash, "stat": source_stat,
+        "n_rows": len(df), "columns": columns
+    })
+    shutil.rmtree(cache, ignore_errors=True)
+    os.replace(tmp, cache)
+
+# Reads the cached columns back into a DataFrame. Numeric columns (and the
+# codes behind categoricals) are memory-mapped, so nothing is parsed.
+def read_columns(cache, columns=None, mmap_mode="r"):
+    meta = read_meta(cache)
+    data = {}
+    for spec in meta["columns"]:
+        col = spec["name"]
+        if columns is not None and col not in columns:
+            continue
+        arr = np.load(os.path.join(cache, f"{col}.npy"), mmap_mode=mmap_mode)
+        if spec["kind"] == "values":
+            data[col] = arr
+        elif spec["categorical"]:
+            data[col] = pd.Categorical.from_codes(arr, categories=spec["categories"])
+        else:
+            data[col] = np.asarray(spec["categories"], dtype=object)[arr]
+    return pd.DataFrame(data)
+
+# Returns True if the cache at `cache` was built from the current contents of
+# `path`. A matching size/mtime is trusted as-is; otherwise the file is rehashed
+# and, if only the timestamp changed, the stored stat is refreshed.
+def cache_is_valid(path, cache):
+    meta = read_meta(cache)
+    if meta is None or meta.get("version") != CACHE_VERSION:
+        return False
+    stat = file_stat(path)
+    if meta.get("stat") == stat:
+        return True
+    if meta.get("sha256") != file_hash(path):
+        return False
+    meta["stat"] = stat
+    write_meta(cache, meta)
+    return True
+
+def build_cache(path=INDIV_DATA_PATH, cache_dir=None):
+    cache = cache_path(path, cache_dir)
+    stat = file_stat(path)
+    df = pd.read_csv(path)
+    write_columns(df, cache, file_hash(path), stat)
+    return cache
+
+################################################################################
+# LOADING
+################################################################################
+
+# Drop-in replacement for pd.read_csv on the individual-level data. The CSV is
+# only parsed when the cache is missing or the file contents have changed.
+def load_indiv_data(path=INDIV_DATA_PATH, cache_dir=None, columns=None):
+    cache = cache_path(path, cache_dir)
+    if not cache_is_valid(path, cache):
+        build_cache(path, cache_dir)
+    return read_columns(cache, columns=columns)
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else INDIV_DATA_PATH
+    print(f"Building cache for {path}")
+    print(build_cache(path))
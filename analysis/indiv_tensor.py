@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+
+################################################################################
+# DENSE TENSOR VIEW OF THE INDIVIDUAL DATA
+################################################################################
+
+# Axes of the tensor, in order. "task" is the (Expt, CriticalTask) pair, since
+# the same experiment contains several tasks (e.g. E1 langloc, E1 ProdLoc_spoken).
+AXES = ["task", "Subject", "Network", "ROI", "Effect"]
+
+# Returns integer codes and the sorted labels they index into. Categorical
+# columns (as returned by indiv_data.load_indiv_data) are reused without
+# re-hashing the strings.
+def factorize(col):
+    cat = col.array if isinstance(col.dtype, pd.CategoricalDtype) else pd.Categorical(col)
+    cat = cat.remove_unused_categories()
+    return np.asarray(cat.codes, dtype=np.intp), cat.categories.tolist()
+
+# Mean and standard error of the mean over `axis`, ignoring missing cells.
+def nanmean_sem(values, axis=None):
+    n = np.sum(~np.isnan(values), axis=axis)
+    mean = np.nanmean(values, axis=axis)
+    sem = np.nanstd(values, axis=axis, ddof=1) / np.sqrt(n)
+    return mean, sem
+
+# Bootstrap means of every column of `values`, an array of shape (units, ...,
+# columns), as an (n_boot x columns) array. Units (e.g. subjects) are
+# resampled with replacement along the first axis; all the middle axes (e.g.
+# fROIs) are pooled, ignoring missing cells. All columns share one resample
+# matrix, and each bootstrap mean is a ratio of two matrix products (resample
+# counts x per-unit sums and counts), so every column is reduced at once.
+# Resamples are drawn `chunk_size` at a time to bound memory.
+def bootstrap_means(values, n_boot=1000, seed=0, chunk_size=None):
+    values = values.reshape(values.shape[0], -1, values.shape[-1])
+    present = ~np.isnan(values)
+    sums = np.where(present, values, 0).sum(axis=1)
+    counts = present.sum(axis=1)
+    # Units without any data would only dilute the resamples.
+    keep = counts.sum(axis=1) > 0
+    sums, counts = sums[keep], counts[keep]
+    n_units = len(sums)
+
+    rng = np.random.default_rng(seed)
+    chunk_size = n_boot if chunk_size is None else chunk_size
+    boot_means = np.empty((n_boot, sums.shape[1]))
+    for start in range(0, n_boot, chunk_size):
+        size = min(chunk_size, n_boot - start)
+        draws = rng.integers(n_units, size=(size, n_units))
+        weights = np.zeros((size, n_units))
+        np.add.at(weights, (np.arange(size)[:, None], draws), 1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            boot_means[start:start+size] = (weights @ sums) / (weights @ counts)
+    return boot_means
+
+# Percentile bootstrap confidence interval of the mean of every column of
+# `values`, resampling units as in `bootstrap_means`.
+def bootstrap_ci(values, n_boot=1000, ci=95, seed=0, chunk_size=None):
+    boot_means = bootstrap_means(values, n_boot=n_boot, seed=seed, chunk_size=chunk_size)
+    alpha = (100 - ci) / 2
+    lower, upper = np.nanpercentile(boot_means, [alpha, 100 - alpha], axis=0)
+    return lower, upper
+
+class FROITensor:
+    """
+    NumPy array of `EffectSize` indexed by (task, Subject, Network, ROI, Effect),
+    with NaN in every cell that has no row in the long-format data. `axes` maps
+    each axis name to its labels, and `index` maps labels back to positions.
+    """
+    def __init__(self, values, axes):
+        self.values = values
+        self.axes = axes
+        self.index = {
+            name: {label: i for i, label in enumerate(labels)}
+            for name, labels in axes.items()
+        }
+
+    @classmethod
+    def from_frame(cls, data, value="EffectSize"):
+        expt, expt_labels = factorize(data["Expt"])
+        crit, crit_labels = factorize(data["CriticalTask"])
+        task_keys, task = np.unique(expt * len(crit_labels) + crit, return_inverse=True)
+        axes = {"task": [
+            (expt_labels[k // len(crit_labels)], crit_labels[k % len(crit_labels)])
+            for k in task_keys
+        ]}
+        codes = [task.ravel()]
+        for name in AXES[1:]:
+            c, labels = factorize(data[name])
+            codes.append(c)
+            axes[name] = labels
+        shape = tuple(len(labels) for labels in axes.values())
+        flat = np.ravel_multi_index(codes, shape)
+        if len(np.unique(flat)) != len(flat):
+            raise ValueError("data has more than one row per (task, Subject, Network, ROI, Effect) cell")
+        values = np.full(shape, np.nan)
+        np.put(values, flat, data[value].to_numpy(dtype=float))
+        return cls(values, axes)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    # Positions of `labels` along `axis`. A single label gives a single position.
+    def indices(self, axis, labels):
+        if isinstance(labels, list):
+            return [self.index[axis][label] for label in labels]
+        return self.index[axis][labels]
+
+    # Positions along the task axis whose Expt and/or CriticalTask match.
+    def task_indices(self, expt=None, critical_task=None):
+        return [
+            i for i, (e, c) in enumerate(self.axes["task"])
+            if (expt is None or e == expt) and (critical_task is None or c == critical_task)
+        ]
+
+    # Returns a new tensor restricted to the given labels, keeping every axis.
+    # Example: tensor.subset(Network=["lang"], Effect=["SProd", "WProd"])
+    def subset(self, **selections):
+        values = self.values
+        axes = dict(self.axes)
+        for name, labels in selections.items():
+            labels = list(labels)
+            idx = [self.index[name][label] for label in labels]
+            values = np.take(values, idx, axis=AXES.index(name))
+            axes[name] = labels
+        return FROITensor(values, axes)
+
+    # Paired difference cond1 - cond2 for every (task, Subject, Network, ROI)
+    # cell, as a single subtraction over the Effect axis.
+    def contrast(self, cond1, cond2):
+        return self.values[..., self.index["Effect"][cond1]] - self.values[..., self.index["Effect"][cond2]]
+
+    # Converts an array over the leading axes of the tensor (e.g. the output of
+    # `contrast`) back into long format, dropping missing cells.
+    def to_frame(self, values=None, name="EffectSize"):
+        values = self.values if values is None else values
+        names = AXES[:values.ndim]
+        present = np.nonzero(~np.isnan(values))
+        frame = {}
+        for axis, idx in zip(names, present):
+            labels = self.axes[axis]
+            if axis == "task":
+                frame["Expt"] = [labels[i][0] for i in idx]
+                frame["CriticalTask"] = [labels[i][1] for i in idx]
+            else:
+                frame[axis] = np.asarray(labels, dtype=object)[idx]
+        frame[name] = values[present]
+        return pd.DataFrame(frame)
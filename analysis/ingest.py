@@ -0,0 +1,213 @@
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from indiv_data import CACHE_DIR, DATA_DIR, INDIV_COLUMNS, INDIV_DATA_PATH, file_stat, load_indiv_data
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+SUMMARY_PATH = os.path.join(DATA_DIR, "fMRI_all_production_data_summaryMeanEffectSize.csv")
+STATE_PATH = os.path.join(CACHE_DIR, "summary_state.json")
+
+# One summary row per combination of these columns (the descriptive columns
+# Localizer_contrast, ROI_name and Hemisphere are constant within a group).
+GROUP_COLUMNS = [
+    "ROI", "Effect", "Expt", "Network", "Localizer_contrast", "CriticalTask",
+    "ROI_name", "Speak_and_type", "Hemisphere"
+]
+SUMMARY_COLUMNS = [
+    "ROI", "Effect", "MeanEffect", "StdEffect", "StderrEffect", "Expt", "Network",
+    "Localizer_contrast", "CriticalTask", "ROI_name", "Speak_and_type", "Hemisphere"
+]
+# Decimal places used in the summary CSV.
+SUMMARY_DECIMALS = 6
+
+################################################################################
+# RUNNING STATISTICS
+################################################################################
+
+# Welford-style running sums (count, mean, sum of squared deviations) for every
+# group in `data`, in order of first appearance.
+def group_moments(data):
+    grouped = data.groupby(GROUP_COLUMNS, sort=False, observed=True)["EffectSize"]
+    moments = grouped.agg(n="count", mean="mean")
+    moments["M2"] = grouped.var(ddof=0) * moments["n"]
+    moments = moments.reset_index()
+    for col in moments.select_dtypes("category").columns:
+        moments[col] = moments[col].astype(moments[col].cat.categories.dtype)
+    return moments
+
+# Merges the moments of a batch of new rows into the running moments, using
+# the pairwise update of Chan et al.; only the groups touched by the batch are
+# recomputed. Groups seen for the first time are appended at the end.
+def merge_moments(state, batch):
+    merged = state.merge(batch, on=GROUP_COLUMNS, how="outer", suffixes=("", "_new"), sort=False)
+    for col in ["n", "mean", "M2"]:
+        merged[col] = merged[col].fillna(0).astype(float)
+        merged[f"{col}_new"] = merged[f"{col}_new"].fillna(0).astype(float)
+    n = merged["n"] + merged["n_new"]
+    delta = merged["mean_new"] - merged["mean"]
+    merged["M2"] = merged["M2"] + merged["M2_new"] + delta**2 * merged["n"] * merged["n_new"] / n
+    merged["mean"] = merged["mean"] + delta * merged["n_new"] / n
+    merged["n"] = n.astype(int)
+    return merged[GROUP_COLUMNS + ["n", "mean", "M2"]]
+
+# Turns running moments into the layout of the summary CSV.
+def summary_from_moments(moments):
+    summary = moments[GROUP_COLUMNS].copy()
+    summary["MeanEffect"] = moments["mean"]
+    summary["StdEffect"] = np.sqrt(moments["M2"] / (moments["n"] - 1))
+    summary["StderrEffect"] = summary["StdEffect"] / np.sqrt(moments["n"])
+    return summary[SUMMARY_COLUMNS]
+
+# Full (non-incremental) recomputation of the summary table.
+def summarize(data):
+    return summary_from_moments(group_moments(data))
+
+################################################################################
+# STATE
+################################################################################
+
+# The state holds the running moments, the subjects already ingested and the
+# size/mtime of the individual CSV they describe. If the CSV was changed by
+# anything other than `ingest`, the state is rebuilt from scratch.
+def read_state(path=INDIV_DATA_PATH, state_path=STATE_PATH):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("stat") != file_stat(path):
+        return None
+    moments = pd.DataFrame(state["moments"], columns=GROUP_COLUMNS + ["n", "mean", "M2"])
+    return moments, set(state["subjects"])
+
+def write_state(moments, subjects, path=INDIV_DATA_PATH, state_path=STATE_PATH):
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    state = {
+        "stat": file_stat(path),
+        "subjects": sorted(subjects),
+        "moments": moments.astype(object).values.tolist()
+    }
+    tmp = state_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path)
+
+def build_state(path=INDIV_DATA_PATH, state_path=STATE_PATH):
+    data = load_indiv_data(path)
+    moments = group_moments(data)
+    subjects = set(data["Subject"].unique())
+    write_state(moments, subjects, path, state_path)
+    return moments, subjects
+
+# A summary value as the summary CSV writes it: rounded to SUMMARY_DECIMALS,
+# with the fewest digits that read back the same, in scientific notation when
+# that is shorter (7.36e-4 rather than 0.000736).
+def format_value(x):
+    if np.isnan(x):
+        return x
+    x = round(x, SUMMARY_DECIMALS)
+    fixed = np.format_float_positional(x, unique=True, trim="-")
+    scientific = np.format_float_scientific(x, unique=True, trim="-", exp_digits=1)
+    return scientific if len(scientific) < len(fixed) else fixed
+
+# A frame as the text to_csv writes for each of its cells.
+def csv_text(df):
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    buffer.seek(0)
+    return pd.read_csv(buffer, dtype=str, keep_default_na=False)
+
+# Writes the summary CSV with one row per group of `moments`. If the file
+# already exists, the rows of groups in `touched` (a frame with GROUP_COLUMNS;
+# default: every group) are rewritten in place, and every other row keeps its
+# position and text, so a no-op ingest leaves the file byte for byte as it
+# was. Rows of groups that `moments` does not have (e.g. the E3 production
+# rows that predate the ProdLoc_typing -> ProdLoc_typed relabeling of the
+# individual data) are dropped, and groups the file does not have are appended.
+def write_summary(moments, summary_path=SUMMARY_PATH, touched=None):
+    summary = summary_from_moments(moments)
+    for col in ["MeanEffect", "StdEffect", "StderrEffect"]:
+        summary[col] = summary[col].map(format_value)
+    summary = csv_text(summary)
+    if os.path.exists(summary_path):
+        existing = pd.read_csv(summary_path, dtype=str, keep_default_na=False)
+        touched = summary if touched is None else csv_text(touched[GROUP_COLUMNS])
+        keys = pd.MultiIndex.from_frame(summary[GROUP_COLUMNS])
+        existing_keys = pd.MultiIndex.from_frame(existing[GROUP_COLUMNS])
+        touched_keys = pd.MultiIndex.from_frame(touched[GROUP_COLUMNS])
+        position = keys.get_indexer(existing_keys)
+        replace = (position >= 0) & existing_keys.isin(touched_keys)
+        existing.loc[replace, SUMMARY_COLUMNS] = summary.iloc[position[replace]][SUMMARY_COLUMNS].to_numpy()
+        summary = pd.concat([existing[position >= 0], summary[~keys.isin(existing_keys)]], ignore_index=True)
+    summary[SUMMARY_COLUMNS].to_csv(summary_path, index=False)
+
+################################################################################
+# INGEST
+################################################################################
+
+# Appends the rows of one (or more) new subjects to the individual CSV and
+# updates the summary table from running sums, without touching existing rows.
+def ingest(new_data, path=INDIV_DATA_PATH, summary_path=SUMMARY_PATH, state_path=STATE_PATH):
+    missing = [c for c in INDIV_COLUMNS if c not in new_data.columns]
+    if missing:
+        raise ValueError(f"new data is missing columns: {missing}")
+    new_data = new_data[INDIV_COLUMNS]
+    state = read_state(path, state_path)
+    if state is None:
+        print("Summary state missing or out of date; rebuilding from the full dataset")
+        state = build_state(path, state_path)
+    moments, subjects = state
+    seen = sorted(set(new_data["Subject"]) & subjects)
+    if seen:
+        raise ValueError(f"subjects already ingested: {seen}")
+
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    new_data.to_csv(path, mode="a", header=False, index=False)
+
+    batch = group_moments(new_data)
+    moments = merge_moments(moments, batch)
+    subjects |= set(new_data["Subject"])
+    write_state(moments, subjects, path, state_path)
+    write_summary(moments, summary_path, touched=batch[GROUP_COLUMNS])
+    return moments
+
+# Checks that the summary CSV has exactly one row per group of the full
+# recomputation, with values that agree to the precision it is written with.
+def check_summary(path=INDIV_DATA_PATH, summary_path=SUMMARY_PATH):
+    full = summarize(load_indiv_data(path))
+    summary = pd.read_csv(summary_path)
+    assert not summary.duplicated(GROUP_COLUMNS).any(), "duplicate groups in the summary"
+    assert len(summary) == len(full), f"{len(summary)} summary rows for {len(full)} groups"
+    merged = full.merge(summary, on=GROUP_COLUMNS, suffixes=("", "_written"))
+    assert len(merged) == len(full), "summary groups differ from the full recomputation"
+    for col in ["MeanEffect", "StdEffect", "StderrEffect"]:
+        np.testing.assert_allclose(merged[f"{col}_written"], merged[col], rtol=0, atol=10.0 ** -SUMMARY_DECIMALS)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add new subjects to the individual-level data and update the summary table.")
+    parser.add_argument("new_data", nargs="+", help="CSV file(s) with the new subjects' rows (same columns as the individual data)")
+    parser.add_argument("--check", action="store_true", help="compare the updated summary against a full recomputation")
+    args = parser.parse_args()
+    for new_path in args.new_data:
+        print(f"Ingesting {new_path}")
+        moments = ingest(pd.read_csv(new_path))
+    if args.check:
+        full = summarize(load_indiv_data()).sort_values(GROUP_COLUMNS, ignore_index=True)
+        incremental = summary_from_moments(moments).sort_values(GROUP_COLUMNS, ignore_index=True)
+        assert (full[GROUP_COLUMNS].values == incremental[GROUP_COLUMNS].values).all()
+        for col in ["MeanEffect", "StdEffect", "StderrEffect"]:
+            np.testing.assert_allclose(incremental[col], full[col], rtol=1e-9, atol=1e-12)
+        check_summary()
+        print("Incremental summary matches full recomputation")
@@ -0,0 +1,182 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from battery import FORMULAS, expand_jobs
+from lmm import design, lmer
+from model_data import BATTERY, INTERACTION_EFFECTS, INTERACTIONS, build_sources
+from permutation import p_adjust_fdr
+
+################################################################################
+# CLOSED FORM (balanced single-fROI models)
+################################################################################
+
+# With one observation per subject and condition, EffectSize ~ Effect +
+# (1|Subject) has a closed-form REML fit: if the subject variance is positive
+# the test of Effect is the paired t-test (df = n - 1); if it is estimated at
+# zero, it is the pooled two-sample t-test (df = 2n - 2). Returns the paired
+# (positive-coded condition, other condition) matrices of the jobs that allow
+# this, as (tests x subjects) arrays with NaN for missing subjects.
+def closed_form_inputs(jobs, subjects):
+    pos, neg, eligible = [], [], []
+    for i, job in enumerate(jobs):
+        if job["formula"] != FORMULAS["separate_fROIs"]:
+            continue
+        data = job["data"]
+        _, X, _, _ = design(data, job["formula"])
+        if X.shape[1] != 2:
+            continue
+        positive = X[:, 1] > 0
+        a = data[positive].set_index("Subject")["EffectSize"]
+        b = data[~positive].set_index("Subject")["EffectSize"]
+        if not (a.index.is_unique and b.index.is_unique and set(a.index) == set(b.index)):
+            continue
+        pos.append(a.reindex(subjects).to_numpy(dtype=float))
+        neg.append(b.reindex(subjects).to_numpy(dtype=float))
+        eligible.append(i)
+    return np.array(pos).reshape(-1, len(subjects)), np.array(neg).reshape(-1, len(subjects)), eligible
+
+# t, df, p and d of the closed-form fit for every test (rows) and every
+# leave-one-subject-out fold (columns), plus the full-data fit as the last
+# column. Each fold only subtracts one subject's terms from the running sums.
+def closed_form_folds(pos, neg):
+    present = ~np.isnan(pos)
+    diff = np.where(present, pos - neg, 0.0)
+    mean = np.where(present, (pos + neg) / 2, 0.0)
+
+    def totals(x):
+        s, ss = x.sum(axis=1, keepdims=True), (x ** 2).sum(axis=1, keepdims=True)
+        # One column per left-out subject, then the full data.
+        return np.hstack([s - x, s]), np.hstack([ss - x ** 2, ss])
+
+    n = present.sum(axis=1, keepdims=True)
+    n = np.hstack([n - present, n]).astype(float)
+    s_d, ss_d = totals(diff)
+    s_m, ss_m = totals(mean)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_d = (ss_d - s_d ** 2 / n) / (n - 1)
+        var_m = (ss_m - s_m ** 2 / n) / (n - 1)
+        mean_d = s_d / n
+        # Subject variance is positive iff MS(subjects) > MS(error).
+        interior = 2 * var_m > var_d / 2 * (1 + 1e-8)
+        t_paired = mean_d / np.sqrt(var_d / n)
+        pooled = (var_d / 2 + 2 * var_m) / 2
+        t_pooled = mean_d / np.sqrt(pooled * 2 / n)
+    t = np.where(interior, t_paired, t_pooled)
+    df = np.where(interior, n - 1, 2 * n - 2)
+    return t, df, 2 * stats.t.sf(np.abs(t), df), 2 * t / np.sqrt(df)
+
+################################################################################
+# REFITS (network models and everything else)
+################################################################################
+
+# Model data of every job, set once per worker process by the pool
+# initializer so that jobs only carry indices.
+_DATA = None
+
+def _init_worker(data):
+    global _DATA
+    _DATA = data
+
+def refit_fold(i, formula, subject):
+    data = _DATA[i]
+    if subject is not None:
+        data = data[data.Subject != subject]
+    fit = lmer(formula, data)
+    return fit["p"], fit["d"]
+
+################################################################################
+# JACKKNIFE
+################################################################################
+
+# Refits every model of the given tables with each subject left out (closed
+# form where possible, otherwise in a process pool) and returns one row per
+# reported effect with the full-data p and d and their range across folds.
+def jackknife(tables=None, sources=None, workers=None):
+    tables = list(BATTERY) + list(INTERACTIONS) if tables is None else tables
+    sources = build_sources() if sources is None else sources
+    jobs = expand_jobs(tables, sources)
+    subjects = sorted(set().union(*[set(job["data"]["Subject"]) for job in jobs]))
+    n_coefs = [len(INTERACTION_EFFECTS) if job["table"] in INTERACTIONS else 1 for job in jobs]
+
+    # p and d per job, coefficient and fold (last fold = full data); NaN where
+    # the left-out subject is not in the model.
+    p = [np.full((k, len(subjects) + 1), np.nan) for k in n_coefs]
+    d = [np.full((k, len(subjects) + 1), np.nan) for k in n_coefs]
+    method = ["refit"] * len(jobs)
+
+    pos, neg, eligible = closed_form_inputs(jobs, subjects)
+    if eligible:
+        _, _, cf_p, cf_d = closed_form_folds(pos, neg)
+        in_model = np.hstack([~np.isnan(pos), np.ones((len(pos), 1), dtype=bool)])
+        for row, i in enumerate(eligible):
+            p[i][0] = np.where(in_model[row], cf_p[row], np.nan)
+            d[i][0] = np.where(in_model[row], cf_d[row], np.nan)
+            method[i] = "closed_form"
+
+    refits = []
+    for i, job in enumerate(jobs):
+        if method[i] == "refit":
+            present = set(job["data"]["Subject"])
+            refits += [(i, k) for k, s in enumerate(subjects) if s in present] + [(i, len(subjects))]
+    print(f"{len(jobs)} models: {len(eligible)} in closed form, {len(jobs) - len(eligible)} refitted ({len(refits)} fits)")
+    if refits:
+        data = [job["data"] for job in jobs]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as pool:
+            futures = [
+                pool.submit(refit_fold, i, jobs[i]["formula"], subjects[k] if k < len(subjects) else None)
+                for i, k in refits
+            ]
+            for (i, k), future in zip(refits, futures):
+                fit_p, fit_d = future.result()
+                coefs = range(1, n_coefs[i] + 1)
+                p[i][:, k] = [fit_p[c] for c in coefs]
+                d[i][:, k] = [fit_d[c] for c in coefs]
+
+    # FDR correction within each fold, across the fROIs of a contrast (and the
+    # effects of an interaction model), as in lmers.R.
+    p_fdr = [np.full_like(x, np.nan) for x in p]
+    families = {}
+    for i, job in enumerate(jobs):
+        if job["model_type"] == "separate_fROIs":
+            families.setdefault((job["table"], job["spec"], job["formula"]), []).append(i)
+    for members in families.values():
+        for k in range(len(subjects) + 1):
+            stacked = np.concatenate([p[i][:, k] for i in members])
+            ok = ~np.isnan(stacked)
+            adjusted = np.full_like(stacked, np.nan)
+            adjusted[ok] = p_adjust_fdr(stacked[ok])
+            offset = 0
+            for i in members:
+                p_fdr[i][:, k] = adjusted[offset:offset + n_coefs[i]]
+                offset += n_coefs[i]
+
+    rows = []
+    for i, job in enumerate(jobs):
+        effects = INTERACTION_EFFECTS if n_coefs[i] > 1 else [""]
+        for c, effect in enumerate(effects):
+            folds_p, folds_d = p[i][c, :-1], d[i][c, :-1]
+            valid = ~np.isnan(folds_p)
+            row = dict(
+                table=job["table"], model=job["model_type"], **job["desc"], effect=effect, method=method[i],
+                n_folds=int(valid.sum()), d=d[i][c, -1], d_min=np.nanmin(folds_d), d_max=np.nanmax(folds_d),
+                p_value=p[i][c, -1], p_min=np.nanmin(folds_p), p_max=np.nanmax(folds_p),
+                most_influential_subject=subjects[int(np.nanargmax(folds_p))],
+            )
+            if job["model_type"] == "separate_fROIs":
+                row.update(p_fdr=p_fdr[i][c, -1], p_fdr_min=np.nanmin(p_fdr[i][c, :-1]), p_fdr_max=np.nanmax(p_fdr[i][c, :-1]))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Leave-one-subject-out sensitivity of every model in the battery.")
+    parser.add_argument("tables", nargs="*", default=None, help="tables to run (default: all)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--out", default="results/jackknife.csv")
+    args = parser.parse_args()
+    result = jackknife(args.tables or None, workers=args.workers)
+    print(f"Writing {args.out}")
+    result.to_csv(args.out, index=False)
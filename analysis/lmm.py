@@ -0,0 +1,277 @@
+import numpy as np
+import pandas as pd
+from scipy import linalg, optimize, stats
+
+################################################################################
+# FORMULAS AND DESIGN MATRICES
+################################################################################
+
+# R's contr.poly(n): orthonormal polynomial contrasts (used for ordered factors).
+def contr_poly(n):
+    x = np.arange(1, n + 1, dtype=float)
+    Q, R = np.linalg.qr(np.vander(x - x.mean(), n, increasing=True))
+    raw = Q * np.diag(R)
+    return (raw / np.sqrt((raw ** 2).sum(axis=0)))[:, 1:]
+
+# R's contr.sum(n): sum-to-zero contrasts (used for unordered factors, since
+# lmers.R sets options(contrasts = c("contr.sum","contr.poly"))).
+def contr_sum(n):
+    return np.vstack([np.eye(n - 1), -np.ones(n - 1)])
+
+# Splits an lme4 formula with random intercepts only, e.g.
+# "EffectSize ~ Effect + (1|ROI) + (1|Subject)", into the response, the fixed
+# terms (with a*b expanded to a, b, a:b; the intercept is always included) and
+# the grouping factors.
+def parse_formula(formula):
+    response, rhs = [s.strip() for s in formula.split("~")]
+    fixed, random = [], []
+    for term in rhs.split("+"):
+        term = term.strip()
+        if term == "1":
+            continue
+        if term.startswith("("):
+            intercept, group = term.strip("()").split("|")
+            if intercept.strip() != "1":
+                raise ValueError(f"only random intercepts are supported, got {term}")
+            random.append(group.strip())
+        elif "*" in term:
+            factors = [f.strip() for f in term.split("*")]
+            fixed.extend(factors + [":".join(factors)])
+        else:
+            fixed.append(term)
+    fixed = list(dict.fromkeys(fixed))
+    return response, fixed, random
+
+# Columns (and their names) for one fixed term. Ordered categoricals get
+# contr.poly, other string columns contr.sum over their sorted levels, and
+# numeric columns (and their products, for a:b terms) are used as-is. Unused
+# levels are dropped, as lmer does.
+def _fixed_columns(data, term):
+    if ":" in term:
+        values = np.prod([data[f].to_numpy(dtype=float) for f in term.split(":")], axis=0)
+        return values[:, None], [term]
+    col = data[term]
+    if col.dtype == "category" and col.cat.ordered:
+        col = col.cat.remove_unused_categories()
+        codes, contrasts = col.cat.codes.to_numpy(), contr_poly(len(col.cat.categories))
+        names = [term + s for s in [".L", ".Q", ".C"] + [f"^{i}" for i in range(4, len(col.cat.categories))]]
+        return contrasts[codes], names[:contrasts.shape[1]]
+    if col.dtype == "category" or not pd.api.types.is_numeric_dtype(col):
+        levels, codes = np.unique(np.asarray(col, dtype=str), return_inverse=True)
+        contrasts = contr_sum(len(levels))
+        return contrasts[codes], [f"{term}{i}" for i in range(1, len(levels))]
+    return col.to_numpy(dtype=float)[:, None], [term]
+
+# Returns the response, fixed-effects design matrix (with intercept), the
+# names of its columns and, for every grouping factor, the integer codes of
+# the rows' groups.
+def design(data, formula):
+    response, fixed, random = parse_formula(formula)
+    columns, names = [np.ones((len(data), 1))], ["(Intercept)"]
+    for term in fixed:
+        cols, col_names = _fixed_columns(data, term)
+        columns.append(cols)
+        names.extend(col_names)
+    groups = [np.unique(np.asarray(data[g]).astype(str), return_inverse=True)[1] for g in random]
+    return data[response].to_numpy(dtype=float), np.hstack(columns), names, groups
+
+################################################################################
+# PENALIZED LEAST SQUARES (as in lme4)
+################################################################################
+
+# Everything the fit needs from the data, so that each evaluation of the
+# deviance only works with (q x q) and (q x p) matrices, where q is the total
+# number of random intercepts.
+def cross_products(y, X, groups):
+    Z = np.hstack([np.eye(codes.max() + 1)[codes] for codes in groups])
+    return {
+        "ZtZ": Z.T @ Z, "ZtX": Z.T @ X, "Zty": Z.T @ y,
+        "XtX": X.T @ X, "Xty": X.T @ y, "yty": y @ y,
+        "n": len(y), "p": X.shape[1], "sizes": [codes.max() + 1 for codes in groups]
+    }
+
+# Solves the penalized least squares problem for relative standard deviations
+# theta (random-effect sd / residual sd) and returns the fixed effects, the
+# penalized residual sum of squares, the two log-determinants of the REML
+# criterion and the Cholesky factor of the fixed-effects normal equations.
+def pls(theta, cp):
+    lam = np.repeat(theta, cp["sizes"])
+    A = lam[:, None] * cp["ZtZ"] * lam[None, :] + np.eye(len(lam))
+    L = linalg.cholesky(A, lower=True)
+    cu = linalg.solve_triangular(L, lam * cp["Zty"], lower=True)
+    RZX = linalg.solve_triangular(L, lam[:, None] * cp["ZtX"], lower=True)
+    RX = linalg.cholesky(cp["XtX"] - RZX.T @ RZX, lower=True)
+    cb = linalg.solve_triangular(RX, cp["Xty"] - RZX.T @ cu, lower=True)
+    beta = linalg.solve_triangular(RX.T, cb, lower=False)
+    r2 = cp["yty"] - cu @ cu - cb @ cb
+    ldL = 2 * np.sum(np.log(np.diag(L)))
+    ldRX = 2 * np.sum(np.log(np.diag(RX)))
+    return beta, r2, ldL, ldRX, RX
+
+# REML criterion profiled over the residual variance (what lmer minimizes).
+def reml_deviance(theta, cp):
+    n, p = cp["n"], cp["p"]
+    _, r2, ldL, ldRX, _ = pls(theta, cp)
+    return ldL + ldRX + (n - p) * (1 + np.log(2 * np.pi * r2 / (n - p)))
+
+# REML criterion as a function of the variance parameters
+# phi = (random-effect variances..., residual variance).
+def _deviance_phi(phi, cp):
+    n, p = cp["n"], cp["p"]
+    s2 = phi[-1]
+    _, r2, ldL, ldRX, _ = pls(np.sqrt(np.maximum(phi[:-1], 0) / s2), cp)
+    return (n - p) * np.log(s2) + ldL + ldRX + r2 / s2 + (n - p) * np.log(2 * np.pi)
+
+def _vcov_phi(phi, cp):
+    s2 = phi[-1]
+    RX = pls(np.sqrt(np.maximum(phi[:-1], 0) / s2), cp)[4]
+    RXi = linalg.solve_triangular(RX, np.eye(len(RX)), lower=True)
+    return s2 * RXi.T @ RXi
+
+################################################################################
+# NUMERICAL DERIVATIVES
+################################################################################
+
+def _steps(x, h):
+    return h * np.maximum(np.abs(x), 1e-3)
+
+def gradient(f, x, h=1e-4):
+    hs = _steps(x, h)
+    g = np.zeros(len(x))
+    for i in range(len(x)):
+        e = np.zeros(len(x))
+        e[i] = hs[i]
+        g[i] = (f(x + e) - f(x - e)) / (2 * hs[i])
+    return g
+
+def hessian(f, x, h=1e-4):
+    hs = _steps(x, h)
+    k = len(x)
+    H = np.zeros((k, k))
+    for i in range(k):
+        for j in range(i, k):
+            ei, ej = np.zeros(k), np.zeros(k)
+            ei[i], ej[j] = hs[i], hs[j]
+            H[i, j] = H[j, i] = (
+                f(x + ei + ej) - f(x + ei - ej) - f(x - ei + ej) + f(x - ei - ej)
+            ) / (4 * hs[i] * hs[j])
+    return H
+
+################################################################################
+# FITTING
+################################################################################
+
+# Relative standard deviations below this count as zero (as lme4's isSingular).
+SINGULAR_TOL = 1e-4
+# Values tried for random-effect parameters that the optimizer left at zero.
+BOUNDARY_PROBES = [0.01, 0.1, 0.5]
+BOUNDARY_RESTARTS = 3
+
+# Satterthwaite degrees of freedom for every fixed effect (as in lmerTest),
+# from the numerical Hessian of the REML criterion in the variance parameters.
+# Variance components estimated at the boundary (zero) are held fixed.
+def satterthwaite_df(phi, cp):
+    free = np.append(np.flatnonzero(phi[:-1] > 1e-8 * phi[-1]), len(phi) - 1)
+    def with_free(sub):
+        full = phi.copy()
+        full[free] = sub
+        return full
+    try:
+        A = 2 * np.linalg.inv(hessian(lambda sub: _deviance_phi(with_free(sub), cp), phi[free]))
+    except np.linalg.LinAlgError:
+        return np.full(cp["p"], np.nan)
+    df = np.zeros(cp["p"])
+    for k in range(cp["p"]):
+        var = lambda sub: _vcov_phi(with_free(sub), cp)[k, k]
+        g = gradient(var, phi[free])
+        df[k] = 2 * var(phi[free]) ** 2 / (g @ A @ g)
+    return df
+
+# Same criterion as lme4's check.conv.grad, for the parameters not on the
+# boundary: the gradient at the optimum scaled by the Cholesky factor of the
+# Hessian, solve(chol(H), g), taking per parameter the smaller of its scaled
+# and raw absolute values. The raw gradient alone overstates convergence
+# problems where the criterion is strongly curved. Returns the largest of
+# these, or NaN when the Hessian is not positive definite (lme4's "unable to
+# evaluate scaled gradient").
+def scaled_max_grad(f, theta, interior):
+    if not interior.any():
+        return 0.0
+    def with_interior(sub):
+        full = theta.copy()
+        full[interior] = sub
+        return full
+    grad = gradient(lambda sub: f(with_interior(sub)), theta[interior])
+    try:
+        upper = np.linalg.cholesky(hessian(lambda sub: f(with_interior(sub)), theta[interior])).T
+    except np.linalg.LinAlgError:
+        return float("nan")
+    scaled = linalg.solve_triangular(upper, grad, lower=False)
+    return float(np.max(np.minimum(np.abs(scaled), np.abs(grad))))
+
+# Fits a linear mixed model with random intercepts by REML, as lmer does, and
+# returns the fixed effects with lmerTest-style (Satterthwaite) tests and the
+# EMAtools lme.dscore effect size d = 2t / sqrt(df). `start` is the initial
+# theta (default: all ones, as in lme4); `optimizer` is any bounded
+# scipy.optimize.minimize method.
+def fit_lmm(y, X, groups, names=None, start=None, optimizer="L-BFGS-B", options=None):
+    cp = cross_products(y, X, groups)
+    n, p = cp["n"], cp["p"]
+    start = np.ones(len(groups)) if start is None else np.asarray(start, dtype=float)
+    minimize = lambda x0: optimize.minimize(
+        reml_deviance, x0, args=(cp,), method=optimizer,
+        bounds=[(0, None)] * len(groups), options=options
+    )
+    res = minimize(start)
+    n_evals = res.nfev
+    # The REML criterion is even in theta, so theta = 0 is always a stationary
+    # point and gradient-based optimizers can stop there. Restart from just off
+    # the boundary whenever that lowers the criterion.
+    for _ in range(BOUNDARY_RESTARTS):
+        theta = np.maximum(res.x, 0)
+        at_zero = theta <= SINGULAR_TOL
+        trials = [np.where(at_zero, value, theta) for value in BOUNDARY_PROBES]
+        better = [x for x in trials if reml_deviance(x, cp) < res.fun - 1e-10]
+        if not at_zero.any() or not better:
+            break
+        res = minimize(better[0])
+        n_evals += res.nfev
+    theta = np.maximum(res.x, 0)
+    beta, r2, _, _, RX = pls(theta, cp)
+    s2 = r2 / (n - p)
+    phi = np.append(theta ** 2 * s2, s2)
+    se = np.sqrt(np.diag(_vcov_phi(phi, cp)))
+    t = beta / se
+    df = satterthwaite_df(phi, cp)
+    interior = theta > SINGULAR_TOL
+    max_grad = scaled_max_grad(lambda th: reml_deviance(th, cp), theta, interior)
+    return {
+        "names": list(names) if names is not None else [f"b{i}" for i in range(p)],
+        "beta": beta, "se": se, "t": t, "df": df,
+        "p": 2 * stats.t.sf(np.abs(t), df),
+        "d": 2 * t / np.sqrt(df),
+        "theta": theta, "sigma": np.sqrt(s2), "deviance": reml_deviance(theta, cp),
+        "optimizer": optimizer, "converged": bool(res.success),
+        "max_grad": max_grad,
+        "singular": bool(np.any(~interior)), "n_evals": int(n_evals), "message": str(res.message),
+    }
+
+# Convenience wrapper: builds the design for an lme4 formula and fits it.
+def lmer(formula, data, **kwargs):
+    y, X, names, groups = design(data, formula)
+    return fit_lmm(y, X, groups, names=names, **kwargs)
+
+# Warning messages lme4 would print for this fit, concatenated as
+# lmers_convergence_tracking.R writes them (the singular-fit message is
+# truncated to its first 23 characters there).
+def convergence_messages(fit, grad_tol=2e-3):
+    messages = []
+    if fit["singular"]:
+        messages.append("boundary (singular) fit")
+    if not fit["converged"]:
+        messages.append(f"convergence code 1 from {fit['optimizer']}: {fit['message']}")
+    if np.isnan(fit["max_grad"]):
+        messages.append("unable to evaluate scaled gradient")
+    elif fit["max_grad"] > grad_tol:
+        messages.append(f"Model failed to converge with max|grad| = {fit['max_grad']:.6g} (tol = {grad_tol:g})")
+    return "".join(messages)
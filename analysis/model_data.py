@@ -0,0 +1,198 @@
+import pandas as pd
+
+from indiv_data import load_indiv_data
+
+################################################################################
+# DATA SOURCES (mirrors "LOAD AND CLEAN RAW DATA" in lmers.R)
+################################################################################
+
+# LH lang network fROIs: 1-6; no restrictions on MD for now
+FROIS = {"lang": list(range(1, 7)), "MD": list(range(1, 21))}
+FROI_STR = {"lang": "1-6", "MD": "1-20"}
+
+# Named subsets of the data, as in `dfs` in lmers.R:
+# name -> (network, Expt, CriticalTask, only subjects who did both spoken and typed tasks)
+SOURCES = {
+    "expt1_prod": ("lang", "E1", "ProdLoc_spoken", False),
+    "expt1_langloc": ("lang", "E1", "langloc", False),
+    # needed for within-subject comparison of spoken and typed production
+    "expt1_prod_speakANDtype": ("lang", "E1", "ProdLoc_spoken", True),
+    "expt2_prod": ("lang", "E2", "NameRead", False),
+    "expt2_langloc": ("lang", "E2", "langloc", False),
+    "expt3_prod": ("lang", "E3", "ProdLoc_typed", False),
+    # same subjects as those in Expt 1 who did both spoken and typed tasks
+    "expt3_langloc": ("lang", "E1", "langloc", True),
+    "expt1_MD_prod": ("MD", "E1", "ProdLoc_spoken", False),
+    "expt2_MD_prod": ("MD", "E2", "NameRead", False),
+    "expt3_MD_prod": ("MD", "E3", "ProdLoc_typed", False),
+    "expt1_MD_loc": ("MD", "E1", "spWM", False),
+    "expt2_MD_loc": ("MD", "E2", "spWM", False),
+    "expt3_MD_loc": ("MD", "E1", "spWM", True),
+}
+
+# Replace *Prod with *Prod_typed in typing experiment (3) for easy analysis.
+TYPED_SOURCES = ["expt3_prod"]
+TYPED_EFFECTS = {"SProd": "SProd_typed", "WProd": "WProd_typed", "NProd": "NProd_typed"}
+
+# Order of the Effect levels in lmers.R. With a two-level ordered factor, the
+# fitted coefficient is positive when the later level has the larger response.
+EFFECT_LEVELS = [
+    "fixation", "Easy WM", "Hard WM", "VisEvSem", "WComp", "SComp", "Nonwords",
+    "NProd_typed", "NProd", "WProd_typed", "WProd", "SProd_typed", "SProd", "Sentences"
+]
+
+# Returns the rows of one named source, optionally without the fixation rows.
+def select_source(data, name, fROIs=FROIS):
+    network, expt, critical_task, speak_and_type = SOURCES[name]
+    rows = data[
+        (data.Network == network) & data.ROI.isin(fROIs[network]) &
+        (data.Expt == expt) & (data.CriticalTask == critical_task)
+    ]
+    if speak_and_type:
+        rows = rows[rows.Speak_and_type == 1]
+    rows = rows.copy()
+    for col in rows.select_dtypes("category").columns:
+        rows[col] = rows[col].astype(rows[col].cat.categories.dtype)
+    if name in TYPED_SOURCES:
+        rows["Effect"] = rows["Effect"].replace(TYPED_EFFECTS)
+    return rows
+
+# Adds a fixation condition for every participant. The EffectSize is 0, since
+# the fixation baseline has already been subtracted out of all other conditions.
+def add_fixation(rows):
+    fixation = rows.copy()
+    fixation["Effect"] = "fixation"
+    fixation["EffectSize"] = 0.0
+    fixation = fixation.drop_duplicates()
+    return pd.concat([rows, fixation], ignore_index=True)
+
+# Equivalent of `dfs` in lmers.R: every named source, with fixation rows added.
+def build_sources(data=None, fROIs=FROIS):
+    data = load_indiv_data() if data is None else data
+    return {name: add_fixation(select_source(data, name, fROIs)) for name in SOURCES}
+
+# Looks up a source by name. Names joined with "+" (as used by the validation
+# analyses) are concatenated.
+def get_source(sources, name):
+    names = name.split("+")
+    if len(names) == 1:
+        return sources[name]
+    return pd.concat([sources[n] for n in names], ignore_index=True)
+
+################################################################################
+# CONTRAST BATTERY (mirrors the TABLE sections of lmers.R)
+################################################################################
+
+# `ordered` is False for the validation analyses, which lmers.R runs on the
+# data before Effect is made an ordered factor (so contr.sum is used instead
+# of contr.poly, and the sign of the effect is flipped).
+def _contrast(cond1, cond2, cond1_src, cond2_src=None, network="lang", ordered=True):
+    cond2_src = cond1_src if cond2_src is None else cond2_src
+    return dict(cond1=cond1, cond2=cond2, cond1_src=cond1_src, cond2_src=cond2_src, network=network, ordered=ordered)
+
+# Pairwise contrasts behind each results/{table}_*.csv, in the order lmers.R
+# writes them. Validation contrasts pool the localizer data of Expts 1 and 2
+# (Expt 3 subjects are already included in Expt 1).
+BATTERY = {
+    "validation_lang": [
+        _contrast("Sentences", "Nonwords", "expt1_langloc+expt2_langloc", ordered=False)
+    ],
+    "validation_md": [
+        _contrast("Hard WM", "Easy WM", "expt1_MD_loc+expt2_MD_loc", network="MD", ordered=False)
+    ],
+    "table1": [
+        _contrast("SProd", "fixation", "expt1_prod"),
+        _contrast("SProd", "Nonwords", "expt1_prod", "expt1_langloc"),
+        _contrast("SProd", "NProd", "expt1_prod"),
+        _contrast("SProd", "VisEvSem", "expt1_prod"),
+    ],
+    "table2": [
+        _contrast("SProd", "WProd", "expt1_prod"),
+        _contrast("SProd", "WProd", "expt2_prod"),
+        _contrast("SProd_typed", "WProd_typed", "expt3_prod"),
+        _contrast("WProd", "NProd", "expt1_prod"),
+        _contrast("WProd_typed", "NProd_typed", "expt3_prod"),
+    ],
+    "table_si2": [
+        _contrast("SProd", "fixation", "expt2_prod"),
+        _contrast("SProd_typed", "fixation", "expt3_prod"),
+        _contrast("SProd", "Nonwords", "expt2_prod", "expt2_langloc"),
+        _contrast("SProd_typed", "Nonwords", "expt3_prod", "expt3_langloc"),
+        _contrast("SProd_typed", "NProd_typed", "expt3_prod"),
+        _contrast("SProd_typed", "VisEvSem", "expt3_prod"),
+    ],
+    "table_si3": [
+        _contrast("SProd", "WProd", "expt2_prod"),
+        _contrast("SProd_typed", "WProd_typed", "expt3_prod"),
+        _contrast("WProd_typed", "NProd_typed", "expt3_prod"),
+    ],
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ OTHER ANALYSES (commented out in lmers.R)
+    "Q1": [
+        _contrast("SProd", "fixation", "expt1_prod"),
+        _contrast("SProd", "fixation", "expt2_prod"),
+        _contrast("SProd", "Nonwords", "expt1_prod", "expt1_langloc"),
+        _contrast("SProd", "Nonwords", "expt2_prod", "expt2_langloc"),
+        _contrast("SProd", "VisEvSem", "expt1_prod"),
+    ],
+    "Q2": [
+        _contrast("SProd_typed", "fixation", "expt3_prod"),
+        _contrast("SProd_typed", "Nonwords", "expt3_prod", "expt3_langloc"),
+        _contrast("SProd_typed", "VisEvSem", "expt3_prod"),
+        _contrast("SProd_typed", "SProd", "expt3_prod", "expt1_prod_speakANDtype"),
+    ],
+    "Q3": [
+        _contrast("WProd", "NProd", "expt1_prod"),
+        _contrast("WProd_typed", "NProd_typed", "expt3_prod"),
+        _contrast("SProd", "WProd", "expt1_prod"),
+        _contrast("SProd", "WProd", "expt2_prod"),
+        _contrast("SProd_typed", "WProd_typed", "expt3_prod"),
+        _contrast("SProd", "WProd", "expt1_MD_prod", network="MD"),
+        _contrast("SProd", "NProd", "expt1_MD_prod", network="MD"),
+        _contrast("SProd", "WProd", "expt2_MD_prod", network="MD"),
+        _contrast("SProd", "WProd", "expt3_MD_prod", network="MD"),
+        _contrast("SProd", "NProd", "expt3_MD_prod", network="MD"),
+    ],
+}
+
+# Task x stimulus models (TABLE SI-4 in lmers.R): production vs. comprehension
+# crossed with sentences vs. word lists.
+INTERACTIONS = {
+    "table_si4": [
+        dict(src="expt1_prod", conds=["SProd", "WProd", "SComp", "WComp"], network="lang")
+    ],
+}
+INTERACTION_EFFECTS = ["TaskType", "StimType", "TaskType:StimType"]
+
+def expt_data(contrast):
+    return "%s/%s" % (contrast["cond1_src"], contrast["cond2_src"])
+
+################################################################################
+# MODEL DATA
+################################################################################
+
+# Rows entering the model of one contrast (optionally one fROI only): cond1
+# rows from cond1_src stacked on cond2 rows from cond2_src, with Effect as an
+# ordered factor when the contrast is ordered.
+def contrast_data(sources, contrast, ROI=None):
+    cond1 = get_source(sources, contrast["cond1_src"])
+    cond2 = get_source(sources, contrast["cond2_src"])
+    rows = pd.concat([
+        cond1[cond1.Effect == contrast["cond1"]], cond2[cond2.Effect == contrast["cond2"]]
+    ], ignore_index=True)
+    if ROI is not None:
+        rows = rows[rows.ROI == ROI].reset_index(drop=True)
+    if contrast["ordered"]:
+        rows["Effect"] = pd.Categorical(rows["Effect"], categories=EFFECT_LEVELS, ordered=True)
+    return rows
+
+# Rows entering one task x stimulus model, with the TaskType (1 = production,
+# 0 = comprehension) and StimType (1 = sentences, 0 = words) indicators.
+def interaction_data(sources, spec, ROI=None):
+    rows = get_source(sources, spec["src"])
+    rows = rows[rows.Effect.isin(spec["conds"])]
+    if ROI is not None:
+        rows = rows[rows.ROI == ROI]
+    rows = rows.reset_index(drop=True)
+    rows["TaskType"] = rows.Effect.isin(["SProd", "WProd"]).astype(int)
+    rows["StimType"] = rows.Effect.isin(["SProd", "SComp"]).astype(int)
+    return rows
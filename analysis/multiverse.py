@@ -0,0 +1,183 @@
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from battery import FIT_CACHE_DIR, FORMULAS, collect_results, expand_jobs, fit_job, read_fit, write_fit
+from indiv_data import INDIV_DATA_PATH, load_indiv_data
+from model_data import FROIS, build_sources
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+MULTIVERSE_PATH = "results/multiverse.csv"
+STABILITY_PATH = "results/multiverse_stability.csv"
+
+TABLES = ["table1", "table2"]
+SIG_LEVEL = 0.05
+
+# Named fROI sets (fROIs in lmers.R). "paper" is the set used in the paper.
+FROI_SETS = {
+    "paper": FROIS,
+    "bilateral": {"lang": list(range(1, 13)), "MD": list(range(1, 21))},
+}
+# Random-effects structures of the network models; the separate fROI models
+# always have a random intercept per subject.
+RANDOM_EFFECTS = {
+    "ROI+Subject": FORMULAS,
+    "Subject": dict(FORMULAS, network="EffectSize ~ Effect + (1|Subject)"),
+}
+
+# Axes of the grid and the values they take by default. The first value of
+# every axis is the analysis reported in the paper.
+AXES = ["frois", "hemisphere", "speak_and_type", "random", "min_size"]
+DEFAULT_SPEC = {
+    "frois": ["paper", "bilateral"],
+    "hemisphere": ["both", "LH", "RH"],
+    # Only subjects who did both the spoken and the typed task.
+    "speak_and_type": [False, True],
+    "random": ["ROI+Subject", "Subject"],
+    # Minimum LocalizerSize of an fROI.
+    "min_size": [0, 50, 100],
+}
+
+################################################################################
+# GRID
+################################################################################
+
+# Every combination of the values of the axes of `spec`, as dicts.
+def expand_grid(spec=DEFAULT_SPEC):
+    return [dict(zip(AXES, values)) for values in itertools.product(*[spec[axis] for axis in AXES])]
+
+# Rows of the individual data that a grid point keeps.
+def point_data(data, point):
+    keep = np.ones(len(data), dtype=bool)
+    if point["hemisphere"] != "both":
+        keep &= np.asarray(data.Hemisphere == point["hemisphere"])
+    if point["speak_and_type"]:
+        keep &= np.asarray(data.Speak_and_type == 1)
+    if point["min_size"]:
+        keep &= np.asarray(data.LocalizerSize >= point["min_size"])
+    return data[keep]
+
+# Model jobs (as in battery.py) of one grid point.
+def point_jobs(data, point, tables=TABLES):
+    fROIs = FROI_SETS[point["frois"]]
+    sources = build_sources(point_data(data, point), fROIs)
+    return expand_jobs(tables, sources, fROIs=fROIs, formulas=RANDOM_EFFECTS[point["random"]])
+
+################################################################################
+# WORKERS
+################################################################################
+
+# Individual data, memory-mapped from the columnar cache once per worker
+# process by the pool initializer, so that all workers share its pages.
+_DATA = None
+
+def _init_worker(path):
+    global _DATA
+    _DATA = load_indiv_data(path)
+
+# Worker: rebuilds the jobs of one grid point from the shared data and fits
+# the ones at the given positions. Returns {key: fit}.
+def fit_point(point, positions, tables=TABLES):
+    jobs = point_jobs(_DATA, point, tables)
+    return {jobs[i]["key"]: fit_job(jobs[i]["formula"], jobs[i]["data"]) for i in positions}
+
+################################################################################
+# MULTIVERSE
+################################################################################
+
+# Runs the tables for every grid point. Data slices that are identical across
+# grid points (or already in the fit cache) are fitted once: every distinct
+# model is assigned to the first grid point that needs it, and each grid point
+# with new models becomes one task in the process pool. Returns the results of
+# every grid point in one long frame.
+def run_multiverse(points, tables=TABLES, path=INDIV_DATA_PATH, workers=None, cache_dir=FIT_CACHE_DIR):
+    data = load_indiv_data(path)
+    point_keys = []
+    fits, todo, assigned = {}, {}, set()
+    for p, point in enumerate(points):
+        jobs = point_jobs(data, point, tables)
+        # Only the keys are kept; workers rebuild the data slices themselves.
+        point_keys.append([{k: v for k, v in job.items() if k != "data"} for job in jobs])
+        for i, job in enumerate(jobs):
+            if job["key"] in fits or job["key"] in assigned:
+                continue
+            fit = read_fit(job["key"], cache_dir)
+            if fit is None:
+                todo.setdefault(p, {})[job["key"]] = i
+                assigned.add(job["key"])
+            else:
+                fits[job["key"]] = fit
+    n_jobs = sum(len(jobs) for jobs in point_keys)
+    n_todo = sum(len(keys) for keys in todo.values())
+    print(f"{len(points)} grid points, {n_jobs} models: {len(fits)} cached, {n_todo} distinct to fit")
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(path,)) as pool:
+            futures = [pool.submit(fit_point, points[p], list(keys.values()), tables) for p, keys in todo.items()]
+            for future in futures:
+                for key, fit in future.result().items():
+                    fits[key] = fit
+                    write_fit(key, fit, cache_dir)
+
+    frames = []
+    for p, (point, jobs) in enumerate(zip(points, point_keys)):
+        for name, df in collect_results(tables, jobs, fits).items():
+            if df.empty:
+                continue
+            table, model = name.rsplit("_", 1)
+            frames.append(df.assign(point=p, **point, table=table, model=model))
+    return pd.concat(frames, ignore_index=True)
+
+# Sign and significance stability of every table cell (contrast and fROI or
+# network) across grid points: the share of points where the effect is
+# positive, significant, and has the same sign and significance as the first
+# grid point (the paper's analysis, with the default spec). Network cells are
+# keyed by their network: their ROI column names the fROI set (e.g. "1-6" or
+# "1-12"), which differs between grid points.
+def stability(results, reference_point=0, sig_level=SIG_LEVEL):
+    cell = ["table", "model", "cond1", "cond2", "expt_data", "unit"]
+    unit = results.ROI.astype(str).where(results.model != "network", results.network)
+    # Network cells have p_value, fROI cells the FDR-corrected p-value.
+    p = results.p_value_fdr_corrected.fillna(results.p_value)
+    results = results.assign(unit=unit, positive=results.cohen_d > 0, significant=p < sig_level)
+    reference = results[results.point == reference_point].set_index(cell)[["positive", "significant"]]
+    results = results.join(reference, on=cell, rsuffix="_reference")
+    agrees = (
+        (results.significant == results.significant_reference) &
+        (~results.significant | (results.positive == results.positive_reference))
+    )
+    # fROIs outside the reference's fROI set have no reference and get NaN.
+    results["agrees"] = agrees.astype(float).where(results.significant_reference.notna())
+    summary = results.groupby(cell, sort=False).agg(
+        n_points=("point", "size"),
+        d_median=("cohen_d", "median"), d_min=("cohen_d", "min"), d_max=("cohen_d", "max"),
+        frac_positive=("positive", "mean"), frac_significant=("significant", "mean"),
+        frac_agree_with_reference=("agrees", "mean"),
+    )
+    return summary.reset_index()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multiverse of fROI-definition and model choices for the main tables.")
+    parser.add_argument("--spec", default=None, help="JSON file with the values of each axis (default: DEFAULT_SPEC)")
+    parser.add_argument("--tables", nargs="+", default=TABLES)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=FIT_CACHE_DIR, help="directory of cached fits")
+    parser.add_argument("--out", default=MULTIVERSE_PATH)
+    parser.add_argument("--stability-out", default=STABILITY_PATH)
+    args = parser.parse_args()
+    spec = DEFAULT_SPEC
+    if args.spec is not None:
+        with open(args.spec) as f:
+            spec = dict(DEFAULT_SPEC, **json.load(f))
+    results = run_multiverse(expand_grid(spec), args.tables, workers=args.workers, cache_dir=args.cache_dir)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    print(f"Writing {args.out}")
+    results.to_csv(args.out, index=False)
+    print(f"Writing {args.stability_out}")
+    stability(results).to_csv(args.stability_out, index=False)
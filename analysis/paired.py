@@ -0,0 +1,157 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from indiv_data import INDIV_DATA_PATH, load_indiv_data
+from model_data import FROI_STR, FROIS
+from permutation import _t_from_sums, p_adjust_fdr
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+PAIRED_PATH = "results/spoken_typed_{model}.csv"
+
+# (Expt, CriticalTask) of the production task in each modality. Participants of
+# Experiment 3 also did the spoken task of Experiment 1.
+MODALITIES = {"spoken": ("E1", "ProdLoc_spoken"), "typed": ("E3", "ProdLoc_typed")}
+# Source names (as in model_data.SOURCES) used for the expt_data column.
+EXPT_DATA = {"lang": "expt1_prod/expt3_prod", "MD": "expt1_MD_prod/expt3_MD_prod"}
+NETWORKS = ["lang", "MD"]
+CONDITIONS = ["SProd", "WProd", "NProd", "SComp", "WComp", "VisEvSem"]
+# cond1 - cond2 contrasts whose difference between modalities is tested.
+# The fixation baseline is 0 in both modalities, so contrasts against it test
+# the main effect of modality on a condition.
+CONTRASTS = [
+    ("SProd", "fixation"), ("WProd", "fixation"), ("NProd", "fixation"),
+    ("SProd", "WProd"), ("WProd", "NProd"), ("SProd", "NProd"), ("SProd", "VisEvSem"),
+]
+
+################################################################################
+# JOINING MODALITIES
+################################################################################
+
+# Participant IDs from Subject strings ("770_FED_20191120c_3T2_PL2017" -> "770"),
+# which are the same across the sessions of one participant.
+def subject_ids(subjects):
+    return pd.Series(subjects, dtype=object).astype(str).str.split("_").str[0].to_numpy()
+
+# (participant x fROI x condition) array of EffectSize for one modality of one
+# network, with NaN for missing cells. Returns the array and the participant IDs.
+def modality_array(data, network, modality, fROIs=FROIS, conditions=CONDITIONS):
+    expt, critical_task = MODALITIES[modality]
+    rows = data[
+        (data.Network == network) & (data.Expt == expt) & (data.CriticalTask == critical_task) &
+        data.ROI.isin(fROIs[network]) & data.Effect.isin(conditions)
+    ]
+    # Split each distinct Subject string once, then merge sessions with the same ID.
+    session, sessions = pd.factorize(rows.Subject)
+    session_id, ids = pd.factorize(subject_ids(np.asarray(sessions, dtype=object)))
+    subject = session_id[session]
+    roi = pd.Index(fROIs[network]).get_indexer(rows.ROI.astype(int))
+    condition = pd.Index(conditions).get_indexer(rows.Effect.astype(str))
+    shape = (len(ids), len(fROIs[network]), len(conditions))
+    flat = np.ravel_multi_index((subject, roi, condition), shape)
+    if len(np.unique(flat)) != len(flat):
+        raise ValueError(f"more than one {modality} row per participant, fROI and condition in {network}")
+    values = np.full(shape, np.nan)
+    np.put(values, flat, rows.EffectSize.to_numpy(dtype=float))
+    return values, np.asarray(ids)
+
+# Hash join of two arrays on their participant IDs: a hash table of the IDs of
+# `right` is probed with the IDs of `left`. Returns the rows of both arrays for
+# the participants they share, in the order of `left`, and those IDs.
+def join_participants(left, left_ids, right, right_ids):
+    position = pd.Index(right_ids).get_indexer(left_ids)
+    matched = position >= 0
+    return left[matched], right[position[matched]], left_ids[matched]
+
+# Modality x condition interaction of every contrast: per participant and fROI,
+# (cond1 - cond2 spoken) - (cond1 - cond2 typed), as one
+# (participant x fROI x contrast) array. Also returns the contrast in each
+# modality.
+def interactions(spoken, typed, contrasts=CONTRASTS, conditions=CONDITIONS):
+    # Append the fixation baseline as a condition of zeros.
+    spoken = np.concatenate([spoken, np.zeros(spoken.shape[:-1] + (1,))], axis=-1)
+    typed = np.concatenate([typed, np.zeros(typed.shape[:-1] + (1,))], axis=-1)
+    levels = list(conditions) + ["fixation"]
+    cond1 = [levels.index(c1) for c1, _ in contrasts]
+    cond2 = [levels.index(c2) for _, c2 in contrasts]
+    spoken_diff = spoken[..., cond1] - spoken[..., cond2]
+    typed_diff = typed[..., cond1] - typed[..., cond2]
+    return spoken_diff - typed_diff, spoken_diff, typed_diff
+
+################################################################################
+# TESTS
+################################################################################
+
+# One-sample t-test of mean = 0 over the first axis of `diffs`, for every
+# other cell at once (NaN = missing).
+def t_test(diffs):
+    present = ~np.isnan(diffs)
+    d = np.where(present, diffs, 0.0)
+    n = present.sum(axis=0)
+    t = _t_from_sums(d.sum(axis=0), (d ** 2).sum(axis=0), n)
+    df = n - 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "n_subjects": n, "t": t, "df": df,
+            "p_value": 2 * stats.t.sf(np.abs(t), df), "cohen_d": 2 * t / np.sqrt(df),
+        }
+
+# Tests the modality x condition interaction of every contrast in every fROI
+# (FDR-corrected across the fROIs of each contrast, as in lmers.R) and for
+# every network, on the participants' mean across its fROIs. Returns
+# (sepfROIs, network) frames with the columns of the results tables, plus the
+# mean contrast in each modality.
+def run_paired(data=None, networks=NETWORKS, contrasts=CONTRASTS, fROIs=FROIS):
+    data = load_indiv_data() if data is None else data
+    froi_frames, network_frames = [], []
+    for network in networks:
+        spoken, spoken_ids = modality_array(data, network, "spoken", fROIs)
+        typed, typed_ids = modality_array(data, network, "typed", fROIs)
+        spoken, typed, ids = join_participants(spoken, spoken_ids, typed, typed_ids)
+        interaction, spoken_diff, typed_diff = interactions(spoken, typed, contrasts)
+        base = dict(cond1=[c1 for c1, _ in contrasts], cond2=[c2 for _, c2 in contrasts], expt_data=EXPT_DATA[network])
+
+        # (fROI x contrast) cells, laid out contrast by contrast.
+        froi = t_test(interaction)
+        with np.errstate(invalid="ignore"):
+            spoken_mean, typed_mean = np.nanmean(spoken_diff, axis=0), np.nanmean(typed_diff, axis=0)
+        fdr = np.full(froi["p_value"].shape, np.nan)
+        for j in range(len(contrasts)):
+            tested = ~np.isnan(froi["p_value"][:, j])
+            fdr[tested, j] = p_adjust_fdr(froi["p_value"][tested, j])
+        frame = pd.DataFrame(base).loc[np.repeat(np.arange(len(contrasts)), len(fROIs[network]))].reset_index(drop=True)
+        frame["ROI"] = np.tile(fROIs[network], len(contrasts))
+        frame = frame.assign(
+            p_value_uncorrected=froi["p_value"].T.ravel(), p_value_fdr_corrected=fdr.T.ravel(),
+            cohen_d=froi["cohen_d"].T.ravel(), t=froi["t"].T.ravel(), df=froi["df"].T.ravel(),
+            n_subjects=froi["n_subjects"].T.ravel(),
+            spoken_mean=spoken_mean.T.ravel(), typed_mean=typed_mean.T.ravel(),
+        )
+        froi_frames.append(frame)
+
+        with np.errstate(invalid="ignore"):
+            network_test = t_test(np.nanmean(interaction, axis=1))
+            spoken_mean = np.nanmean(np.nanmean(spoken_diff, axis=1), axis=0)
+            typed_mean = np.nanmean(np.nanmean(typed_diff, axis=1), axis=0)
+        network_frames.append(pd.DataFrame(base).assign(
+            ROI=FROI_STR[network], network=network, p_value=network_test["p_value"],
+            cohen_d=network_test["cohen_d"], t=network_test["t"], df=network_test["df"],
+            n_subjects=network_test["n_subjects"], spoken_mean=spoken_mean, typed_mean=typed_mean,
+        ))
+        print(f"{network}: {len(ids)} participants with both modalities")
+    return pd.concat(froi_frames, ignore_index=True), pd.concat(network_frames, ignore_index=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Within-participant comparison of spoken (Expt 1) and typed (Expt 3) production.")
+    parser.add_argument("--path", default=INDIV_DATA_PATH, help="individual data CSV")
+    parser.add_argument("--networks", nargs="+", default=NETWORKS)
+    args = parser.parse_args()
+    sep, network = run_paired(load_indiv_data(args.path), args.networks)
+    for model, df in [("sepfROIs", sep), ("network", network)]:
+        out = PAIRED_PATH.format(model=model)
+        print(f"Writing {out}")
+        df.to_csv(out, index=False)
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+
+from indiv_data import CACHE_DIR
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+# Digests of the parcel file and mapping behind every relabeled file.
+RELABEL_STATE_PATH = os.path.join(CACHE_DIR, "relabeled_parcels.json")
+
+################################################################################
+# LABELS
+################################################################################
+
+# Labels of a parcel file, memory-mapped (for uncompressed .nii files) and in
+# the integer dtype they are stored in; get_fdata would read a float64 copy.
+# Returns the image and the labels.
+def load_labels(path):
+    img = nib.load(path, mmap=True)
+    labels = np.asanyarray(img.dataobj)
+    if not np.issubdtype(labels.dtype, np.integer):
+        raise ValueError(f"{path} does not hold integer labels (dtype {labels.dtype})")
+    return img, labels
+
+# Replaces every label that is a key of `mapping` (old label -> new label) by
+# its new label, and every other label by `default`, in one pass. Labels of up
+# to 16 bits go through a lookup table over all their possible values; wider
+# labels are looked up in the sorted keys of the mapping. The result has the
+# dtype of `labels` unless `dtype` is given.
+def remap_labels(labels, mapping, default=0, dtype=None):
+    dtype = labels.dtype if dtype is None else np.dtype(dtype)
+    if labels.dtype.itemsize <= 2:
+        # Index the table with the bits of the labels, read as unsigned.
+        unsigned = np.dtype(f"u{labels.dtype.itemsize}")
+        table = np.full(2 ** (8 * labels.dtype.itemsize), default, dtype=dtype)
+        old = np.array(list(mapping), dtype=labels.dtype).view(unsigned)
+        table[old] = list(mapping.values())
+        return table[labels.view(unsigned)]
+    if not mapping:
+        return np.full_like(labels, default, dtype=dtype)
+    old = np.array(sorted(mapping), dtype=labels.dtype)
+    new = np.array([mapping[o] for o in sorted(mapping)], dtype=dtype)
+    position = np.minimum(np.searchsorted(old, labels), len(old) - 1)
+    return np.where(old[position] == labels, new[position], np.asarray(default, dtype=dtype))
+
+################################################################################
+# CACHED RELABELING
+################################################################################
+
+def relabel_digest(path, mapping, default=0):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        h.update(f.read())
+    h.update(json.dumps([sorted((int(k), int(v)) for k, v in mapping.items()), int(default)]).encode())
+    return h.hexdigest()
+
+def read_relabel_state(path=RELABEL_STATE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Writes a copy of the parcel file `path` with its labels remapped (see
+# remap_labels) to `out`, keeping the affine, header and integer dtype. The
+# file is only rewritten when the parcel file or the mapping has changed
+# since it was last written, or when it is missing. Returns `out`.
+def relabel_parcels(path, out, mapping, default=0, state_path=RELABEL_STATE_PATH):
+    state = read_relabel_state(state_path)
+    key = os.path.abspath(out)
+    digest = relabel_digest(path, mapping, default)
+    if state.get(key) == digest and os.path.exists(out):
+        return out
+    img, labels = load_labels(path)
+    relabeled = nib.Nifti1Image(remap_labels(labels, mapping, default), img.affine, img.header)
+    relabeled.set_data_dtype(labels.dtype)
+    nib.save(relabeled, out)
+    state[key] = digest
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_path + ".tmp", state_path)
+    return out
@@ -0,0 +1,146 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from model_data import BATTERY, FROIS, build_sources, expt_data, get_source
+
+################################################################################
+# PAIRED DIFFERENCES
+################################################################################
+
+# Per-subject cond1 - cond2 difference for every fROI of the contrast's network,
+# as a (Subject x ROI) frame. Only subjects with both conditions are kept.
+def paired_differences(sources, contrast):
+    def values(src, cond):
+        rows = get_source(sources, src)
+        rows = rows[rows.Effect == cond]
+        return rows.set_index(["Subject", "ROI"])["EffectSize"]
+    diff = values(contrast["cond1_src"], contrast["cond1"]) - values(contrast["cond2_src"], contrast["cond2"])
+    diff = diff.dropna().unstack("ROI")
+    return diff.reindex(columns=FROIS[contrast["network"]])
+
+# Stacks the paired differences of every (contrast, fROI) test into one
+# (tests x subjects) array, with subjects aligned across tests (NaN where a
+# subject has no data), so that one sign flip means the same thing everywhere.
+def difference_matrix(sources, contrasts):
+    diffs = [paired_differences(sources, c) for c in contrasts]
+    subjects = sorted(set().union(*[d.index for d in diffs]))
+    rows, labels = [], []
+    for i, (contrast, diff) in enumerate(zip(contrasts, diffs)):
+        diff = diff.reindex(index=subjects)
+        for ROI in diff.columns:
+            rows.append(diff[ROI].to_numpy(dtype=float))
+            labels.append((i, ROI))
+    return np.vstack(rows), labels
+
+################################################################################
+# SIGN-FLIP PERMUTATIONS
+################################################################################
+
+# One-sample t statistic of each row of `diffs` (NaN = missing), given the row
+# sums of the (possibly sign-flipped) differences. The sum of squares does not
+# change under sign flips, so only the sums need recomputing per permutation.
+def _t_from_sums(sums, sum_sq, n):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sums / n
+        var = (sum_sq - sums * mean) / (n - 1)
+        return mean / np.sqrt(np.maximum(var, 0) / n)
+
+# Sign-flip permutation test of mean(diffs) = 0 for every row of `diffs` at once.
+# Every test uses the same random flips (one per subject column), so the max
+# |t| over tests gives a family-wise (max-statistic) corrected p-value as well.
+# Permutations are processed `chunk_size` at a time to bound memory.
+def sign_flip_test(diffs, n_perm=10000, chunk_size=1000, seed=0):
+    present = ~np.isnan(diffs)
+    d = np.where(present, diffs, 0.0)
+    n = present.sum(axis=1)
+    sums = d.sum(axis=1)
+    sum_sq = (d ** 2).sum(axis=1)
+    t_obs = _t_from_sums(sums, sum_sq, n)
+    abs_obs = np.abs(t_obs) * (1 - 1e-12)
+
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(len(d))
+    exceed_max = np.zeros(len(d))
+    done = 0
+    while done < n_perm:
+        size = min(chunk_size, n_perm - done)
+        flips = rng.choice([-1.0, 1.0], size=(size, d.shape[1]))
+        t_perm = np.abs(_t_from_sums(flips @ d.T, sum_sq, n))
+        exceed += (t_perm >= abs_obs).sum(axis=0)
+        exceed_max += (np.nanmax(t_perm, axis=1)[:, None] >= abs_obs).sum(axis=0)
+        done += size
+
+    return {
+        "t": t_obs,
+        "df": n - 1,
+        "p": (1 + exceed) / (1 + n_perm),
+        "p_fwer": (1 + exceed_max) / (1 + n_perm),
+    }
+
+# Benjamini-Hochberg adjustment, as p.adjust(p, method="fdr") in R.
+def p_adjust_fdr(p):
+    p = np.asarray(p, dtype=float)
+    order = np.argsort(p)[::-1]
+    ranks = np.arange(len(p), 0, -1)
+    adjusted = np.minimum.accumulate(p[order] * len(p) / ranks)
+    result = np.empty_like(p)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+################################################################################
+# RESULTS TABLES
+################################################################################
+
+# Runs every contrast of the given tables through one batched permutation pass
+# and returns one results frame per table, with the columns of
+# results/{table}_sepfROIs.csv (FDR correction is across the fROIs of each
+# contrast, as in lmers.R). With fwer=True, a max-statistic corrected p-value
+# over all tests of the run is added as p_value_fwer_corrected.
+def run_permutations(tables, sources=None, n_perm=10000, chunk_size=1000, seed=0, fwer=False):
+    sources = build_sources() if sources is None else sources
+    contrasts = [(table, c) for table in tables for c in BATTERY[table]]
+    diffs, labels = difference_matrix(sources, [c for _, c in contrasts])
+    result = sign_flip_test(diffs, n_perm=n_perm, chunk_size=chunk_size, seed=seed)
+    cohen_d = 2 * result["t"] / np.sqrt(result["df"])
+
+    rows = []
+    for i, (table, contrast) in enumerate(contrasts):
+        idx = [j for j, (k, _) in enumerate(labels) if k == i]
+        fdr = p_adjust_fdr(result["p"][idx])
+        for j, p_fdr in zip(idx, fdr):
+            row = dict(
+                table=table, cond1=contrast["cond1"], cond2=contrast["cond2"],
+                expt_data=expt_data(contrast), ROI=labels[j][1],
+                p_value_uncorrected=result["p"][j], p_value_fdr_corrected=p_fdr,
+                cohen_d=cohen_d[j]
+            )
+            if fwer:
+                row["p_value_fwer_corrected"] = result["p_fwer"][j]
+            rows.append(row)
+    rows = pd.DataFrame(rows)
+
+    results = {}
+    for table in tables:
+        df = rows[rows.table == table].drop(columns="table").reset_index(drop=True)
+        if table.startswith("validation"):
+            df = df.drop(columns="expt_data")
+        results[table] = df
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sign-flip permutation tests for every fROI contrast in the battery.")
+    parser.add_argument("tables", nargs="*", default=list(BATTERY.keys()), help="tables to run (default: all)")
+    parser.add_argument("--n-perm", type=int, default=10000)
+    parser.add_argument("--chunk-size", type=int, default=1000, help="permutations held in memory at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fwer", action="store_true", help="also report max-statistic FWER-corrected p-values")
+    args = parser.parse_args()
+    results = run_permutations(args.tables, n_perm=args.n_perm, chunk_size=args.chunk_size, seed=args.seed, fwer=args.fwer)
+    for table, df in results.items():
+        # lmers.R writes the validation results without the _sepfROIs suffix
+        name = table if table.startswith("validation") else f"{table}_sepfROIs"
+        out = f"results/{name}_permutation.csv"
+        print(f"Writing {out}")
+        df.to_csv(out, index=False)
@@ -0,0 +1,156 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from lmm import lmer
+from model_data import BATTERY, FROI_STR, build_sources, expt_data
+from permutation import _t_from_sums, paired_differences
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+POWER_PATH = "results/power.csv"
+
+SAMPLE_SIZES = [10, 15, 20, 30, 40, 60, 80]
+# Model of the per-subject, per-fROI paired differences of a contrast.
+COMPONENTS_FORMULA = "Diff ~ 1 + (1|ROI) + (1|Subject)"
+
+################################################################################
+# VARIANCE COMPONENTS
+################################################################################
+
+# Fits COMPONENTS_FORMULA to the cond1 - cond2 differences of a contrast and
+# returns the mean effect of every fROI (the fitted mean plus the shrunken
+# fROI deviation) and the subject and residual standard deviations. The subject
+# intercept of the differences is the subject x condition variability of the
+# original data.
+def variance_components(diff):
+    long = diff.stack().dropna().rename("Diff").reset_index()
+    fit = lmer(COMPONENTS_FORMULA, long)
+    sd_roi, sd_subject = fit["theta"] * fit["sigma"]
+    sd_resid = fit["sigma"]
+    mean = fit["beta"][0]
+    # BLUP of the fROI deviations, ignoring the (small) subject imbalance.
+    n = diff.notna().sum(axis=0).to_numpy()
+    shrink = sd_roi ** 2 / (sd_roi ** 2 + sd_resid ** 2 / n)
+    roi_effects = mean + shrink * (diff.mean(axis=0).to_numpy() - mean)
+    return {
+        "ROIs": list(diff.columns), "roi_effects": roi_effects, "mean": mean,
+        "sd_roi": sd_roi, "sd_subject": sd_subject, "sd_resid": sd_resid,
+    }
+
+################################################################################
+# SIMULATION
+################################################################################
+
+# Benjamini-Hochberg decisions at level alpha along the last axis of p, for
+# every simulation at once (same as p_adjust_fdr(p) <= alpha, row by row).
+def fdr_reject(p, alpha=0.05):
+    m = p.shape[-1]
+    ordered = np.sort(p, axis=-1)
+    below = ordered <= alpha * np.arange(1, m + 1) / m
+    # Number of rejections: the largest rank whose p-value is below its bound.
+    k = np.where(below.any(axis=-1), m - np.argmax(below[..., ::-1], axis=-1), 0)
+    threshold = np.take_along_axis(ordered, np.maximum(k - 1, 0)[..., None], axis=-1)
+    return (p <= threshold) & (k > 0)[..., None]
+
+# Simulates n_sim datasets of n_subjects subjects from the fitted components,
+# as one (simulations x subjects x fROIs) array of paired differences, and
+# scores them all at once. Returns how many simulations rejected the null for
+# every fROI (paired t-test, FDR-corrected across the fROIs as in lmers.R) and
+# for the network (t-test on the subjects' mean difference across fROIs).
+def simulate_rejections(components, n_subjects, n_sim, alpha=0.05, seed=None):
+    rng = np.random.default_rng(seed)
+    n_rois = len(components["ROIs"])
+    diffs = (
+        components["roi_effects"]
+        + components["sd_subject"] * rng.standard_normal((n_sim, n_subjects, 1))
+        + components["sd_resid"] * rng.standard_normal((n_sim, n_subjects, n_rois))
+    )
+    df = n_subjects - 1
+    t = _t_from_sums(diffs.sum(axis=1), (diffs ** 2).sum(axis=1), n_subjects)
+    roi_reject = fdr_reject(2 * stats.t.sf(np.abs(t), df), alpha)
+
+    subject_means = diffs.mean(axis=2)
+    t_network = _t_from_sums(subject_means.sum(axis=1), (subject_means ** 2).sum(axis=1), n_subjects)
+    network_reject = 2 * stats.t.sf(np.abs(t_network), df) < alpha
+    return roi_reject.sum(axis=0), int(network_reject.sum())
+
+################################################################################
+# POWER CURVES
+################################################################################
+
+# Estimates power for every contrast of the given tables (each distinct
+# contrast once) at every sample size. Simulations are split into chunks of
+# `chunk_size`, each with its own random stream, and run in a process pool.
+# Returns one row per contrast, fROI (or whole network) and sample size.
+def power_curves(tables=None, sources=None, sample_sizes=SAMPLE_SIZES, n_sim=10000,
+                 alpha=0.05, chunk_size=1000, seed=0, workers=None):
+    tables = list(BATTERY) if tables is None else tables
+    sources = build_sources() if sources is None else sources
+    contrasts = list({
+        tuple(c.items()): c for table in tables for c in BATTERY[table]
+    }.values())
+    components = [variance_components(paired_differences(sources, c)) for c in contrasts]
+
+    tasks = [
+        (i, n, min(chunk_size, n_sim - start))
+        for i in range(len(contrasts)) for n in sample_sizes
+        for start in range(0, n_sim, chunk_size)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    roi_counts, network_counts = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(simulate_rejections, components[i], n, size, alpha, s)
+            for (i, n, size), s in zip(tasks, seeds)
+        ]
+        for (i, n, _), future in zip(tasks, futures):
+            roi, network = future.result()
+            roi_counts[i, n] = roi_counts.get((i, n), 0) + roi
+            network_counts[i, n] = network_counts.get((i, n), 0) + network
+
+    rows = []
+    for i, (contrast, comp) in enumerate(zip(contrasts, components)):
+        desc = dict(
+            network=contrast["network"], cond1=contrast["cond1"], cond2=contrast["cond2"],
+            expt_data=expt_data(contrast)
+        )
+        for n in sample_sizes:
+            for ROI, effect, count in zip(comp["ROIs"], comp["roi_effects"], roi_counts[i, n]):
+                rows.append(dict(desc, fROI=str(ROI), n_subjects=n, effect=effect, power=count / n_sim))
+            rows.append(dict(
+                desc, fROI=FROI_STR[contrast["network"]], n_subjects=n, effect=comp["mean"],
+                power=network_counts[i, n] / n_sim
+            ))
+    return pd.DataFrame(rows)
+
+# Smallest simulated sample size reaching the target power, per contrast and
+# fROI (NaN if none does).
+def required_n(curves, target=0.8):
+    keys = ["network", "cond1", "cond2", "expt_data", "fROI"]
+    reached = curves[curves.power >= target].groupby(keys, sort=False).n_subjects.min()
+    return curves[keys].drop_duplicates().join(reached, on=keys).rename(columns={"n_subjects": "required_n"})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo power curves for the contrasts of the battery.")
+    parser.add_argument("tables", nargs="*", default=None, help="tables whose contrasts to simulate (default: all)")
+    parser.add_argument("--n-sim", type=int, default=10000, help="simulated datasets per contrast and sample size")
+    parser.add_argument("--sample-sizes", type=int, nargs="+", default=SAMPLE_SIZES)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--target", type=float, default=0.8, help="power for the required-N summary")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="simulations per worker task")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--out", default=POWER_PATH)
+    args = parser.parse_args()
+    curves = power_curves(
+        args.tables or None, sample_sizes=args.sample_sizes, n_sim=args.n_sim, alpha=args.alpha,
+        chunk_size=args.chunk_size, seed=args.seed, workers=args.workers
+    )
+    print(f"Writing {args.out}")
+    curves.to_csv(args.out, index=False)
+    print(required_n(curves, args.target).to_string(index=False))
@@ -0,0 +1,108 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from indiv_tensor import factorize
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+RELIABILITY_PATH = "results/split_half_reliability.csv"
+
+# Conditions whose response profile is correlated between halves.
+PROFILE = ["SProd", "WProd", "NProd"]
+# Labels of the two halves in the Half column (e.g. odd and even runs).
+HALVES = ["odd", "even"]
+# Columns identifying one profile, as in the individual data (plus Half).
+UNIT_COLUMNS = ["Expt", "CriticalTask", "Subject", "Network", "ROI"]
+
+################################################################################
+# SPLIT-HALF ARRAY
+################################################################################
+
+# Pivots long-format data with a Half column (one experiment and task) into a
+# (subject, fROI, condition, half) array of EffectSize, with NaN for missing
+# cells. fROIs are (Network, ROI) pairs. Returns the array and the labels of
+# its first two axes.
+def half_array(data, conditions=PROFILE, halves=HALVES):
+    data = data[data["Effect"].isin(conditions) & data["Half"].isin(halves)]
+    subject, subjects = factorize(data["Subject"])
+    network, networks = factorize(data["Network"])
+    roi, rois = factorize(data["ROI"])
+    froi_keys, froi = np.unique(network * len(rois) + roi, return_inverse=True)
+    frois = [(networks[k // len(rois)], rois[k % len(rois)]) for k in froi_keys]
+    condition = pd.Categorical(data["Effect"], categories=conditions).codes
+    half = pd.Categorical(data["Half"], categories=halves).codes
+
+    shape = (len(subjects), len(frois), len(conditions), len(halves))
+    flat = np.ravel_multi_index((subject, froi.ravel(), condition, half), shape)
+    if len(np.unique(flat)) != len(flat):
+        raise ValueError("data has more than one row per (Subject, Network, ROI, Effect, Half) cell")
+    values = np.full(shape, np.nan)
+    np.put(values, flat, data["EffectSize"].to_numpy(dtype=float))
+    return values, subjects, frois
+
+################################################################################
+# RELIABILITY
+################################################################################
+
+# Spearman-Brown prophecy formula: reliability of a measure k times as long.
+def spearman_brown(r, k=2):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return k * r / (1 + (k - 1) * r)
+
+# Pearson correlation between the two halves' condition profiles for every
+# (subject, fROI) of a (subject, fROI, condition, half) array at once, over the
+# conditions present in both halves. Profiles with fewer than min_conditions
+# such conditions get NaN. Returns the half correlations, their
+# Spearman-Brown corrected (full-length) reliabilities and the condition counts.
+def split_half(values, min_conditions=3):
+    a, b = values[..., 0], values[..., 1]
+    present = ~np.isnan(a) & ~np.isnan(b)
+    n = present.sum(axis=-1)
+    a, b = np.where(present, a, 0), np.where(present, b, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ca = np.where(present, a - a.sum(axis=-1, keepdims=True) / n[..., None], 0)
+        cb = np.where(present, b - b.sum(axis=-1, keepdims=True) / n[..., None], 0)
+        r = (ca * cb).sum(axis=-1) / np.sqrt((ca ** 2).sum(axis=-1) * (cb ** 2).sum(axis=-1))
+    r = np.where(n >= min_conditions, r, np.nan)
+    return r, spearman_brown(r), n
+
+# Split-half reliability of every profile in `data` (long format, as the
+# individual data plus a Half column), one batched computation per experiment
+# and task. Returns a tidy frame keyed by UNIT_COLUMNS, so that it can be
+# merged back into the individual data.
+def reliability_table(data, conditions=PROFILE, halves=HALVES, min_conditions=3):
+    if "Half" not in data.columns:
+        raise ValueError("split-half reliability needs a Half column with estimates from each half of the runs")
+    frames = []
+    for (expt, task), rows in data.groupby(["Expt", "CriticalTask"], observed=True, sort=True):
+        if not rows["Effect"].isin(conditions).any():
+            continue
+        values, subjects, frois = half_array(rows, conditions, halves)
+        r, reliability, n = split_half(values, min_conditions)
+        s, f = np.nonzero(n > 0)
+        frames.append(pd.DataFrame({
+            "Expt": expt, "CriticalTask": task,
+            "Subject": np.asarray(subjects, dtype=object)[s],
+            "Network": [frois[i][0] for i in f], "ROI": [frois[i][1] for i in f],
+            "n_conditions": n[s, f], "r_half": r[s, f], "reliability": reliability[s, f],
+        }))
+    if not frames:
+        return pd.DataFrame(columns=UNIT_COLUMNS + ["n_conditions", "r_half", "reliability"])
+    return pd.concat(frames, ignore_index=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split-half reliability of the fROI response profiles.")
+    parser.add_argument("path", help="CSV in the format of fMRI_all_indiv_production_data.csv plus a Half column")
+    parser.add_argument("--conditions", nargs="+", default=PROFILE)
+    parser.add_argument("--halves", nargs=2, default=HALVES, help="labels of the two halves in the Half column")
+    parser.add_argument("--min-conditions", type=int, default=3, help="conditions needed in both halves")
+    parser.add_argument("--out", default=RELIABILITY_PATH)
+    args = parser.parse_args()
+    data = pd.read_csv(args.path)
+    result = reliability_table(data, args.conditions, args.halves, args.min_conditions)
+    print(f"Writing {args.out}")
+    result.to_csv(args.out, index=False)
+    print(result.groupby(["Expt", "CriticalTask", "Network"]).reliability.describe().to_string())
@@ -0,0 +1,292 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+
+import pandas as pd
+
+from indiv_data import CACHE_DIR
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+RESULTS_DIR = "results"
+RESULTS_DB = os.path.join(CACHE_DIR, "results.sqlite")
+
+EXPERIMENTS = {
+    "expt1": "Experiment 1",
+    "expt2": "Experiment 2",
+    "expt3": "Experiment 3",
+}
+
+# Lookup key of a result row. `table_name` is the file name without the
+# _sepfROIs/_network suffix (e.g. "table1", "validation_lang"), `contrast` is
+# "cond1-cond2" with the condition names of the CSVs, or the effect for the
+# interaction model of Table SI-4.
+KEY_COLUMNS = ["table_name", "expt", "network", "ROI", "contrast"]
+# Columns of the CSVs, by kind of result. The equivalence kinds hold the TOST
+# results of tost.py ({table}_sepfROIs_tost.csv and {table}_network_tost.csv).
+VALUE_COLUMNS = {
+    "contrasts": ["cond1", "cond2", "expt_data", "effect", "p_value_uncorrected", "p_value_fdr_corrected", "cohen_d"],
+    "networks": ["cond1", "cond2", "expt_data", "effect", "p_value", "cohen_d"],
+    "contrast_equivalence": ["cond1", "cond2", "expt_data", "effect", "cohen_d", "p_tost", "p_tost_fdr_corrected", "equivalent"],
+    "network_equivalence": ["cond1", "cond2", "expt_data", "effect", "cohen_d", "p_tost", "equivalent"],
+}
+REAL_COLUMNS = ["p_value_uncorrected", "p_value_fdr_corrected", "p_value", "cohen_d", "p_tost", "p_tost_fdr_corrected"]
+# Stored as 0/1 and read back as booleans.
+BOOLEAN_COLUMNS = ["equivalent"]
+# Key columns that are derived from the others, so a CSV cannot have them.
+DERIVED_COLUMNS = ["table_name", "expt", "contrast"]
+
+# Bump when the schema changes; the store is a cache, so an outdated one is
+# emptied and filled again by the next import.
+SCHEMA_VERSION = 3
+
+def column_type(col):
+    return "REAL" if col in REAL_COLUMNS else "INTEGER" if col in BOOLEAN_COLUMNS else "TEXT"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY, kind TEXT NOT NULL, columns TEXT NOT NULL, sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS experiments (expt TEXT PRIMARY KEY, name TEXT NOT NULL);
+""" + "".join(f"""
+CREATE TABLE IF NOT EXISTS {kind} (
+    file TEXT NOT NULL, row INTEGER NOT NULL,
+    table_name TEXT NOT NULL, expt TEXT, network TEXT, ROI TEXT NOT NULL, contrast TEXT NOT NULL,
+    {", ".join(f"{col} {column_type(col)}" for col in columns)},
+    extra TEXT,
+    PRIMARY KEY (file, row)
+);
+CREATE INDEX IF NOT EXISTS {kind}_key ON {kind} ({", ".join(KEY_COLUMNS)});
+""" for kind, columns in VALUE_COLUMNS.items())
+
+################################################################################
+# RESULT FILES
+################################################################################
+
+# Kind and table name of a results CSV, from its file name.
+def file_kind(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if name.endswith("_network_tost"):
+        return "network_equivalence", name[:-len("_network_tost")]
+    if name.endswith("_sepfROIs_tost"):
+        return "contrast_equivalence", name[:-len("_sepfROIs_tost")]
+    if name.endswith("_network"):
+        return "networks", name[:-len("_network")]
+    if name.endswith("_sepfROIs"):
+        return "contrasts", name[:-len("_sepfROIs")]
+    # The validation analyses only have per-fROI results.
+    return "contrasts", name
+
+# Columns of a results CSV that have no column of their own in the store (e.g.
+# t, df and n_subjects in the outputs of paired.py).
+def extra_columns(df, kind):
+    return [col for col in df.columns if col not in KEY_COLUMNS + VALUE_COLUMNS[kind]]
+
+# JSON object of the extra columns of one row, with NaN as null.
+def _extra_json(values):
+    return json.dumps({
+        col: None if pd.isna(value) else value.item() if hasattr(value, "item") else value
+        for col, value in values.items()
+    })
+
+# Rows of a results CSV with their lookup keys added, and the values of any
+# extra columns in `extra`. The network of per-fROI rows follows
+# format_table.py: MD sources have "MD" in their expt_data.
+def keyed_rows(df, kind, table_name):
+    derived = [col for col in DERIVED_COLUMNS if col in df]
+    if derived:
+        raise ValueError(f"{table_name}: columns {derived} clash with the store's derived key columns")
+    extra = extra_columns(df, kind)
+    df = df.copy()
+    for col in VALUE_COLUMNS[kind]:
+        if col not in df:
+            df[col] = None
+    df["table_name"] = table_name
+    df["expt"] = df["expt_data"].str.split("_").str[0]
+    if "network" not in df:
+        if table_name.startswith("validation_"):
+            network = {"lang": "lang", "md": "MD"}[table_name.split("_")[1]]
+            df["network"] = network
+        else:
+            df["network"] = df["expt_data"].str.contains("MD").map({True: "MD", False: "lang"})
+    df["ROI"] = df["ROI"].astype(str)
+    df["contrast"] = df["effect"].where(df["effect"].notna(), df["cond1"] + "-" + df["cond2"])
+    df["extra"] = [_extra_json(values) for values in df[extra].to_dict("records")] if extra else None
+    return df[KEY_COLUMNS + VALUE_COLUMNS[kind] + ["extra"]]
+
+# Turns the 0/1 of boolean columns back into booleans (NULL stays missing).
+def restore_booleans(df):
+    for col in BOOLEAN_COLUMNS:
+        if col in df:
+            df[col] = df[col].map(lambda value: value if value is None else bool(value))
+    return df
+
+################################################################################
+# STORE
+################################################################################
+
+class ResultsStore:
+    """
+    The results CSVs in one SQLite file. Per-fROI rows are in the `contrasts`
+    table and whole-network rows in `networks`; both are indexed on
+    (table_name, expt, network, ROI, contrast), so a lookup by key is an index
+    search rather than a scan. The TOST results of tost.py are kept the same
+    way in `contrast_equivalence` and `network_equivalence`. Columns outside
+    the schema are kept per row as a JSON object in `extra`. `files`
+    remembers the columns of every imported CSV, so that it can be exported
+    in its original layout.
+    """
+    def __init__(self, path=RESULTS_DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                for table in ["files"] + list(VALUE_COLUMNS):
+                    self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+                self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.connection.executescript(SCHEMA)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO experiments VALUES (?, ?)", EXPERIMENTS.items()
+            )
+
+    def close(self):
+        self.connection.close()
+
+    # Imports one results CSV, replacing any earlier import of the same file.
+    # Files whose contents have not changed are skipped. A file that cannot be
+    # stored raises ValueError and leaves the store unchanged. Returns whether
+    # the file was (re)imported.
+    def import_csv(self, path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        known = self.connection.execute("SELECT sha256 FROM files WHERE name = ?", (name,)).fetchone()
+        if known is not None and known["sha256"] == sha256:
+            return False
+        kind, table_name = file_kind(path)
+        df = pd.read_csv(path, float_precision="round_trip")
+        rows = keyed_rows(df, kind, table_name).astype(object)
+        rows = rows.where(rows.notna(), None)
+        columns = ["file", "row"] + list(rows.columns)
+        with self.connection:
+            for table in VALUE_COLUMNS:
+                self.connection.execute(f"DELETE FROM {table} WHERE file = ?", (name,))
+            self.connection.executemany(
+                f"INSERT INTO {kind} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [(name, i, *values) for i, values in enumerate(rows.itertuples(index=False, name=None))]
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (name, kind, json.dumps(list(df.columns)), sha256)
+            )
+        return True
+
+    # Imports every results CSV in a directory. Returns the names of the files
+    # that were (re)imported.
+    def import_results(self, results_dir=RESULTS_DIR):
+        paths = sorted(glob.glob(os.path.join(results_dir, "*_sepfROIs.csv")) +
+                       glob.glob(os.path.join(results_dir, "*_network.csv")) +
+                       glob.glob(os.path.join(results_dir, "*_tost.csv")) +
+                       glob.glob(os.path.join(results_dir, "validation_*.csv")))
+        return [os.path.splitext(os.path.basename(p))[0] for p in paths if self.import_csv(p)]
+
+    # An imported file as a DataFrame with its original columns and row order.
+    def frame(self, name):
+        file = self.connection.execute("SELECT kind, columns FROM files WHERE name = ?", (name,)).fetchone()
+        if file is None:
+            raise KeyError(name)
+        columns = json.loads(file["columns"])
+        stored = [col for col in columns if col in KEY_COLUMNS + VALUE_COLUMNS[file["kind"]]]
+        cursor = self.connection.execute(
+            f"SELECT {', '.join(stored + ['extra'])} FROM {file['kind']} WHERE file = ? ORDER BY row", (name,)
+        )
+        rows = cursor.fetchall()
+        df = pd.DataFrame([row[:-1] for row in rows], columns=stored)
+        if len(stored) < len(columns):
+            extra = pd.DataFrame([json.loads(row["extra"]) for row in rows], index=df.index)
+            df = pd.concat([df, extra], axis=1)
+        return restore_booleans(df[columns])
+
+    def export_csv(self, name, path):
+        self.frame(name).to_csv(path, index=False)
+
+    def export_results(self, out_dir=RESULTS_DIR):
+        os.makedirs(out_dir, exist_ok=True)
+        names = [row["name"] for row in self.connection.execute("SELECT name FROM files ORDER BY name")]
+        for name in names:
+            self.export_csv(name, os.path.join(out_dir, f"{name}.csv"))
+        return names
+
+    # Rows of one kind ("contrasts" or "networks") matching the given key
+    # columns, in file order. Keys that are left out match anything.
+    def query(self, kind, table_name, **key):
+        if kind not in VALUE_COLUMNS:
+            raise ValueError(f"unknown kind {kind!r}")
+        unknown = set(key) - set(KEY_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown key columns {sorted(unknown)}")
+        key = dict(table_name=table_name, **key)
+        if "ROI" in key:
+            key["ROI"] = str(key["ROI"])
+        where = " AND ".join(f"{col} IS ?" for col in KEY_COLUMNS if col in key)
+        cursor = self.connection.execute(
+            f"SELECT * FROM {kind} WHERE {where} ORDER BY file, row", [key[col] for col in KEY_COLUMNS if col in key]
+        )
+        return restore_booleans(pd.DataFrame(cursor.fetchall(), columns=[d[0] for d in cursor.description]))
+
+    # The single row with the given full key, as a dict, or None.
+    def lookup(self, kind, table_name, expt, network, ROI, contrast):
+        rows = self.query(kind, table_name, expt=expt, network=network, ROI=ROI, contrast=contrast)
+        if len(rows) > 1:
+            raise ValueError(f"{len(rows)} rows match {(table_name, expt, network, ROI, contrast)}")
+        return None if rows.empty else rows.iloc[0].to_dict()
+
+    # Names of the experiments (expt1 -> Experiment 1, ...).
+    def experiments(self):
+        return dict(self.connection.execute("SELECT expt, name FROM experiments ORDER BY expt").fetchall())
+
+################################################################################
+# ROUND TRIP
+################################################################################
+
+# Imports every results CSV in a directory into a temporary store, exports it
+# again and compares each exported file with the original (as read by
+# pandas). Returns the names of the files that differ.
+def check_round_trip(results_dir=RESULTS_DIR):
+    read = lambda path: pd.read_csv(path, float_precision="round_trip")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ResultsStore(os.path.join(tmp, "results.sqlite"))
+        store.import_results(results_dir)
+        names = store.export_results(os.path.join(tmp, "export"))
+        store.close()
+        return [
+            name for name in names
+            if not read(os.path.join(results_dir, f"{name}.csv")).equals(read(os.path.join(tmp, "export", f"{name}.csv")))
+        ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import the results CSVs into a SQLite store, or export them back.")
+    parser.add_argument("command", choices=["import", "export", "check"],
+                        help="check: import into a temporary store, export and compare with the originals")
+    parser.add_argument("--results-dir", default=RESULTS_DIR, help="directory of the results CSVs")
+    parser.add_argument("--db", default=RESULTS_DB, help="SQLite file")
+    args = parser.parse_args()
+    if args.command == "check":
+        different = check_round_trip(args.results_dir)
+        for name in different:
+            print(f"{name}: exported file differs from the original")
+        raise SystemExit(1 if different else 0)
+    store = ResultsStore(args.db)
+    if args.command == "import":
+        names = store.import_results(args.results_dir)
+        print(f"Imported {len(names)} changed files into {args.db}")
+    else:
+        names = store.export_results(args.results_dir)
+        print(f"Exported {len(names)} files to {args.results_dir}")
+    store.close()
@@ -0,0 +1,109 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from indiv_data import DATA_DIR, INDIV_DATA_PATH, load_indiv_data
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+EXCLUSIONS_PATH = os.path.join(DATA_DIR, "exclusions.csv")
+OUTLIER_CELLS_PATH = "results/outlier_cells.csv"
+
+# Robust z-scores are computed within each of these groups.
+GROUP_COLUMNS = ["Expt", "CriticalTask", "Network", "ROI", "Effect"]
+# Scales the MAD to the standard deviation of a normal distribution.
+MAD_SCALE = 1.4826
+# A cell is outlying when |z| exceeds Z_THRESHOLD (Iglewicz and Hoaglin), and
+# a subject is excluded when more than MAX_OUTLYING_FRACTION of their cells are.
+Z_THRESHOLD = 3.5
+MAX_OUTLYING_FRACTION = 0.1
+
+################################################################################
+# ROBUST Z-SCORES
+################################################################################
+
+# Integer codes of the rows' groups. Categorical columns (as returned by
+# indiv_data.load_indiv_data) reuse their codes, so nothing is re-hashed.
+def group_codes(data, columns):
+    codes = [
+        data[col].cat.codes.to_numpy() if isinstance(data[col].dtype, pd.CategoricalDtype)
+        else pd.factorize(data[col])[0]
+        for col in columns
+    ]
+    return np.ravel_multi_index(codes, [c.max() + 1 for c in codes])
+
+# (x - median) / (MAD_SCALE * MAD) of every row's EffectSize within its group.
+# Groups with a MAD of zero get NaN.
+def robust_z(data, columns=GROUP_COLUMNS):
+    groups = group_codes(data, columns)
+    x = data["EffectSize"].to_numpy(dtype=float)
+    median = pd.Series(x).groupby(groups).transform("median").to_numpy()
+    deviation = np.abs(x - median)
+    mad = pd.Series(deviation).groupby(groups).transform("median").to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(mad > 0, (x - median) / (MAD_SCALE * mad), np.nan)
+
+################################################################################
+# SCREENING
+################################################################################
+
+# Per-subject counts of cells and outlying cells over the whole dataset, and
+# whether the subject is excluded.
+def screen(data, z_threshold=Z_THRESHOLD, max_fraction=MAX_OUTLYING_FRACTION):
+    z = robust_z(data)
+    subject, subjects = pd.factorize(data["Subject"])
+    scored = ~np.isnan(z)
+    outlying = scored & (np.abs(np.nan_to_num(z)) > z_threshold)
+    n_cells = np.bincount(subject, weights=scored, minlength=len(subjects))
+    n_outlying = np.bincount(subject, weights=outlying, minlength=len(subjects))
+    max_abs_z = np.zeros(len(subjects))
+    np.maximum.at(max_abs_z, subject, np.abs(np.nan_to_num(z)))
+    subjects = pd.DataFrame({
+        "Subject": np.asarray(subjects, dtype=object), "n_cells": n_cells.astype(int),
+        "n_outlying": n_outlying.astype(int), "fraction_outlying": n_outlying / n_cells,
+        "max_abs_z": max_abs_z,
+    })
+    subjects["excluded"] = subjects["fraction_outlying"] > max_fraction
+    return subjects, z
+
+################################################################################
+# EXCLUSION MANIFEST
+################################################################################
+
+# The manifest lists the excluded subjects with the evidence for excluding them.
+def write_exclusions(subjects, path=EXCLUSIONS_PATH):
+    excluded = subjects[subjects.excluded].drop(columns="excluded")
+    excluded.sort_values("fraction_outlying", ascending=False).to_csv(path, index=False)
+    return excluded
+
+def read_exclusions(path=EXCLUSIONS_PATH):
+    return pd.read_csv(path)["Subject"].astype(str).tolist()
+
+# Drops every row of the excluded subjects (a list of subjects, or the path of
+# a manifest).
+def apply_exclusions(data, exclusions):
+    if isinstance(exclusions, str):
+        exclusions = read_exclusions(exclusions)
+    return data[~data["Subject"].astype(str).isin(exclusions)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flag subjects with many outlying EffectSize values (median/MAD z-scores).")
+    parser.add_argument("--path", default=INDIV_DATA_PATH, help="individual data CSV")
+    parser.add_argument("--z", type=float, default=Z_THRESHOLD, help="|z| above which a cell is outlying")
+    parser.add_argument("--max-fraction", type=float, default=MAX_OUTLYING_FRACTION,
+                        help="fraction of outlying cells above which a subject is excluded")
+    parser.add_argument("--out", default=EXCLUSIONS_PATH, help="exclusion manifest")
+    parser.add_argument("--cells-out", default=OUTLIER_CELLS_PATH, help="where to list the outlying cells")
+    args = parser.parse_args()
+    data = load_indiv_data(args.path)
+    subjects, z = screen(data, args.z, args.max_fraction)
+    cells = data[np.abs(np.nan_to_num(z)) > args.z].assign(z=z[np.abs(np.nan_to_num(z)) > args.z])
+    print(f"Writing {args.cells_out}")
+    cells[["Subject"] + GROUP_COLUMNS + ["EffectSize", "z"]].to_csv(args.cells_out, index=False)
+    print(f"Writing {args.out}")
+    excluded = write_exclusions(subjects, args.out)
+    print(f"{len(excluded)} of {len(subjects)} subjects excluded")
+    print(excluded.to_string(index=False))
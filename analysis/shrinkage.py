@@ -0,0 +1,162 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from indiv_data import load_indiv_data
+from ingest import GROUP_COLUMNS, SUMMARY_COLUMNS, SUMMARY_DECIMALS, group_moments
+from model_data import BATTERY, build_sources, expt_data
+from permutation import difference_matrix, p_adjust_fdr
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+SHRUNK_SUMMARY_PATH = "results/summaryShrunkEffectSize.csv"
+
+# The fROIs of one network and hemisphere, in one experiment, task, condition
+# and subject subset (Speak_and_type), share a prior: every summary group
+# column but those naming the fROI, so that each fROI enters its prior once.
+POOL_COLUMNS = [col for col in GROUP_COLUMNS if col not in ["ROI", "ROI_name"]]
+
+################################################################################
+# EMPIRICAL BAYES
+################################################################################
+
+# Normal-normal empirical Bayes for many groups of fROIs at once. `means` and
+# `variances` are (groups x fROIs) arrays of the observed fROI means and their
+# sampling variances, padded with NaN. Within each group the true fROI effects
+# are modelled as N(mu, tau2); mu and tau2 are estimated by REML with batched
+# fixed-point updates, starting from the method-of-moments estimate. Returns
+# the posterior means and standard deviations and the shrinkage factors
+# (0 = raw estimate, 1 = group mean). Groups with a single fROI are not shrunk.
+def eb_shrink(means, variances, max_iter=500, tol=1e-12):
+    present = ~np.isnan(means) & ~np.isnan(variances)
+    m = np.where(present, means, 0.0)
+    v = np.where(present, variances, 1.0)
+    k = present.sum(axis=1)
+    pooled = k >= 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spread = (np.where(present, m - m.sum(axis=1, keepdims=True) / k[:, None], 0) ** 2).sum(axis=1) / (k - 1)
+        tau2 = np.where(pooled, np.maximum(spread - np.where(present, v, 0).sum(axis=1) / k, 0), 0)
+        for _ in range(max_iter):
+            w = np.where(present, 1 / (tau2[:, None] + v), 0)
+            mu = (w * m).sum(axis=1) / w.sum(axis=1)
+            update = (w ** 2 * ((m - mu[:, None]) ** 2 - v)).sum(axis=1) / (w ** 2).sum(axis=1) + 1 / w.sum(axis=1)
+            update = np.where(pooled, np.maximum(update, 0), 0)
+            done = np.nanmax(np.abs(update - tau2)) < tol * max(1, np.nanmax(tau2))
+            tau2 = update
+            if done:
+                break
+        w = np.where(present, 1 / (tau2[:, None] + v), 0)
+        mu = (w * m).sum(axis=1) / w.sum(axis=1)
+        B = tau2[:, None] / (tau2[:, None] + v)
+        B = np.where(pooled[:, None], B, 1)
+        post_mean = mu[:, None] + B * (m - mu[:, None])
+        # Includes the uncertainty in the estimate of mu.
+        post_var = B * v + np.where(pooled[:, None], (1 - B) ** 2 / w.sum(axis=1, keepdims=True), 0)
+    nan = np.where(present, 1.0, np.nan)
+    return post_mean * nan, np.sqrt(post_var) * nan, (1 - B) * nan
+
+# Scatters the rows of `frame` into (groups x fROIs) arrays of the given
+# columns, one group per combination of `by`. Returns the arrays and the
+# (group, position) of every row.
+def _padded(frame, by, columns):
+    grouped = frame.groupby(by, sort=False, observed=True)
+    group, pos = grouped.ngroup().to_numpy(), grouped.cumcount().to_numpy()
+    arrays = []
+    for col in columns:
+        a = np.full((group.max() + 1, pos.max() + 1), np.nan)
+        a[group, pos] = frame[col].to_numpy(dtype=float)
+        arrays.append(a)
+    return arrays, (group, pos)
+
+################################################################################
+# CONDITION MEANS
+################################################################################
+
+# Partially pooled mean response of every fROI and condition, in the layout of
+# fMRI_all_production_data_summaryMeanEffectSize.csv: MeanEffect and
+# StderrEffect are the posterior mean and standard deviation, StdEffect is
+# still the spread across subjects. The raw estimates and the shrinkage factor
+# are appended as extra columns.
+def shrink_summary(data):
+    moments = group_moments(data)
+    if moments.duplicated(POOL_COLUMNS + ["ROI"]).any():
+        raise ValueError(f"an fROI has more than one summary group within {POOL_COLUMNS}")
+    moments["var"] = moments["M2"] / (moments["n"] - 1) / moments["n"]
+    (means, variances), idx = _padded(moments, POOL_COLUMNS, ["mean", "var"])
+    post_mean, post_sd, shrinkage = eb_shrink(means, variances)
+    summary = moments.copy()
+    summary["MeanEffect"] = post_mean[idx]
+    summary["StdEffect"] = np.sqrt(moments["M2"] / (moments["n"] - 1))
+    summary["StderrEffect"] = post_sd[idx]
+    summary["RawMeanEffect"] = moments["mean"]
+    summary["RawStderrEffect"] = np.sqrt(moments["var"])
+    summary["Shrinkage"] = shrinkage[idx]
+    return summary[SUMMARY_COLUMNS + ["RawMeanEffect", "RawStderrEffect", "Shrinkage"]]
+
+################################################################################
+# CONTRASTS
+################################################################################
+
+# Partially pooled cond1 - cond2 effect in every fROI for the contrasts of the
+# given tables, with the fROIs of each contrast sharing a prior. Returns one
+# frame per table with the columns of results/{table}_sepfROIs.csv, where the
+# tests and d = 2t / sqrt(n - 1) use the posterior mean and standard deviation.
+# t = mean / sd is referred to a t distribution with the n - 1 df of the
+# fROI's paired t-test, which it equals when nothing is pooled (shrinkage 0).
+# With pooling it is an approximation: the uncertainty in tau2 is ignored
+# (which makes the p-values too small), while the pooled estimate draws on more
+# data than n - 1 df allow for (which makes them too large).
+def shrink_contrasts(tables, sources=None):
+    sources = build_sources() if sources is None else sources
+    contrasts = [(table, c) for table in tables for c in BATTERY[table]]
+    diffs, labels = difference_matrix(sources, [c for _, c in contrasts])
+    n = np.sum(~np.isnan(diffs), axis=1)
+    tests = pd.DataFrame({
+        "contrast": [i for i, _ in labels], "ROI": [ROI for _, ROI in labels],
+        "mean": np.nanmean(diffs, axis=1), "var": np.nanvar(diffs, axis=1, ddof=1) / n,
+    })
+    (means, variances), idx = _padded(tests, ["contrast"], ["mean", "var"])
+    post_mean, post_sd, shrinkage = eb_shrink(means, variances)
+    t = post_mean[idx] / post_sd[idx]
+    df = n - 1
+    tests["estimate"], tests["se"], tests["shrinkage"] = post_mean[idx], post_sd[idx], shrinkage[idx]
+    tests["p"] = 2 * stats.t.sf(np.abs(t), df)
+    tests["cohen_d"] = 2 * t / np.sqrt(df)
+
+    results = {}
+    for table in tables:
+        rows = []
+        for i, (t_name, contrast) in enumerate(contrasts):
+            if t_name != table:
+                continue
+            group = tests[tests.contrast == i]
+            rows.append(pd.DataFrame({
+                "cond1": contrast["cond1"], "cond2": contrast["cond2"], "expt_data": expt_data(contrast),
+                "ROI": group["ROI"], "p_value_uncorrected": group["p"],
+                "p_value_fdr_corrected": p_adjust_fdr(group["p"]), "cohen_d": group["cohen_d"],
+                "estimate": group["estimate"], "se": group["se"], "shrinkage": group["shrinkage"],
+            }))
+        df = pd.concat(rows, ignore_index=True)
+        if table.startswith("validation"):
+            df = df.drop(columns="expt_data")
+        results[table] = df
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Empirical-Bayes partial pooling of fROI effects within networks.")
+    parser.add_argument("tables", nargs="*", default=list(BATTERY.keys()), help="tables whose contrasts to shrink (default: all)")
+    parser.add_argument("--summary-out", default=SHRUNK_SUMMARY_PATH)
+    args = parser.parse_args()
+    summary = shrink_summary(load_indiv_data())
+    print(f"Writing {args.summary_out}")
+    summary.round(SUMMARY_DECIMALS).to_csv(args.summary_out, index=False)
+    for table, df in shrink_contrasts(args.tables).items():
+        # lmers.R writes the validation results without the _sepfROIs suffix
+        name = table if table.startswith("validation") else f"{table}_sepfROIs"
+        out = f"results/{name}_shrunk.csv"
+        print(f"Writing {out}")
+        df.to_csv(out, index=False)
@@ -0,0 +1,142 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from indiv_data import CACHE_DIR, INDIV_DATA_PATH, cache_path, load_indiv_data, read_meta
+from indiv_tensor import FROITensor, bootstrap_means
+from model_data import FROIS
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+SIMILARITY_PATH = "results/froi_similarity.csv"
+SIMILARITY_CACHE = os.path.join(CACHE_DIR, "froi_similarity.npz")
+
+NETWORKS = ["lang", "MD"]
+CONDITIONS = ["SProd", "WProd", "NProd", "SComp", "WComp", "VisEvSem"]
+
+################################################################################
+# PROFILES
+################################################################################
+
+# (subject x fROI x condition) array of one experiment and task, for the fROIs
+# of the given networks (in FROIS order). Subjects without any data are
+# dropped. Returns the array, the subjects and the (network, ROI) labels.
+def profile_array(tensor, expt="E1", critical_task="ProdLoc_spoken", networks=NETWORKS, conditions=CONDITIONS):
+    task = tensor.task_indices(expt, critical_task)
+    if len(task) != 1:
+        raise ValueError(f"no data for {expt} {critical_task}")
+    frois = [(network, ROI) for network in networks for ROI in FROIS[network]]
+    values = tensor.values[task[0]][
+        :, tensor.indices("Network", [n for n, _ in frois]), tensor.indices("ROI", [r for _, r in frois]), :
+    ][..., tensor.indices("Effect", conditions)]
+    keep = ~np.all(np.isnan(values), axis=(1, 2))
+    subjects = [s for s, k in zip(tensor.axes["Subject"], keep) if k]
+    return values[keep], subjects, frois
+
+# Pearson correlation between the condition profiles of every pair of fROIs,
+# for a (..., fROI, condition) array of profiles, as a (..., fROI, fROI) array.
+# Leading axes (e.g. bootstrap resamples) are handled in one batched product.
+def profile_correlations(profiles):
+    centered = profiles - profiles.mean(axis=-1, keepdims=True)
+    normed = centered / np.linalg.norm(centered, axis=-1, keepdims=True)
+    return normed @ np.swapaxes(normed, -1, -2)
+
+################################################################################
+# SIMILARITY
+################################################################################
+
+# fROI x fROI correlation matrix of the mean condition profiles across
+# subjects, with percentile bootstrap CIs from resampling subjects. All
+# resampled mean profiles come from one batch of matrix products
+# (indiv_tensor.bootstrap_means) and their correlations from one more.
+def similarity(values, n_boot=1000, ci=95, seed=0, chunk_size=None):
+    n_subjects, n_frois, n_conditions = values.shape
+    mean = np.nanmean(values, axis=0)
+    boot = bootstrap_means(values.reshape(n_subjects, -1), n_boot=n_boot, seed=seed, chunk_size=chunk_size)
+    boot_r = profile_correlations(boot.reshape(n_boot, n_frois, n_conditions))
+    alpha = (100 - ci) / 2
+    lower, upper = np.nanpercentile(boot_r, [alpha, 100 - alpha], axis=0)
+    return {"r": profile_correlations(mean), "lower": lower, "upper": upper, "boot_r": boot_r}
+
+# Mean correlation within and between networks (off-diagonal pairs only), with
+# bootstrap CIs from the same resamples.
+def block_summary(result, frois, ci=95):
+    networks = np.array([n for n, _ in frois])
+    off_diagonal = ~np.eye(len(frois), dtype=bool)
+    alpha = (100 - ci) / 2
+    rows = []
+    for i, a in enumerate(NETWORKS):
+        for b in NETWORKS[i:]:
+            block = np.outer(networks == a, networks == b) & off_diagonal
+            boot = result["boot_r"][:, block].mean(axis=1)
+            lower, upper = np.nanpercentile(boot, [alpha, 100 - alpha])
+            rows.append(dict(network_1=a, network_2=b, r=result["r"][block].mean(), ci_lower=lower, ci_upper=upper))
+    return pd.DataFrame(rows)
+
+# Long format: one row per pair of fROIs (both orders, including the diagonal).
+def similarity_frame(result, frois, names=None):
+    names = {} if names is None else names
+    i, j = np.meshgrid(np.arange(len(frois)), np.arange(len(frois)), indexing="ij")
+    i, j = i.ravel(), j.ravel()
+    return pd.DataFrame({
+        "network_1": [frois[k][0] for k in i], "ROI_1": [frois[k][1] for k in i],
+        "ROI_name_1": [names.get(frois[k], "") for k in i],
+        "network_2": [frois[k][0] for k in j], "ROI_2": [frois[k][1] for k in j],
+        "ROI_name_2": [names.get(frois[k], "") for k in j],
+        "r": result["r"][i, j], "ci_lower": result["lower"][i, j], "ci_upper": result["upper"][i, j],
+    })
+
+################################################################################
+# CACHE
+################################################################################
+
+# Computes the similarity matrices, or loads them from the .npz cache if they
+# were computed from the same individual data with the same settings. The
+# cache holds everything plotting needs: r, lower, upper, boot_r, the fROI
+# labels, conditions and subjects.
+def load_similarity(path=INDIV_DATA_PATH, cache=SIMILARITY_CACHE, expt="E1", critical_task="ProdLoc_spoken",
+                    conditions=CONDITIONS, n_boot=1000, ci=95, seed=0, chunk_size=None):
+    data = load_indiv_data(path)
+    settings = repr((read_meta(cache_path(path))["sha256"], expt, critical_task, conditions, n_boot, ci, seed))
+    try:
+        with np.load(cache) as f:
+            if str(f["settings"]) == settings:
+                return {k: f[k] for k in f.files}
+    except (OSError, KeyError, ValueError):
+        pass
+
+    values, subjects, frois = profile_array(FROITensor.from_frame(data), expt, critical_task, conditions=conditions)
+    result = similarity(values, n_boot=n_boot, ci=ci, seed=seed, chunk_size=chunk_size)
+    result.update(
+        networks=np.array([n for n, _ in frois]), ROIs=np.array([r for _, r in frois]),
+        conditions=np.array(conditions), subjects=np.array(subjects), settings=np.array(settings)
+    )
+    os.makedirs(os.path.dirname(cache) or ".", exist_ok=True)
+    np.savez(cache + ".tmp.npz", **result)
+    os.replace(cache + ".tmp.npz", cache)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fROI x fROI similarity of condition profiles, with bootstrap CIs.")
+    parser.add_argument("--expt", default="E1")
+    parser.add_argument("--task", default="ProdLoc_spoken", help="CriticalTask")
+    parser.add_argument("--conditions", nargs="+", default=CONDITIONS)
+    parser.add_argument("--n-boot", type=int, default=1000)
+    parser.add_argument("--ci", type=float, default=95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=None, help="bootstrap resamples held in memory at once")
+    parser.add_argument("--cache", default=SIMILARITY_CACHE)
+    parser.add_argument("--out", default=SIMILARITY_PATH)
+    args = parser.parse_args()
+    result = load_similarity(cache=args.cache, expt=args.expt, critical_task=args.task, conditions=args.conditions,
+                             n_boot=args.n_boot, ci=args.ci, seed=args.seed, chunk_size=args.chunk_size)
+    frois = list(zip(result["networks"].tolist(), result["ROIs"].tolist()))
+    data = load_indiv_data(columns=["Network", "ROI", "ROI_name"])
+    data = data.drop_duplicates(["Network", "ROI"])
+    names = {(n, r): name for n, r, name in zip(data.Network, data.ROI, data.ROI_name)}
+    print(f"Writing {args.out}")
+    similarity_frame(result, frois, names).to_csv(args.out, index=False)
+    print(block_summary(result, frois, args.ci).to_string(index=False))
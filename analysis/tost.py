@@ -0,0 +1,128 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from model_data import BATTERY, FROI_STR, build_sources, expt_data
+from permutation import difference_matrix, p_adjust_fdr
+from results_store import ResultsStore
+
+################################################################################
+# CONSTANTS AND PATHS
+################################################################################
+
+# Default equivalence bounds, on the scale of the tables' d = 2t / sqrt(df).
+BOUNDS = (-0.5, 0.5)
+ALPHA = 0.05
+
+################################################################################
+# TWO ONE-SIDED TESTS
+################################################################################
+
+# TOST of every row of `diffs` (tests x subjects, NaN = missing) at once.
+# With scale="d", the bounds are on the tables' effect size d = 2t / sqrt(df);
+# with scale="raw", they are in EffectSize units. A test shows equivalence
+# when both one-sided tests reject, i.e. when p_tost = max(p_lower, p_upper)
+# is below alpha. Returns t, df, d, the bounds in EffectSize units and p_tost.
+def tost(diffs, low=BOUNDS[0], high=BOUNDS[1], scale="d"):
+    present = ~np.isnan(diffs)
+    d = np.where(present, diffs, 0.0)
+    n = present.sum(axis=1)
+    df = n - 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = d.sum(axis=1) / n
+        se = np.sqrt(np.maximum((d ** 2).sum(axis=1) - n * mean ** 2, 0) / df / n)
+        t = mean / se
+        if scale == "d":
+            low_raw, high_raw = low * se * np.sqrt(df) / 2, high * se * np.sqrt(df) / 2
+        elif scale == "raw":
+            low_raw, high_raw = np.full(len(d), low), np.full(len(d), high)
+        else:
+            raise ValueError(f"unknown scale {scale!r}")
+        t_lower = t - low_raw / se
+        t_upper = t - high_raw / se
+    p_tost = np.maximum(stats.t.sf(t_lower, df), stats.t.cdf(t_upper, df))
+    return {
+        "t": t, "df": df, "cohen_d": 2 * t / np.sqrt(df),
+        "bound_low": low_raw, "bound_high": high_raw, "p_tost": p_tost,
+    }
+
+# Mean of the rows of `diffs` within each block of `blocks` (an integer label
+# per row), ignoring missing cells, as one (blocks x subjects) array.
+def block_means(diffs, blocks):
+    present = ~np.isnan(diffs)
+    sums = np.zeros((blocks.max() + 1, diffs.shape[1]))
+    counts = np.zeros_like(sums)
+    np.add.at(sums, blocks, np.where(present, diffs, 0.0))
+    np.add.at(counts, blocks, present)
+    with np.errstate(invalid="ignore"):
+        return sums / counts
+
+################################################################################
+# RESULTS TABLES
+################################################################################
+
+# Equivalence tests for every fROI of every contrast in the given tables (FDR
+# correction across the fROIs of each contrast, as in lmers.R) and for every
+# network, on the subjects' mean difference across its fROIs. All cells of
+# all tables are tested in two batched calls. Returns (sepfROIs, network)
+# frames per table, laid out like results/{table}_sepfROIs.csv and
+# results/{table}_network.csv.
+# Network cells are not tested on the model behind the tables' network d: the
+# tables fit a mixed model over all fROIs (lmer, with fROI and subject random
+# effects), while this is a paired t-test on the subjects' fROI means. Their
+# d, and so bounds on the d scale, measure the effect relative to the
+# between-subject spread of those means, not to the mixed model's standard
+# error, and need not agree with the d printed in the network row.
+def run_tost(tables, sources=None, low=BOUNDS[0], high=BOUNDS[1], scale="d", alpha=ALPHA):
+    sources = build_sources() if sources is None else sources
+    contrasts = [(table, c) for table in tables for c in BATTERY[table]]
+    diffs, labels = difference_matrix(sources, [c for _, c in contrasts])
+    blocks = np.array([i for i, _ in labels])
+    froi = tost(diffs, low, high, scale)
+    network = tost(block_means(diffs, blocks), low, high, scale)
+
+    fdr = np.empty(len(labels))
+    for i in range(len(contrasts)):
+        fdr[blocks == i] = p_adjust_fdr(froi["p_tost"][blocks == i])
+
+    desc = pd.DataFrame([
+        dict(table=table, cond1=c["cond1"], cond2=c["cond2"], expt_data=expt_data(c), network=c["network"])
+        for table, c in contrasts
+    ])
+    froi_rows = desc.iloc[blocks].reset_index(drop=True)
+    froi_rows["ROI"] = [ROI for _, ROI in labels]
+    froi_rows = froi_rows.assign(**{k: froi[k] for k in froi}, p_tost_fdr_corrected=fdr)
+    froi_rows["equivalent"] = froi_rows["p_tost_fdr_corrected"] < alpha
+    network_rows = desc.assign(ROI=desc["network"].map(FROI_STR), **{k: network[k] for k in network})
+    network_rows["equivalent"] = network_rows["p_tost"] < alpha
+
+    results = {}
+    for table in tables:
+        results[table] = tuple(
+            rows[rows.table == table].drop(columns="table").reset_index(drop=True)
+            for rows in [froi_rows, network_rows]
+        )
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Equivalence (TOST) tests for every contrast in the battery.")
+    parser.add_argument("tables", nargs="*", default=[t for t in BATTERY if not t.startswith("validation")],
+                        help="tables to run (default: all but the validation tables)")
+    parser.add_argument("--bounds", type=float, nargs=2, default=BOUNDS, metavar=("LOW", "HIGH"))
+    parser.add_argument("--scale", choices=["d", "raw"], default="d",
+                        help="bounds on the tables' d (default) or in EffectSize units")
+    parser.add_argument("--alpha", type=float, default=ALPHA)
+    args = parser.parse_args()
+    results = run_tost(args.tables, low=args.bounds[0], high=args.bounds[1], scale=args.scale, alpha=args.alpha)
+    # The CSVs are also imported into the results store, where format_table.py
+    # reads them from.
+    store = ResultsStore()
+    for table, (sep, network) in results.items():
+        for name, df in [("sepfROIs", sep), ("network", network)]:
+            out = f"results/{table}_{name}_tost.csv"
+            print(f"Writing {out}")
+            df.to_csv(out, index=False)
+            store.import_csv(out)
+    store.close()
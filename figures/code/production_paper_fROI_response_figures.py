@@ -23,10 +23,15 @@ import matplotlib.patches as mpatches
 from matplotlib.patches import Ellipse, Circle
 import pandas as pd
 import numpy as np
-import statistics
-import math
 import nibabel as nib
 from nilearn import plotting
+import sys
+sys.path.append('../../analysis')
+from indiv_data import load_indiv_data
+from indiv_tensor import FROITensor, bootstrap_ci, nanmean_sem
+from indexed_data import IndexedData
+from screening import apply_exclusions
+from parcels import relabel_parcels
 
 sns.set(style="ticks", font_scale=3.5)
 
@@ -34,67 +39,27 @@ sns.set(style="ticks", font_scale=3.5)
 # In[39]:
 
 
-#define helper filter functions
-
-#function that filters a dataframe by specified values in a specified column of the dataframe
-# example: dataframe containing columns subject_id, fROI, condition, effect_size
-# calling filter_X(data, ['cond1','cond2'], 'condition') will return the dataframe with only the rows
-# that have cond1 or cond2 as the condition
-def filter_X(data, targets, name_in_data):
-    if isinstance(targets, list): 
-        filter = 0
-        for target in targets:
-            filter = filter | (data[name_in_data] == target)
-        return (data[filter])
-    else:
-        raise TypeError("targets must be a list")
-
-# function that filters a dataframe by the specified conditions in the Effect column for each expt (use filter_X for a 
-# more general purpose filter function -- you can specify the column name to filter on there)
-def filter_conditions(data, conditions):
-    if(isinstance(conditions,dict)):
-        tmp = []
-        for expt in conditions:
-            tmp = tmp + conditions[expt]
-        
-        conditions = np.unique(tmp)
-        filter = 0
-        for cond in conditions:
-            filter = filter | (data.Effect == cond)
-        return (data[filter])
-    else:
-        raise Exception('conditions should be a dictionary specifying the conditions to be retained for each expt')
-
-# function that modifies experiment names -- this was very specific to the production paper, but could 
-# potentially be used for other things. consolidated_expt is an experiment that is present in all of the 
-# different experiments, for example, langloc. experiment_names is a list of experiments currently in the dataframe 
-# and new_exp_names is a list of new names (parallel with experiment_names) -- critical_tasks is more labels 
-# for the exp_names (kind of specific to production paper)
-def modify_experiment_names(data, consolidated_expt, experiment_names, new_exp_names, critical_tasks):
-    modified_data = data[0:0]
-    for ind,exp in enumerate(experiment_names):
-        if(consolidated_expt!=None):
-            if(exp !=consolidated_expt):
-                selected_data = data[(data.Expt==exp) & (data.CriticalTask==critical_tasks[ind])].copy()
-            else:
-                selected_data = data[(data.CriticalTask==critical_tasks[ind])].copy()
-        else:
-            selected_data = data[(data.CriticalTask==critical_tasks[ind])].copy()
-            
-        
-        selected_data.loc[:,'Expt'] = new_exp_names[ind]
-        modified_data = pd.concat([modified_data, selected_data])
-    return(modified_data)
-
 #wrapper function to filter and prep data for plotting figures for production paper
-def prep_data(data, consolidated_expt, networks, hemispheres, ROIs, conditions, critical_tasks, experiment_names, new_exp_names):
-    prepped_data = data
-    prepped_data = filter_X(prepped_data, networks, 'Network')
-    prepped_data = filter_X(prepped_data, hemispheres,'Hemisphere')
-    prepped_data = filter_X(prepped_data, ROIs,'ROI')
-    prepped_data = filter_conditions(prepped_data, conditions)
+# (keeps the rows of the given networks, hemispheres, fROIs and conditions, and renames each experiment
+# in experiment_names to its new_exp_names entry, taking the rows of its critical task; the rows are
+# looked up in an index over (Network, Hemisphere, ROI, Effect, Expt, CriticalTask) that is built once
+# per dataset and shared by every figure)
+#exclusions: optional list of subjects (or path of the manifest written by analysis/screening.py) to drop
+def prep_data(data, consolidated_expt, networks, hemispheres, ROIs, conditions, critical_tasks, experiment_names, new_exp_names, exclusions=None):
+    if not isinstance(conditions,dict):
+        raise Exception('conditions should be a dictionary specifying the conditions to be retained for each expt')
+    all_conditions = list(np.unique([cond for expt in conditions for cond in conditions[expt]]))
+    
+    index = IndexedData.of(data)
+    selections = dict(Network=networks, Hemisphere=hemispheres, ROI=ROIs, Effect=all_conditions)
+    prepped_data = index.relabel_experiments(selections, consolidated_expt, experiment_names, new_exp_names, critical_tasks)
+    if exclusions is not None:
+        prepped_data = apply_exclusions(prepped_data, exclusions)
     
-    prepped_data = modify_experiment_names(prepped_data, consolidated_expt, experiment_names, new_exp_names, critical_tasks)
+    #the cached data is dictionary-encoded -- decode the (now small) selection so that plotting
+    #sees plain values in their original order of appearance
+    for col in prepped_data.select_dtypes('category').columns:
+        prepped_data[col] = prepped_data[col].astype(prepped_data[col].cat.categories.dtype)
     
     return (prepped_data)
 
@@ -195,31 +160,32 @@ def add_brain_image(ax,image_file, main_brain, network):
     ab=AnnotationBbox(im, (x,y), xycoords='axes fraction', frameon=False, box_alignment=(0.0,0.5))
     ax.add_artist(ab)
 
-#this function generates a list of means and standard errors in a given expt order from the specified conditions in a dataset
-def generate_bar_data(data,expt_order,conditions):
+#this function generates a list of means and error bars in a given expt order from the specified conditions in a dataset
+# error="sem" gives standard errors; error="bootstrap" gives percentile bootstrap CIs (resampling subjects), as
+# [[mean-lower],[upper-mean]] so they can be passed straight to yerr
+def generate_bar_data(data,expt_order,conditions,error="sem",n_boot=1000,ci=95,chunk_size=None,seed=0):
     
     if not isinstance(conditions,dict):
         raise TypeError("conditions must be a dictionary specifying the conditions for each expt")
-        
+    if error not in ["sem","bootstrap"]:
+        raise ValueError("error must be 'sem' or 'bootstrap'")
+    
+    #dense (task, subject, network, ROI, condition) view of the data -- each expt is then one reduction
+    tensor = FROITensor.from_frame(data)
     bar_means_list = []
     bar_errors_list = []
     for expt in expt_order:
-        bar_means = []
-        bar_errors = []
-        for condition in conditions[expt]:
-            current_data = data[(data.Expt==expt)&(data.Effect==condition)]["EffectSize"]
-#             print(condition)
-#             print(current_data)
-#             print(expt)
-            n = len(current_data)
-            mean = statistics.mean(current_data)
-            SEM = statistics.stdev(current_data)/math.sqrt(n)
-            
-            bar_means.append(mean)
-            bar_errors.append(SEM)
-            
-        bar_means_list.append(bar_means)
-        bar_errors_list.append(bar_errors)
+        cells = tensor.values[tensor.task_indices(expt=expt)][..., tensor.indices("Effect", conditions[expt])]
+        #one column per condition, pooling over subjects and ROIs
+        bar_means, bar_errors = nanmean_sem(cells.reshape(-1, len(conditions[expt])), axis=0)
+        if error == "bootstrap":
+            #subjects first, so that one resample of subjects is shared by every condition of the expt
+            by_subject = np.moveaxis(cells, 1, 0)
+            lower, upper = bootstrap_ci(by_subject, n_boot=n_boot, ci=ci, seed=seed, chunk_size=chunk_size)
+            bar_errors = [[[m-lo],[hi-m]] for m,lo,hi in zip(bar_means,lower,upper)]
+        
+        bar_means_list.append(list(bar_means))
+        bar_errors_list.append(list(bar_errors))
     
     return (bar_means_list, bar_errors_list)
             
@@ -229,7 +195,8 @@ def generate_bar_data(data,expt_order,conditions):
 
 
 #function to make a figure from given data -- assumes individual level data
-def plot_data(ax,data, data_title,network, expt_order, conditions, xlim=None,ylim=None,ylabel=True,main_brain=False,brain_image="",plot_legend=False,plot_labels=False,plot_icons=False):
+# error_type is "sem" (default) or "bootstrap"; n_boot and chunk_size configure the bootstrap
+def plot_data(ax,data, data_title,network, expt_order, conditions, xlim=None,ylim=None,ylabel=True,main_brain=False,brain_image="",plot_legend=False,plot_labels=False,plot_icons=False,error_type="sem",n_boot=1000,chunk_size=None):
     
     SMALL_SIZE = 40
     MEDIUM_SIZE = 50
@@ -274,7 +241,7 @@ def plot_data(ax,data, data_title,network, expt_order, conditions, xlim=None,yli
     linewidth = 4
     capsize = 0
     
-    bar_means_all_expts, bar_errors_all_expts = generate_bar_data(data,expt_order,conditions)
+    bar_means_all_expts, bar_errors_all_expts = generate_bar_data(data,expt_order,conditions,error=error_type,n_boot=n_boot,chunk_size=chunk_size)
     
     sliding_x_pos = 0
     space_between_expts = bar_width*1.5
@@ -378,9 +345,9 @@ hemispheres = ["LH"] #which hemisphere to include in data
 ROIs = [i for i in range(1,6+1)]
 
 
-#read in the csv with all data
+#read in the csv with all data (from the columnar cache, rebuilt only when the csv changes)
 #this csv is in long format
-all_indiv_data = pd.read_csv('../../data/fMRI_all_indiv_production_data.csv')
+all_indiv_data = load_indiv_data('../../data/fMRI_all_indiv_production_data.csv')
 
 experiment_names = ["langloc","E1","E2","E3"]
 new_exp_names = ["LangLoc","E1","E2","E3"] #one to one correspondence with above list, replacement names
@@ -505,9 +472,9 @@ ROI_names = ["IFG", "PostTemp"]
 ROIs = [lang_ROI_names.index(roi)+1 for roi in ROI_names]
 
 
-#read in the csv with all data
+#read in the csv with all data (from the columnar cache, rebuilt only when the csv changes)
 #this csv is in long format
-all_indiv_data = pd.read_csv('../../data/fMRI_all_indiv_production_data.csv')
+all_indiv_data = load_indiv_data('../../data/fMRI_all_indiv_production_data.csv')
 
 experiment_names = ["E1"]
 new_exp_names = ["E1"] #one to one correspondence with above list, replacement names
@@ -581,18 +548,15 @@ for i, ax in enumerate(axes):
             # a bar graph that shows the S>W diffs, so a graph with 2 bars for each fROI: 
             # SProd WProd  SComp WComp SComp>WComp
             ax.set_title("b.", **TITLE_KWS)
+            #per-subject S-W differences for every fROI at once, from the dense view of the data
+            tensor = FROITensor.from_frame(indiv_data)
             data = []
-            for j, roi in enumerate(ROI_names):
-                for s in indiv_data.Subject.unique():
-                    rows = indiv_data[(indiv_data.Subject==s)&(indiv_data.ROI_name==roi)]
-                    for suffix in ["Prod", "Comp"]:
-                        data.append({
-                            "Subject": s,
-                            "ROI": ROIs[j],
-                            "ROI_name": roi,
-                            "EffectSizeDiff": rows[rows.Effect==f"S{suffix}"].squeeze().EffectSize - rows[rows.Effect==f"W{suffix}"].squeeze().EffectSize,
-                            "Contrast": f"S{suffix}-W{suffix}"
-                        })
+            for suffix in ["Prod", "Comp"]:
+                diff = tensor.to_frame(tensor.contrast(f"S{suffix}", f"W{suffix}"), name="EffectSizeDiff")
+                diff["ROI_name"] = [lang_ROI_names[roi-1] for roi in diff.ROI]
+                diff["Contrast"] = f"S{suffix}-W{suffix}"
+                data.append(diff[["Subject", "ROI", "ROI_name", "EffectSizeDiff", "Contrast"]])
+            data = pd.concat(data)
         else:
             # panel c
             # a bar graph that shows predictions of Matchin and Hickock’s silly account 
@@ -694,7 +658,7 @@ ROIs = [1,3,4]
 
 
 #read in the csv with all data
-# all_indiv_data = pd.read_csv('../../data/fMRI_all_indiv_production_data.csv')
+# all_indiv_data = load_indiv_data('../../data/fMRI_all_indiv_production_data.csv')
 
 experiment_names = ["E1","E3"]
 new_exp_names = ["E1","E3"] #one to one correspondence with above list, replacement names
@@ -745,7 +709,7 @@ ROIs = [30,10,23,27,5]
 
 
 #read in the csv with all data
-all_indiv_data = pd.read_csv('../../data/fMRI_all_indiv_production_data.csv')
+all_indiv_data = load_indiv_data('../../data/fMRI_all_indiv_production_data.csv')
 
 experiment_names = ["E1","E3"]
 new_exp_names = ["E1","E3"] #one to one correspondence with above list, replacement names
@@ -803,7 +767,7 @@ plot_labels_bool = [1,0,0,0,1,0,0,0,0]
 plot_legend_bool = [0,0,0,1,0,0,0,0,0]
 
 #read in the csv with all data
-all_indiv_data = pd.read_csv('../../data/fMRI_all_indiv_production_data.csv')
+all_indiv_data = load_indiv_data('../../data/fMRI_all_indiv_production_data.csv')
 
 experiment_names = ["LangLoc","MD","E1","E3"]
 new_exp_names = ["Lang","MD","E1","E3"] #one to one correspondence with above list, replacement names
@@ -825,22 +789,11 @@ fig_ax1 = fig.add_subplot(gs1[0:7,1:9])
 stat_img = "../parcels/SProd_SCompANDSProd_WProdfROIs.nii"
 ROI_color1="turquoise"
 ROI_color2="yellow"
-img = nib.load(stat_img)
-data = img.get_fdata()
-#select only the significant fROIs
-data_filtered = np.zeros(data.shape)
-for ix,i in enumerate(data):
-    for jx,j in enumerate(i):
-        for kx,k in enumerate(j):
-            if((k==1)|(k==2)|(k==3)|(k==11)):
-                data_filtered[ix,jx,kx]=1
-            if((k==4)|(k==5)|(k==6)|(k==7)|(k==9)):
-                data_filtered[ix,jx,kx]=2
-
-affine = img.affine
-new_image = nib.Nifti1Image(data_filtered, affine)
+#select only the significant fROIs: 1, 2, 3 and 11 become 1, and 4, 5, 6, 7 and 9 become 2
+#(the relabeled file is only rewritten when the parcels or this mapping change)
+selected_fROIs = {1: [1,2,3,11], 2: [4,5,6,7,9]}
 new_image_name = '../parcels/selected_production_ROIs.nii'
-nib.save(new_image, new_image_name)
+relabel_parcels(stat_img, new_image_name, {old: new for new, olds in selected_fROIs.items() for old in olds})
 colors = plt.cm.get_cmap('gray')
 display = plotting.plot_glass_brain(new_image_name,
                                         display_mode='lzr',